@@ -41,13 +41,19 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so its timings cover all the rest
+    'snippets.metrics.MetricsMiddleware',
+    'snippets.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    # before anything that reads the database, so session lookups follow the replica routing too
+    'snippets.routing.ReplicaRoutingMiddleware',
+    # Django's session, CSRF, auth, messages and clickjacking middleware, skipped for API clients (see middleware.py)
+    'snippets.middleware.ApiSessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'snippets.middleware.ApiCsrfViewMiddleware',
+    'snippets.middleware.ApiAuthenticationMiddleware',
+    'snippets.middleware.ApiMessageMiddleware',
+    'snippets.middleware.ApiXFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'mainAPI.urls'
@@ -91,6 +97,10 @@ DATABASES = {
     }
 }
 
+# Safe requests can read from replicas listed in SNIPPETS_READ_REPLICAS (see snippets/routing.py); writes always go to
+# 'default'.
+DATABASE_ROUTERS = ['snippets.routing.ReplicaRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -151,7 +161,12 @@ We could also customize the pagination style if we needed too, but in this case
 
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
-    'PAGE_SIZE': 10
+    'PAGE_SIZE': 10,
+    'DEFAULT_RENDERER_CLASSES': [
+        'rest_framework.renderers.JSONRenderer',
+        'snippets.renderers.CachedBrowsableAPIRenderer',
+    ],
+    'DEFAULT_METADATA_CLASS': 'snippets.metadata.CachedMetadata',
 }
 
 """
@@ -165,3 +180,117 @@ You'll also be able to see the 'highlight' links on the snippet instances, that
 HTML representations. 
 
 """
+
+# Highlighting
+
+# Viewers can ask the highlight endpoint for another style with ?style= and ?linenos=. Those renders are made on
+# demand, cached per process and held to the limits below.
+SNIPPETS_ON_DEMAND_MAX_CODE_BYTES = 256 * 1024
+SNIPPETS_ON_DEMAND_RENDER_SECONDS = 1.0
+SNIPPETS_RENDER_CACHE_SIZE = 256
+SNIPPETS_RENDER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Stored renders made in Snippet.save() and on-demand renders both run in a pool of sandboxed worker processes with
+# the limits below. A render over its limits is stored as plain escaped text instead.
+SNIPPETS_SANDBOX_ENABLED = True
+SNIPPETS_SANDBOX_WORKERS = 2
+SNIPPETS_SANDBOX_CPU_SECONDS = 2.0
+SNIPPETS_SANDBOX_WALL_SECONDS = 5.0
+SNIPPETS_SANDBOX_MAX_OUTPUT = 16 * 1024 * 1024
+SNIPPETS_SANDBOX_MEMORY_BYTES = 1024 * 1024 * 1024
+
+# `manage.py rehighlight` records its progress in a file per database in SNIPPETS_REHIGHLIGHT_CHECKPOINT_DIR, so an
+# interrupted run can resume; None uses the system's temporary directory.
+SNIPPETS_REHIGHLIGHT_CHECKPOINT_DIR = None
+
+# Raw code endpoint (/snippets/<pk>/raw). With SNIPPETS_RAW_STORE_DIR set, snippet bodies are also written to files
+# there and sent without passing through Python: 'sendfile' hands the file to the WSGI server's file wrapper, and
+# 'x-accel-redirect' leaves it to nginx, which must serve SNIPPETS_RAW_ACCEL_PREFIX from the store directory as an
+# internal location.
+SNIPPETS_RAW_STORE_DIR = None
+SNIPPETS_RAW_SERVE_MODE = 'sendfile'
+SNIPPETS_RAW_ACCEL_PREFIX = '/_raw/'
+
+# text/plain uploads to POST /snippets/ and PUT /snippets/<pk>/raw are read in chunks and refused past this size
+SNIPPETS_MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+
+# Concurrent misses for the same on-demand render are coalesced: threads of a process share one render, and processes
+# take turns through a lock ('file' for the processes of one host, 'advisory' for PostgreSQL advisory locks across
+# hosts, or None for in-process only) and share results through the Django cache named below. A process that waits
+# longer than SNIPPETS_COALESCE_WAIT_SECONDS gets the previous render of the snippet if there is one.
+SNIPPETS_COALESCE_LOCK = 'file'
+SNIPPETS_COALESCE_LOCK_DIR = None
+SNIPPETS_COALESCE_WAIT_SECONDS = 2.0
+SNIPPETS_RENDER_SHARED_CACHE = 'default'
+SNIPPETS_RENDER_SHARED_TIMEOUT = 60 * 60
+
+# Snippet views are counted in memory and written in batches, every SNIPPETS_VIEW_FLUSH_SECONDS or once
+# SNIPPETS_VIEW_FLUSH_THRESHOLD views are pending. /snippets/popular/ lists the SNIPPETS_POPULAR_SIZE most viewed.
+SNIPPETS_VIEW_FLUSH_SECONDS = 10.0
+SNIPPETS_VIEW_FLUSH_THRESHOLD = 1000
+SNIPPETS_POPULAR_SIZE = 50
+
+# Deleting a snippet through the API, or a user with `manage.py purge_deleted --delete-user`, only hides it; the
+# purger (`manage.py purge_deleted`) removes the rows SNIPPETS_PURGE_BATCH_SIZE at a time, waiting
+# SNIPPETS_PURGE_PAUSE_SECONDS between batches.
+SNIPPETS_PURGE_BATCH_SIZE = 500
+SNIPPETS_PURGE_PAUSE_SECONDS = 0.5
+
+# GET, HEAD and OPTIONS requests read from one of these DATABASES aliases, picked by weight, e.g.
+# {'replica1': 2, 'replica2': 1}. A client that writes reads from 'default' for SNIPPETS_REPLICA_PIN_SECONDS after,
+# so it sees its own changes despite replication lag.
+SNIPPETS_READ_REPLICAS = {}
+SNIPPETS_REPLICA_PIN_SECONDS = 5.0
+
+# On PostgreSQL the snippets table is partitioned by month of `created` (see snippets/partitions.py). Run
+# `manage.py manage_partitions` daily: it creates partitions SNIPPETS_PARTITIONS_AHEAD months ahead and, unless
+# SNIPPETS_PARTITIONS_RETAIN is None, detaches the partitions older than that many months.
+SNIPPETS_PARTITIONS_AHEAD = 3
+SNIPPETS_PARTITIONS_RETAIN = None
+
+# `manage.py archive_snippets` moves the code and renders of snippets older than SNIPPETS_ARCHIVE_AFTER_DAYS, viewed at
+# most SNIPPETS_ARCHIVE_MAX_VIEWS times, into compressed segment files of about SNIPPETS_ARCHIVE_SEGMENT_BYTES in
+# SNIPPETS_ARCHIVE_DIR. Archived snippets are read back from there transparently, so the directory must stay in place
+# (and be set) for as long as any snippet is archived.
+SNIPPETS_ARCHIVE_DIR = None
+SNIPPETS_ARCHIVE_AFTER_DAYS = 365
+SNIPPETS_ARCHIVE_MAX_VIEWS = 10
+SNIPPETS_ARCHIVE_SEGMENT_BYTES = 64 * 1024 * 1024
+
+# The browsable API caches the HTML forms it renders (with a <select> of every lexer and style, they are costly) in
+# each process, up to SNIPPETS_BROWSABLE_FORM_CACHE_SIZE of them; 0 renders them afresh every time.
+SNIPPETS_BROWSABLE_FORM_CACHE_SIZE = 256
+
+# Sessions, CSRF, auth, messages and X-Frame-Options only run for requests that may come from a browser: those under
+# SNIPPETS_BROWSER_PATHS, with a session cookie, or asking for the browsable API. Programs calling the JSON API skip
+# them; SNIPPETS_API_MIDDLEWARE = False runs them for every request.
+SNIPPETS_API_MIDDLEWARE = True
+SNIPPETS_BROWSER_PATHS = ('/admin/', '/api-auth/')
+
+# Every request is timed into per-view histograms served at /metrics (see snippets/metrics.py). With several worker
+# processes, point SNIPPETS_METRICS_DIR at a directory they share: each writes its histograms there every
+# SNIPPETS_METRICS_FLUSH_SECONDS and /metrics reports the sum. Empty the directory when restarting the server.
+SNIPPETS_METRICS_DIR = None
+SNIPPETS_METRICS_FLUSH_SECONDS = 5.0
+# /metrics answers the addresses and networks in SNIPPETS_METRICS_ALLOWED_IPS, compared with REMOTE_ADDR (behind a
+# proxy, that is the proxy's: restrict /metrics there too), and logged in staff users. None serves it to anyone.
+SNIPPETS_METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+# With SNIPPETS_PROFILE_DIR set, requests carrying a token from `manage.py profile_token` (valid for
+# SNIPPETS_PROFILE_TOKEN_MAX_AGE seconds) in an X-Snippets-Profile header or `profile` query parameter, and one in
+# SNIPPETS_PROFILE_SAMPLE_RATE others (0 for none), are profiled into that directory (see snippets/profiling.py). The
+# oldest profiles are removed beyond SNIPPETS_PROFILE_MAX_BYTES.
+SNIPPETS_PROFILE_DIR = None
+SNIPPETS_PROFILE_SAMPLE_RATE = 0
+SNIPPETS_PROFILE_MAX_BYTES = 256 * 1024 * 1024
+SNIPPETS_PROFILE_TOKEN_MAX_AGE = 3600
+
+# mainAPI/wsgi.py warms the process up when SNIPPETS_WARM_UP is set: it renders a line with each of
+# SNIPPETS_WARM_LEXERS, builds the formatters of every style and fills the URL and serializer caches (see
+# snippets/warmup.py). Load the application before forking (`gunicorn --preload`) so the workers share all that
+# instead of each building its own; `manage.py memory_report` shows how much of their memory is shared.
+SNIPPETS_WARM_UP = True
+SNIPPETS_WARM_LEXERS = (
+    'python', 'javascript', 'bash', 'java', 'html', 'sql', 'c', 'cpp', 'json', 'go', 'rust', 'ruby', 'php', 'css',
+    'yaml', 'text',
+)
@@ -15,6 +15,7 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from snippets.views import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -32,3 +33,8 @@ urlpatterns = [
 urlpatterns += [
     path('api-auth/', include('rest_framework.urls')),
 ]
+
+# request metrics for Prometheus to scrape
+urlpatterns += [
+    path('metrics', metrics, name='metrics'),
+]
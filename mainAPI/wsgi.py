@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mainAPI.settings')
 
 application = get_wsgi_application()
+
+# load lexers, formatters and caches once here, so that workers forked after a preload share them (see
+# snippets/warmup.py)
+from snippets.warmup import WARM_UP, warm_up  # noqa: E402
+
+if WARM_UP:
+    warm_up()
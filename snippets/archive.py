@@ -0,0 +1,189 @@
+"""
+Cold storage for the bodies of old, rarely read snippets.
+
+`manage.py archive_snippets` moves the big columns of snippets older than `SNIPPETS_ARCHIVE_AFTER_DAYS` and viewed at
+most `SNIPPETS_ARCHIVE_MAX_VIEWS` times (ARCHIVED_FIELDS: the code, the highlighted HTML and everything rendered
+from it) into segment files under `SNIPPETS_ARCHIVE_DIR`, blanks them in the table and records the segment number on
+the row. The row keeps its metadata, so lists, stats and lookups work as before, and loading a snippet with any of
+those fields reads them back from its segment (see `Snippet.from_db`). Saving an archived snippet writes the bodies
+back into the table; `manage.py rehydrate_snippets` does that in bulk.
+
+A segment is a pair of files written once and never changed:
+
+- `NNNNNN.seg`, the records one after another, each the zlib-compressed fields of one snippet;
+- `NNNNNN.idx`, fixed-size `(snippet id, offset, length, code bytes)` entries sorted by id, searched by bisection,
+  so reading a record costs one read of the index (cached) and one `pread` of the record.
+
+Records of snippets that are rehydrated or deleted stay behind in their segment.
+"""
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+ARCHIVE_DIR = getattr(settings, 'SNIPPETS_ARCHIVE_DIR', None)
+ARCHIVE_AFTER_DAYS = getattr(settings, 'SNIPPETS_ARCHIVE_AFTER_DAYS', 365)
+ARCHIVE_MAX_VIEWS = getattr(settings, 'SNIPPETS_ARCHIVE_MAX_VIEWS', 10)
+ARCHIVE_SEGMENT_BYTES = getattr(settings, 'SNIPPETS_ARCHIVE_SEGMENT_BYTES', 64 * 1024 * 1024)
+
+# the columns moved out of the table, and which of them hold text rather than bytes
+ARCHIVED_FIELDS = ('code', 'highlighted', 'highlighted_gzip', 'highlighted_br', 'highlight_state', 'tokens',
+                   'line_index')
+TEXT_FIELDS = ('code', 'highlighted')
+# what the table holds in their place
+ARCHIVED_BLANKS = {name: '' if name in TEXT_FIELDS else b'' for name in ARCHIVED_FIELDS}
+
+INDEX_ENTRY = struct.Struct('<QQII')
+FIELD_LENGTH = struct.Struct('<I')
+# segment indexes kept in memory
+INDEX_CACHE_SIZE = 64
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def encode_record(values):
+    parts = []
+    for name in ARCHIVED_FIELDS:
+        value = values[name]
+        value = value.encode('utf-8') if name in TEXT_FIELDS else bytes(value)
+        parts.append(FIELD_LENGTH.pack(len(value)))
+        parts.append(value)
+    return zlib.compress(b''.join(parts), 6)
+
+
+def decode_record(record):
+    data = zlib.decompress(record)
+    values, offset = {}, 0
+    for name in ARCHIVED_FIELDS:
+        length, = FIELD_LENGTH.unpack_from(data, offset)
+        offset += FIELD_LENGTH.size
+        value = data[offset:offset + length]
+        offset += length
+        values[name] = value.decode('utf-8') if name in TEXT_FIELDS else value
+    return values
+
+
+class SegmentWriter:
+    """
+    Writes one segment. Nothing is visible under the segment's name until `close()` has made it durable.
+    """
+
+    def __init__(self, store, number):
+        self.store = store
+        self.number = number
+        self.entries = []
+        self.size = 0
+        self._data = open(store.path(number, '.seg.tmp'), 'wb')
+
+    def add(self, pk, values):
+        record = encode_record(values)
+        self._data.write(record)
+        self.entries.append((pk, self.size, len(record), len(values['code'].encode('utf-8'))))
+        self.size += len(record)
+
+    def close(self):
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._data.close()
+        with open(self.store.path(self.number, '.idx.tmp'), 'wb') as index:
+            index.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in sorted(self.entries)))
+            index.flush()
+            os.fsync(index.fileno())
+        os.replace(self.store.path(self.number, '.seg.tmp'), self.store.path(self.number, '.seg'))
+        os.replace(self.store.path(self.number, '.idx.tmp'), self.store.path(self.number, '.idx'))
+
+    def discard(self):
+        self._data.close()
+        os.remove(self.store.path(self.number, '.seg.tmp'))
+
+
+class ArchiveStore:
+    """
+    The segment files in one directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, number, suffix):
+        return os.path.join(self.root, '%06d%s' % (number, suffix))
+
+    def segments(self):
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith('.idx') and name[:-4].isdigit())
+
+    def writer(self):
+        """
+        Start the next segment.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        in_progress = [int(name.split('.')[0]) for name in os.listdir(self.root) if name.endswith('.tmp')]
+        return SegmentWriter(self, max(self.segments() + in_progress + [0]) + 1)
+
+    def _index(self, number):
+        with self._lock:
+            index = self._indexes.get(number)
+            if index is not None:
+                self._indexes.move_to_end(number)
+                return index
+        try:
+            with open(self.path(number, '.idx'), 'rb') as index_file:
+                index = index_file.read()
+        except FileNotFoundError:
+            raise ArchiveError('Archive segment %d is missing from %s.' % (number, self.root))
+        with self._lock:
+            self._indexes[number] = index
+            while len(self._indexes) > INDEX_CACHE_SIZE:
+                self._indexes.popitem(last=False)
+        return index
+
+    def entry(self, number, pk):
+        """
+        Return the `(offset, length, code bytes)` of the snippet's record in segment `number`.
+        """
+        index = self._index(number)
+        low, high = 0, len(index) // INDEX_ENTRY.size
+        while low < high:
+            middle = (low + high) // 2
+            entry = INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)
+            if entry[0] == pk:
+                return entry[1:]
+            if entry[0] < pk:
+                low = middle + 1
+            else:
+                high = middle
+        raise ArchiveError('Snippet %d is not in archive segment %d.' % (pk, number))
+
+    def read(self, number, pk):
+        """
+        Return the archived fields of a snippet, as `{field name: value}`.
+        """
+        offset, length, _ = self.entry(number, pk)
+        with open(self.path(number, '.seg'), 'rb') as segment:
+            return decode_record(os.pread(segment.fileno(), length, offset))
+
+    def code_size(self, number, pk):
+        return self.entry(number, pk)[2]
+
+
+archive_store = ArchiveStore(ARCHIVE_DIR) if ARCHIVE_DIR else None
+
+
+def get_archive_store():
+    """
+    The configured store, for reading snippets that have been archived.
+    """
+    if archive_store is None:
+        raise ImproperlyConfigured('Some snippets are archived; SNIPPETS_ARCHIVE_DIR must point at their segments.')
+    return archive_store
@@ -0,0 +1,165 @@
+"""
+Request coalescing ("singleflight") for expensive lookups.
+
+When a popular snippet's render drops out of the cache, every request for it would otherwise render it at the same
+time. Instead, the first caller for a key does the work and everyone else arriving meanwhile waits for its result:
+
+- within a process, `SingleFlight` makes concurrent threads share one call per key;
+- across processes, `process_lock` serialises the work per key, with a lock file (one host) or a PostgreSQL advisory
+  lock (any number of hosts). Whoever gets the lock second finds the result in the shared cache, and whoever waits too
+  long falls back to a slightly stale copy instead.
+"""
+import errno
+import fcntl
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+COALESCE_LOCK = getattr(settings, 'SNIPPETS_COALESCE_LOCK', 'file')
+COALESCE_LOCK_DIR = getattr(settings, 'SNIPPETS_COALESCE_LOCK_DIR', None)
+COALESCE_WAIT_SECONDS = getattr(settings, 'SNIPPETS_COALESCE_WAIT_SECONDS', 2.0)
+
+# keys are hashed onto this many lock files, so the directory stays small
+LOCK_STRIPES = 1024
+LOCK_POLL_SECONDS = 0.01
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs a function at most once per key at a time; callers that arrive while it runs get the same outcome.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # 'leader' calls did the work, 'shared' ones waited for a leader
+        self.stats = Counter()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            self.stats['leader' if leader else 'shared'] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+def _digest(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).digest()
+
+
+class FileLock:
+    """
+    Per-key exclusive locks between the processes of one host, using `flock` on striped lock files.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @contextmanager
+    def hold(self, key, timeout):
+        """
+        Try to hold the lock for `key` for the duration of the block, yielding whether we got it within `timeout`.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        stripe = struct.unpack('<H', _digest(key)[:2])[0] % LOCK_STRIPES
+        fd = os.open(os.path.join(self.directory, '%04d.lock' % stripe), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            acquired = _poll(lambda: _try_flock(fd), timeout)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+def _try_flock(fd):
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError as exc:
+        if exc.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+
+
+def _poll(attempt, timeout):
+    deadline = time.monotonic() + timeout
+    while not attempt():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(LOCK_POLL_SECONDS)
+    return True
+
+
+class AdvisoryLock:
+    """
+    Per-key exclusive locks between any processes sharing the PostgreSQL database, using session advisory locks.
+    """
+
+    @contextmanager
+    def hold(self, key, timeout):
+        lock_id = struct.unpack('<q', _digest(key)[:8])[0]
+        with connection.cursor() as cursor:
+            def attempt():
+                cursor.execute('SELECT pg_try_advisory_lock(%s)', [lock_id])
+                return cursor.fetchone()[0]
+            acquired = _poll(attempt, timeout)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    cursor.execute('SELECT pg_advisory_unlock(%s)', [lock_id])
+
+
+class NoLock:
+    """
+    Coalescing within the process only.
+    """
+
+    @contextmanager
+    def hold(self, key, timeout):
+        yield True
+
+
+def get_process_lock(kind=COALESCE_LOCK, directory=COALESCE_LOCK_DIR):
+    if kind == 'advisory':
+        return AdvisoryLock()
+    if kind == 'file':
+        return FileLock(directory or os.path.join(tempfile.gettempdir(), 'snippets-locks'))
+    return NoLock()
+
+
+process_lock = get_process_lock()
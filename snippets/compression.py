@@ -0,0 +1,72 @@
+"""
+Pre-compressed variants of the highlighted HTML.
+
+The highlighted document only changes when a snippet is re-rendered, so we compress it once at save time and let
+`SnippetHighlight` hand the stored bytes straight to the client instead of compressing the same document on every GET.
+
+brotli is optional; without it only the gzip variant is stored.
+"""
+import gzip
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+# encodings we can serve from storage, in order of preference when the client rates them equally
+SUPPORTED_ENCODINGS = ('br', 'gzip')
+
+
+def compress_variants(html):
+    """
+    Return a dict of `{encoding: bytes}` holding every pre-compressed variant of `html`.
+    """
+    data = html.encode('utf-8')
+    # mtime=0 keeps the gzip output stable so unchanged renders give byte-identical variants
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, mode=brotli.MODE_TEXT)
+    return variants
+
+
+def parse_accept_encoding(header):
+    """
+    Parse an `Accept-Encoding` header into a dict of `{coding: qvalue}`.
+    """
+    codings = {}
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+    return codings
+
+
+def preferred_encoding(header, available):
+    """
+    Pick the best encoding from `available` that the client accepts, or None to send the document uncompressed.
+    """
+    if not header:
+        return None
+    codings = parse_accept_encoding(header)
+    wildcard = codings.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for encoding in SUPPORTED_ENCODINGS:
+        if encoding not in available:
+            continue
+        quality = codings.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    # an explicit identity preference beats a compressed variant the client only tolerates
+    if best is not None and codings.get('identity', 0.0) > best_quality:
+        return None
+    return best
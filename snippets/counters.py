@@ -0,0 +1,148 @@
+"""
+Buffered snippet view counts.
+
+An UPDATE per snippet view would make every read a write. Views are counted in process memory instead and flushed to
+SnippetViews in one batched upsert, every `SNIPPETS_VIEW_FLUSH_SECONDS` or as soon as `SNIPPETS_VIEW_FLUSH_THRESHOLD`
+views are pending, whichever comes first. Each flush also reloads the most viewed snippets from the count index,
+which is what `/snippets/popular/` serves, so that endpoint never sorts the table; a process that serves it without
+counting views, and so without flushing, reloads the list itself once it is `SNIPPETS_VIEW_FLUSH_SECONDS` old.
+
+Counts still in memory when a process dies are lost, so the numbers are approximate by design.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+from .models import Snippet, SnippetViews
+
+logger = logging.getLogger(__name__)
+
+VIEW_FLUSH_SECONDS = getattr(settings, 'SNIPPETS_VIEW_FLUSH_SECONDS', 10.0)
+VIEW_FLUSH_THRESHOLD = getattr(settings, 'SNIPPETS_VIEW_FLUSH_THRESHOLD', 1000)
+POPULAR_SIZE = getattr(settings, 'SNIPPETS_POPULAR_SIZE', 50)
+
+# rows per upsert statement, and snippets per query checking they still exist: both stay under SQLite's limit of
+# 999 parameters a statement
+UPSERT_BATCH_SIZE = 500
+
+
+def upsert_counts(counts):
+    """
+    Add `{snippet pk: views}` to SnippetViews in batched `INSERT ... ON CONFLICT DO UPDATE` statements.
+
+    Counts for snippets deleted in the meantime are dropped.
+    """
+    pks = sorted(counts)
+    existing = set()
+    for start in range(0, len(pks), UPSERT_BATCH_SIZE):
+        existing.update(Snippet.objects.filter(pk__in=pks[start:start + UPSERT_BATCH_SIZE])
+                        .values_list('pk', flat=True))
+    rows = [(pk, count) for pk, count in sorted(counts.items()) if pk in existing]
+    table = connection.ops.quote_name(SnippetViews._meta.db_table)
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            batch = rows[start:start + UPSERT_BATCH_SIZE]
+            cursor.execute(
+                'INSERT INTO {table} (snippet_id, count) VALUES {values} '
+                'ON CONFLICT (snippet_id) DO UPDATE SET count = {table}.count + EXCLUDED.count'.format(
+                    table=table, values=', '.join(['(%s, %s)'] * len(batch))),
+                [value for row in batch for value in row])
+    return len(rows)
+
+
+class ViewCounter:
+    """
+    Adds up snippet views in memory and flushes them from a background thread.
+    """
+
+    def __init__(self, flush_seconds=VIEW_FLUSH_SECONDS, flush_threshold=VIEW_FLUSH_THRESHOLD,
+                 popular_size=POPULAR_SIZE, background=True):
+        self.flush_seconds = flush_seconds
+        self.flush_threshold = flush_threshold
+        self.popular_size = popular_size
+        self.background = background
+        self.popular = []
+        self.popular_refreshed = None
+        self._pending = Counter()
+        self._pending_total = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, pk, views=1):
+        with self._lock:
+            self._pending[pk] += views
+            self._pending_total += views
+            over_threshold = self._pending_total >= self.flush_threshold
+            if self.background and self._thread is None:
+                self._start()
+        if over_threshold:
+            self._wake.set()
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='snippet-view-counter', daemon=True)
+        self._thread.start()
+        atexit.register(self._flush_at_exit)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            try:
+                self.flush()
+            except DatabaseError:
+                logger.exception('Flushing snippet view counts failed')
+            finally:
+                # this thread outlives any request, so it has to give its connection back itself
+                connection.close()
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except DatabaseError:
+            logger.warning('Could not flush %d snippet views at exit', self._pending_total, exc_info=True)
+
+    def flush(self):
+        """
+        Write the pending counts and reload the popular list. Counts are put back if the write fails.
+        """
+        with self._flush_lock:
+            with self._lock:
+                counts, self._pending = self._pending, Counter()
+                self._pending_total = 0
+            if counts:
+                try:
+                    upsert_counts(counts)
+                except DatabaseError:
+                    with self._lock:
+                        self._pending.update(counts)
+                        self._pending_total += sum(counts.values())
+                    raise
+            self.refresh_popular()
+
+    def refresh_popular(self):
+        self.popular = list(SnippetViews.objects.order_by('-count')
+                            .values_list('snippet_id', 'count')[:self.popular_size])
+        self.popular_refreshed = time.monotonic()
+
+    def get_popular(self):
+        """
+        Return the `(snippet pk, views)` of the most viewed snippets, as of the last flush or at most `flush_seconds`
+        ago.
+        """
+        if self.popular_refreshed is None or time.monotonic() - self.popular_refreshed >= self.flush_seconds:
+            self.refresh_popular()
+        return self.popular
+
+
+view_counter = ViewCounter()
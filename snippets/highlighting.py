@@ -0,0 +1,292 @@
+"""
+Rendering snippets to highlighted HTML.
+
+`Snippet.save()` renders the stored `highlighted` document with the snippet's own style, inside the highlight
+sandbox, falling back to plain escaped text if the render goes over its limits. When only the code changed the
+stored render is updated incrementally (see `incremental.py`), and the lexed tokens are stored alongside it (see
+`tokens.py`). Viewers can also ask `SnippetHighlight` for another style, line-number setting or ANSI output; those
+renders are formatted on demand from the stored tokens, kept in a bounded in-process cache and held to a size and
+time budget so a huge paste cannot stall a worker.
+"""
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from functools import lru_cache
+from html import escape
+from io import StringIO
+
+from django.conf import settings
+from django.core.cache import caches
+from pygments.formatters.html import HtmlFormatter
+from pygments.formatters.terminal256 import Terminal256Formatter
+from pygments.lexers import get_lexer_by_name
+
+from .incremental import (
+    HighlightState, LinesFormatter, format_lines, preprocess, render_full, render_incremental, stripped_lines,
+    supports_incremental, wrap_lines,
+)
+from .lines import build_index
+from .coalesce import COALESCE_WAIT_SECONDS, SingleFlight, process_lock
+from .sandbox import RenderLimitExceeded, record_limit_hit, sandbox
+from .tokens import TokenStream
+
+# limits for renders made on demand from SnippetHighlight
+ON_DEMAND_MAX_CODE_BYTES = getattr(settings, 'SNIPPETS_ON_DEMAND_MAX_CODE_BYTES', 256 * 1024)
+ON_DEMAND_RENDER_SECONDS = getattr(settings, 'SNIPPETS_ON_DEMAND_RENDER_SECONDS', 1.0)
+RENDER_CACHE_SIZE = getattr(settings, 'SNIPPETS_RENDER_CACHE_SIZE', 256)
+RENDER_CACHE_MAX_BYTES = getattr(settings, 'SNIPPETS_RENDER_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+# the Django cache on-demand renders are shared between processes through
+RENDER_SHARED_CACHE = getattr(settings, 'SNIPPETS_RENDER_SHARED_CACHE', 'default')
+RENDER_SHARED_TIMEOUT = getattr(settings, 'SNIPPETS_RENDER_SHARED_TIMEOUT', 60 * 60)
+
+# formats SnippetHighlight can render on demand with ?output=
+OUTPUT_CHOICES = [('html', 'HTML document'), ('ansi', '256-colour ANSI text')]
+
+# how many tokens we format between two looks at the clock
+DEADLINE_CHECK_INTERVAL = 512
+
+# how many `Snippet.save()` calls 'performed' the stored render and how many 'skipped' it as nothing it uses changed
+render_counts = Counter()
+
+
+def get_formatter(style, linenos, title='', formatter_class=HtmlFormatter):
+    """
+    Build the HtmlFormatter used for every stored and on-demand render.
+    """
+    options = {'title': title} if title else {}
+    return formatter_class(style=style, linenos='table' if linenos else False, full=True, **options)
+
+
+def plain_html(code):
+    """
+    The fallback document used when a snippet can't be highlighted within its limits.
+    """
+    return '<pre>%s</pre>' % escape(code)
+
+
+class _BoundedWriter(StringIO):
+    # a StringIO that refuses to grow past `limit` characters
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def write(self, s):
+        if self.tell() + len(s) > self.limit:
+            raise RenderLimitExceeded('Rendered output is larger than the allowed size.')
+        return super().write(s)
+
+
+def _until(tokens, deadline):
+    # pass tokens through, giving up once the deadline has gone by
+    for count, token in enumerate(tokens):
+        if count % DEADLINE_CHECK_INTERVAL == 0 and time.monotonic() > deadline:
+            raise RenderLimitExceeded('Rendering took longer than the allowed time.')
+        yield token
+
+
+@lru_cache(maxsize=128)
+def get_output_formatter(output, style, linenos, title=''):
+    """
+    Return the formatter for an on-demand render: the HTML document, or 256-colour ANSI text for terminals.
+
+    Building a formatter works out the CSS or escape codes of every token type in the style, which costs as much as
+    formatting a small snippet, so they are built once per process and shared.
+    """
+    if output == 'ansi':
+        return Terminal256Formatter(style=style, linenos=linenos)
+    return get_formatter(style, linenos, title)
+
+
+def format_tokens(tokens, formatter, timeout=None, max_output=None):
+    """
+    Format `(tokentype, value)` pairs with `formatter`.
+
+    With a `timeout` (in seconds) formatting, and the lexing feeding it, stop with RenderLimitExceeded once the time
+    is up, and with `max_output` so does output growing past that many characters.
+    """
+    if timeout is not None:
+        tokens = _until(tokens, time.monotonic() + timeout)
+    out = _BoundedWriter(max_output) if max_output else StringIO()
+    formatter.format(tokens, out)
+    return out.getvalue()
+
+
+def render_html(code, language, style, linenos, title='', output='html', timeout=None, max_output=None):
+    """
+    Lex and format `code`, returning the full highlighted HTML document (or ANSI text, with `output='ansi'`).
+    """
+    lexer = get_lexer_by_name(language)
+    formatter = get_output_formatter(output, style, linenos, title)
+    return format_tokens(lexer.get_tokens(code), formatter, timeout, max_output)
+
+
+def render_tokens(tokens, code, style, linenos, title='', output='html', timeout=None, max_output=None):
+    """
+    Like `render_html`, but formatting the token stream stored in `Snippet.tokens` instead of lexing `code` again.
+    """
+    formatter = get_output_formatter(output, style, linenos, title)
+    return format_tokens(TokenStream.decode(tokens, code), formatter, timeout, max_output)
+
+
+# what a stored render produces; `state`, `tokens` and `lines` are encoded for the BinaryFields of the same names
+Render = namedtuple('Render', 'html state tokens lines')
+
+
+def render_with_state(code, language, style, linenos, title='', previous=None, max_output=None):
+    """
+    Return a Render: the highlighted document for `code`, the state needed to update it incrementally later, the
+    token stream and the line-offset index.
+
+    `previous` is an optional `(code, html, state, tokens)` rendered earlier with the same language and options; the
+    new document is then made by re-highlighting only what the edit touched. Lexers that can't be lexed
+    incrementally are rendered in full and get an empty state.
+    """
+    lexer = get_lexer_by_name(language)
+    formatter = get_formatter(style, linenos, title, formatter_class=LinesFormatter)
+    if not supports_incremental(lexer):
+        tokens = list(lexer.get_tokens(code))
+        html, body_start, body_end = wrap_lines(formatter, format_lines(formatter, tokens))
+        state, stream = None, TokenStream.from_tokens(tokens)
+    else:
+        text = preprocess(lexer, code)
+        if previous is not None:
+            old_code, old_html, old_state, old_tokens = previous
+            old_text = preprocess(lexer, old_code)
+            html, state, (start, end, tokens) = render_incremental(lexer, formatter, old_text, old_html,
+                                                                   HighlightState.decode(old_state), text)
+            stream = TokenStream.decode(old_tokens, old_code).splice(start, end, tokens, text)
+        else:
+            html, state, tokens = render_full(lexer, formatter, text)
+            stream = TokenStream.from_tokens(tokens)
+        body_start, body_end = state.body_start, state.body_end
+    if max_output and len(html) > max_output:
+        raise RenderLimitExceeded('Rendered output is larger than the allowed size.')
+    return Render(html, state.encode() if state else b'', stream.encode(code),
+                  build_index(code, html, body_start, body_end, stripped_lines(lexer, code)))
+
+
+def fallback_render(code):
+    """
+    The Render stored for a snippet that couldn't be highlighted: `plain_html`, with no state or tokens.
+    """
+    html = plain_html(code)
+    return Render(html, b'', b'', build_index(code, html, len('<pre>'), len(html) - len('</pre>')))
+
+
+def render_stored(code, language, style, linenos, title='', previous=None):
+    """
+    Render the document stored in `Snippet.highlighted` along with the rest of its Render.
+
+    Falls back to `fallback_render` when a limit is hit.
+    """
+    try:
+        return sandbox.run(render_with_state, code, language, style, linenos, title, previous)
+    except RenderLimitExceeded as exc:
+        record_limit_hit(language, code, exc)
+        return fallback_render(code)
+
+
+class RenderCache:
+    """
+    A thread-safe LRU of rendered documents, bounded both by entry count and by total size.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE, RENDER_CACHE_MAX_BYTES)
+
+
+render_flight = SingleFlight()
+
+
+def _render(snippet, style, linenos, output):
+    # failures are returned rather than raised, so they are cached like any other result
+    try:
+        if len(snippet.code.encode('utf-8')) > ON_DEMAND_MAX_CODE_BYTES:
+            raise RenderLimitExceeded('Snippet is too large to render on demand.')
+        if snippet.tokens:
+            return render_tokens(snippet.tokens, snippet.code, style, linenos, snippet.title, output,
+                                 timeout=ON_DEMAND_RENDER_SECONDS, max_output=sandbox.max_output)
+        return sandbox.run(render_html, snippet.code, snippet.language, style, linenos, snippet.title, output,
+                           timeout=ON_DEMAND_RENDER_SECONDS)
+    except RenderLimitExceeded as exc:
+        record_limit_hit(snippet.language, snippet.code, exc)
+        return exc
+
+
+def _render_shared(snippet, key):
+    # Runs once per key per process at a time. The shared cache holds renders for every process, and the process
+    # lock makes sure only one of them renders a given key; the latest good render of each snippet and options is
+    # kept as well, for callers that can't get the lock in time.
+    pk, version, style, linenos, output = key
+    shared = caches[RENDER_SHARED_CACHE]
+    shared_key = 'snippets:render:%d:%d:%s:%d:%s' % key
+    latest_key = 'snippets:render-latest:%d:%s:%d:%s' % (pk, style, linenos, output)
+    rendered = shared.get(shared_key)
+    if rendered is None:
+        with process_lock.hold(shared_key, COALESCE_WAIT_SECONDS) as acquired:
+            rendered = shared.get(shared_key)
+            if rendered is None and not acquired:
+                stale = shared.get(latest_key)
+                if stale is not None:
+                    render_flight.stats['stale'] += 1
+                    return stale
+            if rendered is None:
+                rendered = _render(snippet, style, linenos, output)
+                shared.set(shared_key, rendered, RENDER_SHARED_TIMEOUT)
+                if not isinstance(rendered, RenderLimitExceeded):
+                    shared.set(latest_key, rendered, RENDER_SHARED_TIMEOUT)
+    render_cache.set(key, rendered, 0 if isinstance(rendered, RenderLimitExceeded) else len(rendered))
+    return rendered
+
+
+def render_on_demand(snippet, style, linenos, output='html'):
+    """
+    Return `snippet` rendered with `style` and `linenos` as HTML or ANSI text, going through the render caches.
+
+    Snippets with a stored token stream are only formatted, in-process; the others are lexed in the highlight
+    sandbox. Concurrent misses for the same render are coalesced, within the process and across processes, so a
+    burst of requests renders it once (see coalesce.py). Failures are cached as well, so a snippet that blew its
+    budget once isn't rendered again until it changes.
+    """
+    key = (snippet.pk, snippet.version, style, linenos, output)
+    cached = render_cache.get(key)
+    if cached is None:
+        cached = render_flight.do(key, _render_shared, snippet, key)
+    if isinstance(cached, RenderLimitExceeded):
+        raise cached
+    return cached
@@ -0,0 +1,503 @@
+"""
+Incremental re-highlighting.
+
+Every stored render keeps a little state next to it: the lexer's state stack at each line start the lexer landed
+on, and where the code lines sit in the highlighted document. When a snippet's code is edited we find the first
+changed line, re-lex from the nearest checkpoint before it, and stop as soon as we reach a line in the unchanged tail
+where the lexer is in the same state as last time. Everything past that point lexes exactly as before, so the old
+HTML lines are spliced back in as they are.
+
+Reusing the lines before the edit needs one more guarantee: no regex tried before the restart point may have looked
+at the edited text. Most lexer rules can't see past the end of the line they start on, which we check by looking at
+the parsed regex. For the few that can (block comments, triple-quoted strings, ...) the lex records every attempt
+that got past the part of the rule confined to its line, and on an edit those attempts are re-run against the new
+text; if any of them comes out differently we restart before it.
+
+This only works for plain RegexLexer subclasses without filters; any other lexer is always rendered in full.
+"""
+import json
+import zlib
+from io import StringIO
+
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexer import RegexLexer
+from pygments.token import Error, Whitespace, _TokenType
+
+try:
+    from re import _compiler as sre_compile, _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_compile
+    import sre_constants
+    import sre_parse
+
+# marks[line] for a line start the lexer never stopped at (a single token ran across it)
+NO_CHECKPOINT = -1
+
+_ATOMS = (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN)
+_REPEATS = tuple(op for op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+                               getattr(sre_constants, 'POSSESSIVE_REPEAT', None)) if op is not None)
+_ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
+_NEWLINE_CATEGORIES = {
+    getattr(sre_constants, name) for name in (
+        'CATEGORY_SPACE', 'CATEGORY_NOT_DIGIT', 'CATEGORY_NOT_WORD', 'CATEGORY_LINEBREAK', 'CATEGORY_UNI_SPACE',
+        'CATEGORY_UNI_NOT_DIGIT', 'CATEGORY_UNI_NOT_WORD', 'CATEGORY_UNI_LINEBREAK',
+    )
+}
+
+
+class LinesFormatter(HtmlFormatter):
+    """
+    An HtmlFormatter that wraps lines which have already been formatted, instead of formatting tokens.
+    """
+
+    def format_lines(self, lines, outfile):
+        self._formatted_lines = lines
+        self.format_unencoded(None, outfile)
+
+    def _format_lines(self, tokensource):
+        for line in self._formatted_lines:
+            yield 1, line + self.lineseparator
+
+
+def supports_incremental(lexer):
+    return (isinstance(lexer, RegexLexer)
+            and type(lexer).get_tokens_unprocessed is RegexLexer.get_tokens_unprocessed
+            and not lexer.filters)
+
+
+def preprocess(lexer, text):
+    """
+    Normalise `text` the way `Lexer.get_tokens` does before lexing, so our line numbers match the formatter's.
+    """
+    if text.startswith('\ufeff'):
+        text = text[1:]
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if lexer.stripall:
+        text = text.strip()
+    elif lexer.stripnl:
+        text = text.strip('\n')
+    if lexer.tabsize > 0:
+        text = text.expandtabs(lexer.tabsize)
+    if lexer.ensurenl and not text.endswith('\n'):
+        text += '\n'
+    return text
+
+
+def stripped_lines(lexer, text):
+    """
+    How many lines at the start of `text` `preprocess` strips, which the formatter doesn't number.
+    """
+    if text.startswith('\ufeff'):
+        text = text[1:]
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if lexer.stripall:
+        kept = text.lstrip()
+    elif lexer.stripnl:
+        kept = text.lstrip('\n')
+    else:
+        return 0
+    return text.count('\n', 0, len(text) - len(kept))
+
+
+# Looking inside the lexer's regexes
+
+def _accepts_newline(op, av, flags):
+    if op == sre_constants.LITERAL:
+        return av == 10
+    if op == sre_constants.NOT_LITERAL:
+        return av != 10
+    if op == sre_constants.ANY:
+        return bool(flags & sre_constants.SRE_FLAG_DOTALL)
+    negate, found = False, False
+    for item, value in av:
+        if item == sre_constants.NEGATE:
+            negate = True
+        elif item == sre_constants.LITERAL:
+            found = found or value == 10
+        elif item == sre_constants.RANGE:
+            found = found or value[0] <= 10 <= value[1]
+        elif item == sre_constants.CATEGORY:
+            found = found or value in _NEWLINE_CATEGORIES
+        else:
+            return True
+    return found != negate
+
+
+def _newline_free(items, flags):
+    # True if nothing in `items` can match or look ahead at a newline
+    for op, av in items:
+        if op in _ATOMS:
+            if _accepts_newline(op, av, flags):
+                return False
+        elif op in _REPEATS:
+            if not _newline_free(av[2], flags):
+                return False
+        elif op == sre_constants.SUBPATTERN:
+            if not _newline_free(av[-1], (flags | av[1]) & ~av[2]):
+                return False
+        elif op == _ATOMIC_GROUP:
+            if not _newline_free(av, flags):
+                return False
+        elif op == sre_constants.BRANCH:
+            if not all(_newline_free(alternative, flags) for alternative in av[1]):
+                return False
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if av[0] > 0 and not _newline_free(av[1], flags):
+                return False
+        elif op == sre_constants.GROUPREF_EXISTS:
+            if not all(_newline_free(branch, flags) for branch in av[1:] if branch is not None):
+                return False
+        elif op != sre_constants.AT:
+            return False
+    return True
+
+
+def _line_local(items, flags, final=True):
+    """
+    True if a match attempt with `items` never looks past the first newline at or after where it starts.
+
+    A newline may still be matched by the very last element (say a trailing `\\s+`): that only ever extends the match
+    itself, and peeks at most one character past its end.
+    """
+    items = list(items)
+    for index, (op, av) in enumerate(items):
+        last = final and index == len(items) - 1
+        if op in _ATOMS:
+            if not last and _accepts_newline(op, av, flags):
+                return False
+        elif op in _REPEATS:
+            body = list(av[2])
+            if not _newline_free(body, flags) and not (last and len(body) == 1 and body[0][0] in _ATOMS):
+                return False
+        elif op == sre_constants.SUBPATTERN:
+            if not _line_local(av[-1], (flags | av[1]) & ~av[2], last):
+                return False
+        elif op == _ATOMIC_GROUP:
+            if not _line_local(av, flags, last):
+                return False
+        elif op == sre_constants.BRANCH:
+            if not all(_line_local(alternative, flags, last) for alternative in av[1]):
+                return False
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if av[0] > 0 and not _newline_free(av[1], flags):
+                return False
+        elif op == sre_constants.GROUPREF_EXISTS:
+            if not all(_line_local(branch, flags, last) for branch in av[1:] if branch is not None):
+                return False
+        elif op != sre_constants.AT:
+            return False
+    return True
+
+
+def _lookbehind(items):
+    # how many characters before its start position a match attempt may look at
+    width = 0
+    for op, av in items:
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            width = max(width, av[1].getwidth()[1] if av[0] < 0 else _lookbehind(av[1]))
+        elif op == sre_constants.AT:
+            width = max(width, 1)
+        elif op in _REPEATS:
+            width = max(width, _lookbehind(av[2]))
+        elif op == sre_constants.SUBPATTERN:
+            width = max(width, _lookbehind(av[-1]))
+        elif op == _ATOMIC_GROUP:
+            width = max(width, _lookbehind(av))
+        elif op == sre_constants.BRANCH:
+            width = max([width] + [_lookbehind(alternative) for alternative in av[1]])
+        elif op == sre_constants.GROUPREF_EXISTS:
+            width = max([width] + [_lookbehind(branch) for branch in av[1:] if branch is not None])
+    return width
+
+
+def _always(text, pos):
+    return True
+
+
+def _analyse_rule(regex):
+    """
+    Return `(probe, lookbehind)` for one lexer rule.
+
+    `probe` is None for line-local rules. For the others it matches the leading part of the rule that is confined
+    to the line: when that fails the whole rule fails without looking further, otherwise the attempt is recorded.
+    """
+    parsed = sre_parse.parse(regex.pattern, regex.flags)
+    flags = parsed.state.flags
+    lookbehind = _lookbehind(parsed)
+    if _line_local(parsed, flags):
+        return None, lookbehind
+    items = list(parsed)
+    head = 0
+    while head < len(items) and _newline_free(items[head:head + 1], flags):
+        head += 1
+    if not head:
+        return _always, lookbehind
+    return sre_compile.compile(sre_parse.SubPattern(parsed.state, items[:head]), regex.flags).match, lookbehind
+
+
+_plans = {}
+
+
+def lexer_plan(lexer):
+    """
+    Return `(rules, lookbehind)` for a lexer class, worked out once per process.
+
+    `rules` maps each state to a list of `(rexmatch, action, new_state, probe, index)`; `lookbehind` is the furthest
+    any rule looks back from where it starts.
+    """
+    cls = type(lexer)
+    if cls not in _plans:
+        rules, lookbehind = {}, 0
+        for state, statetokens in lexer._tokens.items():
+            rules[state] = []
+            for index, (rexmatch, action, new_state) in enumerate(statetokens):
+                probe, width = _analyse_rule(rexmatch.__self__)
+                lookbehind = max(lookbehind, width)
+                rules[state].append((rexmatch, action, new_state, probe, index))
+        _plans[cls] = (rules, lookbehind)
+    return _plans[cls]
+
+
+def lex(lexer, text, pos=0, line=0, stack=('root',), stop=None):
+    """
+    Lex `text` from `pos` exactly like `RegexLexer.get_tokens_unprocessed`, noting the state stack at line starts.
+
+    Returns `(tokens, checkpoints, probes, pos)`: the `(tokentype, value)` pairs, a list of `(line, stack)` for every
+    line start the lexer landed on (beginning with `(line, stack)` itself), the `(pos, state, rule)` attempts that may
+    have looked beyond their line, and where lexing ended. Lexing ends early at the first line start for which
+    `stop(line, stack, pos)` is true.
+    """
+    rules, _ = lexer_plan(lexer)
+    tokens = []
+    checkpoints = [(line, tuple(stack))]
+    probes = []
+    statestack = list(stack)
+    statetokens = rules[statestack[-1]]
+    while 1:
+        start = pos
+        for rexmatch, action, new_state, probe, index in statetokens:
+            if probe is not None and probe(text, pos):
+                probes.append((pos, statestack[-1], index))
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        tokens.append((action, m.group()))
+                    else:
+                        tokens.extend((ttype, value) for _, ttype, value in action(lexer, m))
+                pos = m.end()
+                if new_state is not None:
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == '#pop':
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        assert False, 'wrong state def: %r' % new_state
+                    statetokens = rules[statestack[-1]]
+                break
+        else:
+            try:
+                if text[pos] == '\n':
+                    statestack = ['root']
+                    statetokens = rules['root']
+                    tokens.append((Whitespace, '\n'))
+                else:
+                    tokens.append((Error, text[pos]))
+                pos += 1
+            except IndexError:
+                break
+        if pos > start:
+            line += text.count('\n', start, pos)
+            if text[pos - 1] == '\n':
+                state = tuple(statestack)
+                checkpoints.append((line, state))
+                if stop is not None and stop(line, state, pos):
+                    break
+    return tokens, checkpoints, probes, pos
+
+
+def format_lines(formatter, tokens):
+    """
+    Format tokens into a list of HTML lines, without their line separators.
+    """
+    cut = len(formatter.lineseparator)
+    return [line[:-cut] for _, line in HtmlFormatter._format_lines(formatter, tokens)]
+
+
+def wrap_lines(formatter, lines):
+    """
+    Return `(html, body_start, body_end)` for the full document around `lines` and where the lines sit in it.
+    """
+    out = StringIO()
+    formatter.format_lines(lines, out)
+    html = out.getvalue()
+    # everything after the code lines is the same whatever the lines are, so measure it on a one-line document
+    probe = StringIO()
+    formatter.format_lines(['\x00'], probe)
+    tail = len(probe.getvalue()) - probe.getvalue().rindex('\x00') - 1 - len(formatter.lineseparator)
+    body_end = len(html) - tail
+    body_start = body_end - sum(len(line) for line in lines) - len(formatter.lineseparator) * len(lines)
+    return html, body_start, body_end
+
+
+class HighlightState:
+    """
+    What we keep about a render to re-highlight it incrementally.
+
+    `marks[line]` indexes into `stacks` for every line start (`line` 0 up to and including the end of the text), or is
+    NO_CHECKPOINT. `probes` are the `(pos, state, rule)` attempts that may have looked past their line, and
+    `body_start` and `body_end` locate the code lines in the highlighted document.
+    """
+
+    def __init__(self, marks, stacks, probes, body_start, body_end):
+        self.marks = marks
+        self.stacks = stacks
+        self.probes = probes
+        self.body_start = body_start
+        self.body_end = body_end
+
+    @classmethod
+    def from_checkpoints(cls, checkpoints, nlines, probes, body_start, body_end):
+        marks = [NO_CHECKPOINT] * (nlines + 1)
+        stacks, ids = [], {}
+        for line, stack in checkpoints:
+            if stack not in ids:
+                ids[stack] = len(stacks)
+                stacks.append(stack)
+            marks[line] = ids[stack]
+        return cls(marks, stacks, probes, body_start, body_end)
+
+    def stack_at(self, line):
+        mark = self.marks[line]
+        return None if mark == NO_CHECKPOINT else self.stacks[mark]
+
+    def checkpoints(self, start=0, end=None):
+        end = len(self.marks) if end is None else end
+        return [(line, self.stacks[self.marks[line]]) for line in range(start, end)
+                if self.marks[line] != NO_CHECKPOINT]
+
+    def encode(self):
+        # store the marks run-length encoded; most lines start in the same state as the previous one
+        runs = []
+        for line, mark in enumerate(self.marks):
+            if not runs or runs[-1][1] != mark:
+                runs.append([line, mark])
+        names = sorted({state for _, state, _ in self.probes})
+        ids = {name: index for index, name in enumerate(names)}
+        data = {
+            'lines': len(self.marks) - 1,
+            'runs': runs,
+            'stacks': [list(stack) for stack in self.stacks],
+            'states': names,
+            'probes': [value for pos, state, rule in self.probes for value in (pos, ids[state], rule)],
+            'body': [self.body_start, self.body_end],
+        }
+        return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def decode(cls, blob):
+        data = json.loads(zlib.decompress(bytes(blob)).decode('utf-8'))
+        marks = []
+        runs = data['runs'] + [[data['lines'] + 1, None]]
+        for (line, mark), (next_line, _) in zip(runs, runs[1:]):
+            marks.extend([mark] * (next_line - line))
+        flat, names = data['probes'], data['states']
+        probes = [(flat[i], names[flat[i + 1]], flat[i + 2]) for i in range(0, len(flat), 3)]
+        return cls(marks, [tuple(stack) for stack in data['stacks']], probes, *data['body'])
+
+
+def render_full(lexer, formatter, text):
+    """
+    Highlight all of `text`, returning `(html, state, tokens)`.
+    """
+    tokens, checkpoints, probes, _ = lex(lexer, text)
+    lines = format_lines(formatter, tokens)
+    html, body_start, body_end = wrap_lines(formatter, lines)
+    return html, HighlightState.from_checkpoints(checkpoints, len(lines), probes, body_start, body_end), tokens
+
+
+def _same_outcome(rexmatch, old_text, text, pos):
+    old, new = rexmatch(old_text, pos), rexmatch(text, pos)
+    return (old and old.regs) == (new and new.regs)
+
+
+def render_incremental(lexer, formatter, old_text, old_html, state, text):
+    """
+    Re-highlight `text`, an edited `old_text`, reusing the lines of `old_html` that can't have changed.
+
+    `old_html` and `state` must come from rendering `old_text` with the same lexer and formatter options.
+    Returns `(html, state, edit)`, the document and state being identical to what `render_full` would give. `edit` is
+    `(start, end, tokens)`: the new tokens replace those that covered `old_text[start:end]`.
+    """
+    rules, lookbehind = lexer_plan(lexer)
+    old_lines = old_text.split('\n')
+    new_lines = text.split('\n')
+    old_count, new_count = len(old_lines) - 1, len(new_lines) - 1
+    offsets = [0]
+    for line in new_lines[:-1]:
+        offsets.append(offsets[-1] + len(line) + 1)
+
+    prefix = 0
+    shortest = min(old_count, new_count)
+    while prefix < shortest and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < shortest - prefix and old_lines[old_count - 1 - suffix] == new_lines[new_count - 1 - suffix]:
+        suffix += 1
+
+    # Restart at the last checkpoint before the first changed line; line 0 always has one. A checkpoint on the
+    # changed line itself won't do, as the token that ended there may have peeked at its first character.
+    start = max(prefix - 1, 0)
+    while state.marks[start] == NO_CHECKPOINT:
+        start -= 1
+    # then step back past any earlier attempt that sees the edit differently
+    kept = 0
+    for pos, name, index in state.probes:
+        if pos >= offsets[start]:
+            break
+        if not _same_outcome(rules[name][index][0], old_text, text, pos):
+            while offsets[start] > pos or state.marks[start] == NO_CHECKPOINT:
+                start -= 1
+            break
+        kept += 1
+    while kept and state.probes[kept - 1][0] >= offsets[start]:
+        kept -= 1
+
+    shift = old_count - new_count
+    resync = new_count - suffix
+
+    def stop(line, stack, pos):
+        # the rest of the text is unchanged, far enough in that no rule can look back into the edit
+        return (line >= resync and pos - offsets[resync] >= lookbehind
+                and state.stack_at(line + shift) == stack)
+
+    tokens, checkpoints, probes, end_pos = lex(lexer, text, offsets[start], start, state.stack_at(start), stop)
+    end, end_stack = checkpoints[-1]
+    if stop(end, end_stack, end_pos):
+        # back in step with the old render: keep its lines, checkpoints and probes from here on
+        checkpoints.pop()
+        reused = state.checkpoints(end + shift)
+        moved = len(text) - len(old_text)
+        probes += [(pos + moved, name, index) for pos, name, index in state.probes if pos + moved >= end_pos]
+    else:
+        end, reused = new_count, []
+    old_body = old_html[state.body_start:state.body_end].split(formatter.lineseparator)
+    lines = old_body[:start] + format_lines(formatter, tokens) + old_body[end + shift:old_count]
+    html, body_start, body_end = wrap_lines(formatter, lines)
+
+    checkpoints = state.checkpoints(0, start) + checkpoints + [(line - shift, stack) for line, stack in reused]
+    probes = state.probes[:kept] + probes
+    state = HighlightState.from_checkpoints(checkpoints, new_count, probes, body_start, body_end)
+    return html, state, (offsets[start], end_pos - len(text) + len(old_text), tokens)
@@ -0,0 +1,102 @@
+"""
+Line-offset index for a snippet's code and highlighted document.
+
+Clients showing part of a long snippet ask for `?lines=a-b`. The index stored with every render records where each
+line starts, both in `code` and in the code section of `highlighted`, so a range is sliced straight out of the stored
+text: two offsets are read from the index, without decoding the rest of it or scanning the text.
+
+Both tables number lines the way pygments does: `\r\n` and a lone `\r` end a line as `\n` does, and the blank lines
+a lexer strips from the start and end of the code, which have no lines in the document, get empty spans there. Line
+`n` of either table is then the same line of the snippet.
+
+Layout: the two line counts, then the `count + 1` line start offsets of the code and of the highlighted document, as
+little-endian 32-bit integers. The last offset of each table is where the last line ends.
+"""
+import re
+import struct
+import sys
+from array import array
+
+_HEADER = struct.Struct('<II')
+_OFFSET = struct.Struct('<I')
+# the array type holding unsigned 32-bit integers on this platform, to match _OFFSET
+_TYPECODE = next(typecode for typecode in 'IL' if array(typecode).itemsize == _OFFSET.size)
+_LINE_BREAK = re.compile('\r\n|\r|\n')
+
+
+def line_offsets(text, start=0, end=None):
+    """
+    Return the offsets at which the lines of `text[start:end]` start, followed by `end`.
+    """
+    end = len(text) if end is None else end
+    offsets = array(_TYPECODE, [start])
+    if text.find('\r', start, end) == -1:
+        pos = text.find('\n', start, end)
+        while pos != -1:
+            offsets.append(pos + 1)
+            pos = text.find('\n', pos + 1, end)
+    else:
+        offsets.extend(match.end() for match in _LINE_BREAK.finditer(text, start, end))
+    if offsets[-1] != end:
+        offsets.append(end)
+    return offsets
+
+
+def build_index(code, html, body_start, body_end, stripped_lines=0):
+    """
+    Build the index for `code` and `html`, the code lines of which sit in `html[body_start:body_end]`, the lexer
+    having stripped the first `stripped_lines` lines of `code`.
+    """
+    code_offsets = line_offsets(code)
+    html_offsets = array(_TYPECODE, [body_start] * stripped_lines) + line_offsets(html, body_start, body_end)
+    # and the blank lines it stripped at the end
+    html_offsets.extend([body_end] * (len(code_offsets) - len(html_offsets)))
+    if sys.byteorder == 'big':
+        code_offsets.byteswap()
+        html_offsets.byteswap()
+    header = _HEADER.pack(len(code_offsets) - 1, len(html_offsets) - 1)
+    return header + code_offsets.tobytes() + html_offsets.tobytes()
+
+
+class LineIndex:
+    """
+    Read access to a stored index. Line numbers are 1-based and ranges inclusive.
+    """
+
+    def __init__(self, blob):
+        self.blob = blob
+        self.code_lines, self.html_lines = _HEADER.unpack_from(blob)
+
+    def _offset(self, table_start, line):
+        return _OFFSET.unpack_from(self.blob, table_start + _OFFSET.size * line)[0]
+
+    def _span(self, table_start, total, first, last):
+        first = min(max(first, 1), total + 1)
+        last = min(total if last is None else last, total)
+        last = max(last, first - 1)
+        return self._offset(table_start, first - 1), self._offset(table_start, last), first, last
+
+    def code_span(self, first, last=None):
+        """
+        Return `(start, end, first, last)`: where lines `first` to `last` of the code are, with the range clamped to
+        the lines there are. A range past the end gives an empty span.
+        """
+        return self._span(_HEADER.size, self.code_lines, first, last)
+
+    def html_span(self, first, last=None):
+        """
+        Like `code_span`, for the lines of the highlighted document.
+        """
+        return self._span(_HEADER.size + _OFFSET.size * (self.code_lines + 1), self.html_lines, first, last)
+
+
+def parse_line_range(value):
+    """
+    Parse `a-b`, `a-` or `a` into `(first, last)`, `last` being None for an open range. Raises ValueError.
+    """
+    first, dash, last = value.partition('-')
+    first = int(first)
+    last = (int(last) if last else None) if dash else first
+    if first < 1 or (last is not None and last < first):
+        raise ValueError('Line ranges are 1-based and must not end before they start.')
+    return first, last
@@ -0,0 +1,83 @@
+"""
+Move the bodies of old, rarely viewed snippets out of the database into archive segments.
+
+    python manage.py archive_snippets
+    python manage.py archive_snippets --older-than-days 730 --max-views 0 --limit 100000
+
+See snippets/archive.py. Run `rehydrate_snippets` to bring them back.
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from snippets.archive import (
+    ARCHIVE_AFTER_DAYS, ARCHIVE_DIR, ARCHIVE_MAX_VIEWS, ARCHIVE_SEGMENT_BYTES, ARCHIVED_BLANKS, ARCHIVED_FIELDS,
+    ArchiveStore,
+)
+from snippets.models import Snippet
+
+
+class Command(BaseCommand):
+    help = 'Archive the code and renders of old, rarely viewed snippets into compressed segment files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--max-views', type=int, default=ARCHIVE_MAX_VIEWS,
+                            help='Leave snippets viewed more often than this in the database.')
+        parser.add_argument('--segment-bytes', type=int, default=ARCHIVE_SEGMENT_BYTES,
+                            help='Start a new segment once the current one is this big.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Snippets read and updated at a time.')
+        parser.add_argument('--limit', type=int, default=None, help='Archive at most this many snippets.')
+        parser.add_argument('--directory', default=ARCHIVE_DIR,
+                            help='Where the segments go; SNIPPETS_ARCHIVE_DIR must point there for reads.')
+
+    def seal(self, writer, pending, batch_size):
+        """
+        Make the segment durable, then point its snippets at it, returning how many were archived.
+        """
+        writer.close()
+        archived = 0
+        for start in range(0, len(pending), batch_size):
+            with transaction.atomic():
+                for pk, version in pending[start:start + batch_size]:
+                    # a snippet edited since it was read keeps its new body; its record is left unused
+                    archived += Snippet.objects.filter(pk=pk, version=version, archive_segment__isnull=True).update(
+                        archive_segment=writer.number, **ARCHIVED_BLANKS)
+        self.stdout.write('Segment %d: %d snippets, %.1f MiB.' % (writer.number, archived, writer.size / 1024 / 1024))
+        return archived
+
+    def handle(self, *args, **options):
+        if not options['directory']:
+            raise CommandError('Set SNIPPETS_ARCHIVE_DIR, or pass --directory, to archive snippets.')
+        store = ArchiveStore(options['directory'])
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        queryset = (Snippet.objects.filter(created__lt=cutoff, archive_segment__isnull=True, deleted=False)
+                    .filter(Q(views__isnull=True) | Q(views__count__lte=options['max_views']))
+                    .order_by('pk').only('pk', 'version', *ARCHIVED_FIELDS))
+        limit = options['limit']
+        writer, pending, archived, last = None, [], 0, 0
+        try:
+            while limit is None or archived + len(pending) < limit:
+                size = options['batch_size'] if limit is None else min(options['batch_size'],
+                                                                      limit - archived - len(pending))
+                snippets = list(queryset.filter(pk__gt=last)[:size])
+                if not snippets:
+                    break
+                for snippet in snippets:
+                    writer = writer or store.writer()
+                    writer.add(snippet.pk, {name: getattr(snippet, name) for name in ARCHIVED_FIELDS})
+                    pending.append((snippet.pk, snippet.version))
+                    if writer.size >= options['segment_bytes']:
+                        archived += self.seal(writer, pending, options['batch_size'])
+                        writer, pending = None, []
+                last = snippets[-1].pk
+            if writer is not None:
+                archived += self.seal(writer, pending, options['batch_size'])
+                writer = None
+        finally:
+            if writer is not None:
+                writer.discard()
+        self.stdout.write(self.style.SUCCESS('Archived %d snippets.' % archived))
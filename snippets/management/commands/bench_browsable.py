@@ -0,0 +1,72 @@
+"""
+Measure browsable API page render time with and without cached forms.
+
+    python manage.py bench_browsable
+    python manage.py bench_browsable --repeat 50
+
+Renders the HTML pages of `/snippets/` and `/snippets/<pk>/` for a logged in user, whose pages carry the POST and
+PUT forms, with DRF's BrowsableAPIRenderer and with CachedBrowsableAPIRenderer. The user and snippet it needs are
+created in a transaction that is rolled back at the end.
+"""
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from snippets.models import Snippet
+from snippets.renderers import CachedBrowsableAPIRenderer, form_cache
+from snippets.views import SnippetDetail, SnippetList
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compare browsable API render times of the stock renderer and the one caching its forms.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Pages rendered per measurement.')
+
+    def timed(self, repeat, func):
+        func()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        factory = APIRequestFactory()
+
+        def page(view_class, renderer, path, **kwargs):
+            view = view_class.as_view(renderer_classes=[JSONRenderer, renderer])
+
+            def render():
+                request = factory.get(path, HTTP_ACCEPT='text/html')
+                force_authenticate(request, user)
+                response = view(request, **kwargs)
+                response.render()
+                return len(response.content)
+            return render
+
+        self.stdout.write('%-16s %10s %12s %12s %8s' % ('page', 'size', 'stock', 'cached', 'speedup'))
+        try:
+            with transaction.atomic():
+                user = User.objects.create(username='bench-browsable-%d' % time.time())
+                snippet = Snippet.objects.create(owner=user, code='print("hello")\n' * 20)
+                for name, view_class, path, kwargs in (
+                        ('/snippets/', SnippetList, '/snippets/', {}),
+                        ('/snippets/<pk>/', SnippetDetail, '/snippets/%d/' % snippet.pk, {'pk': snippet.pk})):
+                    form_cache.clear()
+                    size = page(view_class, CachedBrowsableAPIRenderer, path, **kwargs)()
+                    stock = self.timed(repeat, page(view_class, BrowsableAPIRenderer, path, **kwargs))
+                    cached = self.timed(repeat, page(view_class, CachedBrowsableAPIRenderer, path, **kwargs))
+                    self.stdout.write('%-16s %9dB %10.2fms %10.2fms %7.1fx' % (
+                        name, size, stock, cached, stock / cached if cached else 0))
+                raise Rollback()
+        except Rollback:
+            pass
@@ -0,0 +1,53 @@
+"""
+Stress benchmark for the highlight sandbox, built from adversarial inputs.
+
+    python manage.py bench_highlight_sandbox
+    python manage.py bench_highlight_sandbox --scale 4 --in-process
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from snippets.highlighting import render_stored
+from snippets.sandbox import limit_hits, sandbox
+
+
+def adversarial_inputs(scale):
+    """
+    Yield `(name, language, code)` cases that are slow or large to highlight.
+    """
+    yield 'long single line', 'python', 'x = ' + 'a + ' * (50000 * scale) + '1\n'
+    yield 'many short lines', 'python', 'value = 1\n' * (50000 * scale)
+    yield 'deep nesting', 'scheme', '(' * (20000 * scale) + ')' * (20000 * scale)
+    yield 'unterminated string', 'javascript', '"' + '\\\\' * (100000 * scale)
+    yield 'backslash runs', 'bash', 'echo ' + '\\' * (100000 * scale) + '\n'
+    yield 'quote soup', 'sml', "'" * (20000 * scale) + '\n'
+    yield 'comment opener storm', 'c', '/*' * (50000 * scale) + '\n'
+    yield 'html tag storm', 'html', '<a ' * (30000 * scale) + '\n'
+    yield 'unicode wall', 'python', '# ' + '☃\U0001f600' * (50000 * scale) + '\n'
+
+
+class Command(BaseCommand):
+    help = 'Highlight adversarial inputs through the sandbox and report render times and fallbacks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=int, default=1, help='Multiply the size of every input.')
+        parser.add_argument('--in-process', action='store_true',
+                            help='Run without the sandbox, to compare against unguarded rendering.')
+
+    def handle(self, *args, **options):
+        sandbox.enabled = not options['in_process']
+        self.stdout.write('%-22s %-11s %10s %9s  %s' % ('case', 'language', 'bytes', 'seconds', 'result'))
+        total = 0.0
+        for name, language, code in adversarial_inputs(options['scale']):
+            hits = sum(limit_hits.values())
+            start = time.perf_counter()
+            html = render_stored(code, language, 'friendly', False)[0]
+            elapsed = time.perf_counter() - start
+            total += elapsed
+            result = 'fallback' if sum(limit_hits.values()) > hits else 'highlighted (%d chars)' % len(html)
+            self.stdout.write('%-22s %-11s %10d %9.3f  %s' % (name, language, len(code), elapsed, result))
+        self.stdout.write('total %.3fs' % total)
+        for (language, bucket), count in sorted(limit_hits.items()):
+            self.stdout.write('limit hit: %s %s x%d' % (language, bucket, count))
+        sandbox.shutdown()
@@ -0,0 +1,78 @@
+"""
+Measure the per-request cost of the middleware with Django's stock list and with the API profile.
+
+    python manage.py bench_middleware
+    python manage.py bench_middleware --repeat 500
+
+Sends the same requests through the whole handler (URL routing, middleware, view, rendering) with MIDDLEWARE as
+configured and with the Api* middleware swapped back for the Django classes they extend, reporting the time and the
+queries per request. The user and snippet it needs are created in a transaction that is rolled back at the end.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.module_loading import import_string
+
+from snippets.models import Snippet
+
+
+class Rollback(Exception):
+    pass
+
+
+def stock_middleware(middleware):
+    """
+    `middleware` with each snippets.middleware class replaced by the Django middleware it extends.
+    """
+    stock = []
+    for path in middleware:
+        if path.startswith('snippets.middleware.'):
+            base = import_string(path).__mro__[2]
+            path = '%s.%s' % (base.__module__, base.__name__)
+        stock.append(path)
+    return stock
+
+
+class Command(BaseCommand):
+    help = 'Compare per-request time and queries of the stock middleware and the API profile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=500, help='Requests timed per measurement.')
+
+    def measure(self, repeat, middleware, request):
+        with override_settings(MIDDLEWARE=middleware):
+            client = Client()
+            request(client)
+            with CaptureQueriesContext(connection) as queries:
+                request(client)
+            # read before the next request resets the query log
+            count = len(queries)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                request(client)
+            return (time.perf_counter() - start) / repeat * 1000, count
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        profiles = (stock_middleware(settings.MIDDLEWARE), settings.MIDDLEWARE)
+        self.stdout.write('%-38s %20s %20s' % ('request', 'stock', 'api profile'))
+        try:
+            with transaction.atomic():
+                user = User.objects.create(username='bench-middleware-%d' % time.time())
+                Snippet.objects.create(owner=user, code='print("hello")\n')
+                cookie = '%s=%s' % (settings.SESSION_COOKIE_NAME, 'x' * 32)
+                for name, request in (
+                        ('GET /, anonymous', lambda client: client.get('/')),
+                        ('GET /snippets/, anonymous', lambda client: client.get('/snippets/')),
+                        # a client with a session cookie may be logged in, so its session is read either way
+                        ('GET /snippets/, session cookie', lambda client: client.get('/snippets/', HTTP_COOKIE=cookie))):
+                    self.stdout.write('%-38s %20s %20s' % (name, *(
+                        '%.3fms, %d queries' % self.measure(repeat, middleware, request) for middleware in profiles)))
+                raise Rollback()
+        except Rollback:
+            pass
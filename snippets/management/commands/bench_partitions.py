@@ -0,0 +1,95 @@
+"""
+Measure snippet list latency as the table grows.
+
+    python manage.py bench_partitions
+    python manage.py bench_partitions --sizes 10000,100000,1000000 --months 36
+
+Grows the snippets table to each size in turn with rows spread over the last `--months` months, and times the first
+page of `/snippets/`, its last page (the newest snippets) and a query for the last week's snippets. Run it before and
+after migrating to the partitioned table to compare. Everything is written in one transaction that is rolled back at
+the end.
+"""
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.utils import timezone
+from rest_framework.settings import api_settings
+
+from snippets.models import Snippet
+from snippets.partitions import is_partitioned, list_partitions
+from snippets.views import SnippetList
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Time the snippet list against table size; run before and after partitioning to compare.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,50000', help='Comma separated table sizes to time at.')
+        parser.add_argument('--months', type=int, default=24, help='Months of history to spread the rows over.')
+        parser.add_argument('--repeat', type=int, default=20, help='Requests timed per measurement.')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows per bulk insert.')
+
+    def timed(self, repeat, func):
+        func()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    def grow(self, owner, count, months, batch_size):
+        # bulk_create stamps every row with the current time, so spread them over the months afterwards
+        now = timezone.now()
+        for start in range(0, count, batch_size):
+            rows = Snippet.objects.bulk_create(
+                [Snippet(owner=owner, code='x = %d\n' % n, highlighted='<pre>x</pre>')
+                 for n in range(start, min(start + batch_size, count))])
+            for month in range(months):
+                pks = [row.pk for row in rows[month::months]]
+                if pks:
+                    Snippet.objects.filter(pk__in=pks).update(created=now - timedelta(days=30 * month + 1))
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        repeat = options['repeat']
+        factory = RequestFactory()
+        view = SnippetList.as_view()
+
+        def list_page(page):
+            response = view(factory.get('/snippets/', {'page': page}))
+            response.render()
+
+        partitions = len(list_partitions(connection)) if is_partitioned(connection) else 0
+        self.stdout.write('%s, %s' % (connection.vendor, '%d partitions' % partitions if partitions else 'plain table'))
+        self.stdout.write('%10s %12s %12s %12s' % ('rows', 'first page', 'last page', 'last week'))
+        try:
+            with transaction.atomic():
+                owner = User.objects.create(username='bench-partitions-%d' % time.time())
+                rows = Snippet.objects.count()
+                for size in sizes:
+                    if size > rows:
+                        self.grow(owner, size - rows, options['months'], options['batch_size'])
+                        rows = size
+                    if connection.vendor == 'postgresql':
+                        with connection.cursor() as cursor:
+                            cursor.execute('ANALYZE snippets_snippet')
+                    page_size = api_settings.PAGE_SIZE
+                    last_page = max(1, (Snippet.objects.live().count() + page_size - 1) // page_size)
+                    since = timezone.now() - timedelta(days=7)
+                    self.stdout.write('%10d %10.2fms %10.2fms %10.2fms' % (
+                        rows,
+                        self.timed(repeat, lambda: list_page(1)),
+                        self.timed(repeat, lambda: list_page(last_page)),
+                        self.timed(repeat, lambda: list(Snippet.objects.filter(created__gte=since)
+                                                        .order_by('-created').values_list('pk', flat=True)[:10])),
+                    ))
+                raise Rollback()
+        except Rollback:
+            pass
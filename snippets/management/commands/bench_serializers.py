@@ -0,0 +1,72 @@
+"""
+Measure serializer construction and OPTIONS responses with and without the per-process caches.
+
+    python manage.py bench_serializers
+    python manage.py bench_serializers --repeat 500
+
+Times building a SnippetSerializer and serializing one snippet with it, with the fields built from scratch (as DRF
+does) and copied from CachedFieldsMixin's templates, and `OPTIONS /snippets/` with SimpleMetadata and CachedMetadata.
+The snippet is created in a transaction that is rolled back at the end.
+"""
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.metadata import SimpleMetadata
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from snippets.metadata import CachedMetadata
+from snippets.models import Snippet
+from snippets.serializers import SnippetSerializer
+from snippets.views import SnippetList
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compare serializer instantiation and OPTIONS /snippets/ with and without cached fields and metadata.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200, help='Operations timed per measurement.')
+
+    def timed(self, repeat, func):
+        func()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        factory = APIRequestFactory()
+        uncached = type('Uncached' + SnippetSerializer.__name__, (SnippetSerializer,), {'cache_fields': False})
+
+        def options_request(metadata_class):
+            view = SnippetList.as_view(metadata_class=metadata_class)
+
+            def run():
+                request = factory.options('/snippets/')
+                force_authenticate(request, user)
+                view(request).render()
+            return run
+
+        self.stdout.write('%-28s %12s %12s %8s' % ('operation', 'stock', 'cached', 'speedup'))
+        try:
+            with transaction.atomic():
+                user = User.objects.create(username='bench-serializers-%d' % time.time())
+                snippet = Snippet.objects.create(owner=user, code='print("hello")\n')
+                context = {'request': factory.get('/snippets/')}
+                for name, stock, cached in (
+                        ('SnippetSerializer().fields', lambda: uncached().fields, lambda: SnippetSerializer().fields),
+                        ('serialize one snippet', lambda: uncached(snippet, context=context).data,
+                         lambda: SnippetSerializer(snippet, context=context).data),
+                        ('OPTIONS /snippets/', options_request(SimpleMetadata), options_request(CachedMetadata))):
+                    stock, cached = self.timed(repeat, stock), self.timed(repeat, cached)
+                    self.stdout.write('%-28s %10.3fms %10.3fms %7.1fx' % (
+                        name, stock, cached, stock / cached if cached else 0))
+                raise Rollback()
+        except Rollback:
+            pass
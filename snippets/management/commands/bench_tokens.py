@@ -0,0 +1,61 @@
+"""
+Benchmark rendering from the stored token stream against a full pygments `highlight()`.
+
+    python manage.py bench_tokens
+    python manage.py bench_tokens --repeat 20 --styles 5
+"""
+import inspect
+import time
+
+from django.core.management.base import BaseCommand
+from pygments import highlight
+from pygments.lexers import get_lexer_by_name
+
+from snippets.highlighting import get_output_formatter, render_tokens, render_with_state
+from snippets.models import STYLE_CHOICES
+
+
+def sample_inputs():
+    """
+    Yield `(name, language, code)` cases of realistic code in a few sizes.
+    """
+    import argparse
+    import json.decoder
+    source = inspect.getsource(argparse)
+    yield 'python, 2KB', 'python', source[:2000]
+    yield 'python, 100KB', 'python', source
+    yield 'python, json.decoder', 'python', inspect.getsource(json.decoder)
+    yield 'javascript, 20KB', 'javascript', 'function add(a, b) {\n  // sum\n  return a + b; /* done */\n}\n' * 300
+    yield 'html, 20KB', 'html', '<div class="x"><script>var a = 1;</script><p>Hello &amp; bye</p></div>\n' * 280
+
+
+class Command(BaseCommand):
+    help = 'Compare formatting stored tokens with highlighting from scratch, for HTML and ANSI output.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='Renders timed per case and style.')
+        parser.add_argument('--styles', type=int, default=3, help='How many of STYLE_CHOICES to render each case in.')
+
+    def timed(self, repeat, func):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        styles = [style for style, _ in STYLE_CHOICES][:options['styles']]
+        self.stdout.write('%-22s %-5s %8s %9s %11s %11s %8s' % (
+            'case', 'out', 'code', 'tokens', 'highlight', 'from tokens', 'speedup'))
+        for name, language, code in sample_inputs():
+            tokens = render_with_state(code, language, 'default', False).tokens
+            lexer = get_lexer_by_name(language)
+            for output in ('html', 'ansi'):
+                full = stored = 0.0
+                for style in styles:
+                    formatter = get_output_formatter(output, style, False)
+                    full += self.timed(repeat, lambda: highlight(code, lexer, formatter))
+                    stored += self.timed(repeat, lambda: render_tokens(tokens, code, style, False, output=output))
+                full, stored = full / len(styles), stored / len(styles)
+                self.stdout.write('%-22s %-5s %7dB %8dB %9.2fms %9.2fms %7.1fx' % (
+                    name, output, len(code.encode('utf-8')), len(tokens), full, stored, full / stored))
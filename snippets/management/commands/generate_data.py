@@ -0,0 +1,163 @@
+"""
+Fill the database with synthetic users and snippets, to try things out at production size.
+
+    python manage.py generate_data --users 10000 --snippets 1000000
+    python manage.py generate_data --snippets 50000 --workers 8 --seed 2
+
+Snippets are spread over the users unevenly (a few own many, most own a handful), their languages follow a
+long-tailed popularity over LANGUAGE_CHOICES and their sizes a log-normal distribution around a kilobyte or so, up to
+`--max-bytes`. Worker processes write and highlight the snippets a batch at a time, exactly as `Snippet.save()` would
+render them, and this process inserts each batch as it comes back with `bulk_create`. The stats tables are rebuilt at
+the end, since bulk inserts bypass them. The same `--seed` gives the same snippets.
+"""
+import math
+import multiprocessing
+import os
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from snippets.compression import compress_variants
+from snippets.highlighting import render_stored
+from snippets.models import LANGUAGE_CHOICES, STYLE_CHOICES, Snippet
+from snippets.sandbox import sandbox
+from snippets.stats import rebuild_stats
+
+# share of snippets in the most used languages; the rest is spread evenly over every other lexer
+POPULAR_LANGUAGES = {
+    'python': 0.22, 'javascript': 0.14, 'bash': 0.07, 'java': 0.06, 'html': 0.06, 'sql': 0.05, 'c': 0.04,
+    'cpp': 0.04, 'json': 0.04, 'go': 0.03, 'rust': 0.03, 'ruby': 0.02, 'php': 0.02, 'css': 0.02, 'yaml': 0.02,
+}
+# lines a snippet in that language is made of; other languages get C-like lines
+SAMPLE_LINES = {
+    'python': ['def {name}(items, limit={n}):', '    """Return the first items over the limit."""',
+               '    return [item for item in items if item > limit]', 'class {Name}(object):',
+               '    {name} = {{"key": {n}, "other": [1, 2, 3]}}  # a comment', 'import os.path as {name}', ''],
+    'javascript': ['function {name}(items, limit = {n}) {{', '  return items.filter((item) => item > limit);', '}}',
+                   'const {name} = {{ key: {n}, other: [1, 2, 3] }}; // a comment', "import {Name} from './{name}';"],
+    'bash': ['for {name} in $(seq 1 {n}); do', '  echo "${name}" | grep -v "^#" >> /tmp/{name}.log', 'done',
+             'export {Name}=$HOME/{name}  # a comment'],
+    'html': ['<div class="{name}">', '  <p id="{name}-{n}">Some <em>text</em> &amp; more</p>', '</div>',
+             '<script>var {name} = {n};</script>'],
+    'sql': ['SELECT {name}.id, COUNT(*) AS total FROM {name}', 'WHERE {name}.value > {n} -- a comment',
+            'GROUP BY {name}.id ORDER BY total DESC;'],
+    'json': ['{{"{name}": {n}, "items": [1, 2, 3], "nested": {{"flag": true, "value": null}}}}'],
+    'yaml': ['{name}:', '  limit: {n}', '  items: [1, 2, 3]  # a comment', '  enabled: true'],
+    'css': ['.{name} > p {{', '  margin: {n}px 0; color: #{n:03d};', '}}'],
+}
+C_LINES = ['int {name}(int *items, int count) {{', '    for (int i = 0; i < count; i++) {{',
+           '        if (items[i] > {n}) return items[i]; /* a comment */', '    }}', '    return -1;', '}}']
+WORDS = ['alpha', 'total', 'buffer', 'parse', 'render', 'value', 'node', 'index', 'queue', 'client', 'token', 'cache']
+
+
+def language_weights():
+    languages = [language for language, _ in LANGUAGE_CHOICES]
+    rest = (1 - sum(POPULAR_LANGUAGES.values())) / max(1, len(languages) - len(POPULAR_LANGUAGES))
+    return languages, [POPULAR_LANGUAGES.get(language, rest) for language in languages]
+
+
+def make_code(rng, language, size):
+    lines = SAMPLE_LINES.get(language, C_LINES)
+    code, length = [], 0
+    while length < size:
+        name = rng.choice(WORDS) + str(rng.randrange(100))
+        line = rng.choice(lines).format(name=name, Name=name.capitalize(), n=rng.randrange(1000))
+        code.append(line)
+        length += len(line) + 1
+    return '\n'.join(code) + '\n'
+
+
+_worker = {}
+
+
+def start_worker(owners, options):
+    # render inline, as this process is already one of a pool. Workers never touch the database: only the parent
+    # inserts, so the connection they inherit goes unused.
+    sandbox.enabled = False
+    _worker['owners'] = owners
+    _worker['options'] = options
+    _worker['owner_weights'] = list(_cumulative(1 / (rank + 1) ** 0.8 for rank in range(len(owners))))
+    _worker['languages'] = language_weights()
+
+
+def _cumulative(weights):
+    total = 0.0
+    for weight in weights:
+        total += weight
+        yield total
+
+
+def make_batch(batch):
+    """
+    Return the field values of the snippets in `batch`, highlighted and compressed.
+    """
+    number, count = batch
+    options = _worker['options']
+    rng = random.Random('%s-%d' % (options['seed'], number))
+    languages, weights = _worker['languages']
+    styles = [style for style, _ in STYLE_CHOICES]
+    rows = []
+    for _ in range(count):
+        language = rng.choices(languages, weights)[0]
+        size = min(options['max_bytes'], int(rng.lognormvariate(math.log(options['median_bytes']), 1.1)) + 1)
+        code = make_code(rng, language, size)
+        style = 'friendly' if rng.random() < 0.8 else rng.choice(styles)
+        linenos = rng.random() < 0.2
+        title = '%s %s' % (rng.choice(WORDS), rng.choice(WORDS)) if rng.random() < 0.6 else ''
+        html, state, tokens, lines = render_stored(code, language, style, linenos, title)
+        variants = compress_variants(html)
+        rows.append({
+            'owner_id': rng.choices(_worker['owners'], cum_weights=_worker['owner_weights'])[0],
+            'title': title, 'code': code, 'linenos': linenos, 'language': language, 'style': style,
+            'highlighted': html, 'highlight_state': state, 'tokens': tokens, 'line_index': lines,
+            'highlighted_gzip': variants.get('gzip', b''), 'highlighted_br': variants.get('br', b''), 'version': 1,
+        })
+    return rows
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic users and highlighted snippets with realistic sizes and languages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Users to create.')
+        parser.add_argument('--snippets', type=int, default=10000, help='Snippets to create.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes highlighting snippets.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Snippets per batch and per insert.')
+        parser.add_argument('--median-bytes', type=int, default=800, help='Median snippet size.')
+        parser.add_argument('--max-bytes', type=int, default=64 * 1024, help='Largest snippet size.')
+        parser.add_argument('--seed', default='0', help='Seed for the random choices.')
+        parser.add_argument('--prefix', default='synthetic', help='Prefix of the usernames.')
+
+    def create_users(self, count, prefix):
+        start = User.objects.filter(username__startswith=prefix + '-').count()
+        password = make_password(None)
+        User.objects.bulk_create([User(username='%s-%d' % (prefix, start + n), password=password)
+                                  for n in range(count)])
+        return list(User.objects.filter(username__startswith=prefix + '-').order_by('?')
+                    .values_list('pk', flat=True))
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        owners = self.create_users(options['users'], options['prefix'])
+        if not owners:
+            self.stderr.write('No users to own the snippets.')
+            return
+        self.stdout.write('%d users with the prefix %r.' % (len(owners), options['prefix']))
+        batch_size = options['batch_size']
+        batches = [(number, min(batch_size, options['snippets'] - start))
+                   for number, start in enumerate(range(0, options['snippets'], batch_size))]
+        worker_options = {name: options[name] for name in ('seed', 'median_bytes', 'max_bytes')}
+        created = 0
+        with multiprocessing.Pool(max(1, options['workers']), start_worker, (owners, worker_options)) as pool:
+            for rows in pool.imap_unordered(make_batch, batches):
+                Snippet.objects.bulk_create([Snippet(**row) for row in rows])
+                created += len(rows)
+                self.stdout.write('\r%d/%d snippets' % (created, options['snippets']), ending='')
+                self.stdout.flush()
+        self.stdout.write('')
+        rebuild_stats()
+        elapsed = time.perf_counter() - started
+        self.stdout.write('Created %d snippets in %.1fs (%.0f a second).' % (created, elapsed, created / elapsed))
@@ -0,0 +1,252 @@
+"""
+Replay a mix of API reads and writes against a running server and report latency percentiles and throughput.
+
+    python manage.py runserver --noreload &   # or gunicorn mainAPI.wsgi, as deployed
+    python manage.py loadtest --duration 30 --concurrency 8
+    python manage.py loadtest --requests 5000 --mix detail=60,highlight=30,create=10 --username alice --password ...
+
+Each of `--concurrency` threads keeps one HTTP/1.1 connection open and sends requests back to back, picking each
+operation at random in the proportions of `--mix`, over the routes in snippets/urls.py:
+
+    list       GET /snippets/?page=N          popular    GET /snippets/popular/
+    detail     GET /snippets/<pk>/            stats      GET /snippets/stats/
+    highlight  GET /snippets/<pk>/highlight/  users      GET /users/<pk>/
+    raw        GET /snippets/<pk>/raw         user-stats GET /users/<pk>/stats/
+    create     POST /snippets/                update     PATCH /snippets/<pk>/ (one this run created)
+
+Snippets and users are sampled from this project's database, which must be the one the server uses: fill it with
+`manage.py generate_data` first. Four reads in five go to the first fifth of the sample, so some snippets are hot and
+others cold. Writes need `--username` and `--password` for basic authentication and are left out without them; the
+snippets they create are not cleaned up. Responses other than 2xx, and connection failures, count as errors.
+"""
+import base64
+import http.client
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from snippets.models import Snippet
+
+DEFAULT_MIX = 'list=25,detail=30,highlight=20,raw=5,popular=5,stats=3,users=3,user-stats=3,create=4,update=2'
+WRITES = ('create', 'update')
+SAMPLE_SIZE = 10000
+PERCENTILES = (50, 95, 99)
+
+
+def parse_mix(mix):
+    """
+    Turn `name=weight,...` into `{name: weight}`, rejecting unknown operations.
+    """
+    weights = {}
+    for part in filter(None, mix.split(',')):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in Worker.operations:
+            raise CommandError('Unknown operation %r, expected one of %s.' % (name, ', '.join(Worker.operations)))
+        try:
+            weights[name] = float(weight or 1)
+        except ValueError:
+            raise CommandError('Bad weight for %s: %r.' % (name, weight))
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+def percentile(ordered, percent):
+    """
+    The nearest-rank `percent`th percentile of the sorted list `ordered`.
+    """
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+class Worker(threading.Thread):
+    """
+    Sends requests over one connection until the run is over, recording `(operation, seconds, ok)` for each.
+    """
+
+    operations = ('list', 'detail', 'highlight', 'raw', 'popular', 'stats', 'users', 'user-stats', 'create',
+                  'update')
+
+    def __init__(self, run, seed):
+        super(Worker, self).__init__(daemon=True)
+        self.run_state = run
+        self.random = random.Random(seed)
+        self.results = []
+        self.created = []
+        self.connection = None
+
+    def pick(self, ids):
+        hot = ids[:max(1, len(ids) // 5)]
+        return self.random.choice(hot if self.random.random() < 0.8 else ids)
+
+    def request(self, method, path, body=None, headers=()):
+        run = self.run_state
+        headers = dict(run.headers, **dict(headers))
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        if self.connection is None:
+            self.connection = run.connection_class(run.host, run.port, timeout=run.timeout)
+        try:
+            self.connection.request(method, run.prefix + path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return None, None
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+            self.connection = None
+        return response.status, data
+
+    def send(self, operation):
+        """
+        Perform one `operation`, returning whether it succeeded.
+        """
+        run = self.run_state
+        if operation == 'list':
+            status, _ = self.request('GET', '/snippets/?page=%d' % self.random.randint(1, run.pages))
+        elif operation in ('detail', 'highlight', 'raw'):
+            suffix = {'detail': '/', 'highlight': '/highlight/', 'raw': '/raw'}[operation]
+            status, _ = self.request('GET', '/snippets/%d%s' % (self.pick(run.snippets), suffix))
+        elif operation == 'popular':
+            status, _ = self.request('GET', '/snippets/popular/')
+        elif operation == 'stats':
+            status, _ = self.request('GET', '/snippets/stats/')
+        elif operation in ('users', 'user-stats'):
+            suffix = '/' if operation == 'users' else '/stats/'
+            status, _ = self.request('GET', '/users/%d%s' % (self.pick(run.users), suffix))
+        elif operation == 'update' and self.created:
+            code = self.random.choice(run.sample_code) + '# edited %d\n' % self.random.randrange(1000)
+            status, _ = self.request('PATCH', '/snippets/%d/' % self.random.choice(self.created), {'code': code},
+                                     run.write_headers)
+        else:
+            # creating, or updating before this thread has created anything
+            status, data = self.request('POST', '/snippets/', {
+                'code': self.random.choice(run.sample_code), 'language': 'python', 'title': 'load test',
+            }, run.write_headers)
+            if status == 201:
+                self.created.append(json.loads(data.decode('utf-8'))['id'])
+        return status is not None and 200 <= status < 300
+
+    def run(self):
+        run = self.run_state
+        while run.take():
+            operation = self.random.choices(run.names, run.weights)[0]
+            start = time.perf_counter()
+            ok = self.send(operation)
+            self.results.append((operation, time.perf_counter() - start, ok))
+        if self.connection is not None:
+            self.connection.close()
+
+
+class Run:
+    """
+    What the workers share: where to send requests, what to ask for, and when to stop.
+    """
+
+    def __init__(self, base_url, mix, snippets, users, pages, sample_code, credentials, duration, requests, timeout):
+        url = urlsplit(base_url)
+        if url.scheme not in ('http', 'https'):
+            raise CommandError('The base URL must be http or https: %r.' % base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host, self.port, self.prefix = url.hostname, url.port, url.path.rstrip('/')
+        self.names, self.weights = list(mix), list(mix.values())
+        self.snippets, self.users, self.pages, self.sample_code = snippets, users, pages, sample_code
+        # JSON from the API views (it is the first renderer), HTML from the highlight
+        self.headers = {'Accept': '*/*', 'Host': url.netloc}
+        self.write_headers = ()
+        if credentials:
+            token = base64.b64encode(('%s:%s' % credentials).encode('utf-8')).decode('ascii')
+            self.write_headers = (('Authorization', 'Basic ' + token),)
+        self.timeout = timeout
+        self.deadline = time.monotonic() + duration if duration else None
+        self.remaining = requests
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Whether a worker may send another request.
+        """
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return False
+        if self.remaining is None:
+            return True
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class Command(BaseCommand):
+    help = 'Replay a read/write mix against a running server and report p50/p95/p99 latency and throughput.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help='Where the API is served.')
+        parser.add_argument('--concurrency', type=int, default=4, help='Connections sending requests at once.')
+        parser.add_argument('--duration', type=float, default=None, help='Seconds to run for (default 30).')
+        parser.add_argument('--requests', type=int, default=None, help='Requests to send, instead of a duration.')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help='Relative weights of the operations.')
+        parser.add_argument('--username', help='User to create and update snippets as.')
+        parser.add_argument('--password', help='Password of --username.')
+        parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for a response.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the random choices.')
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options['mix'])
+        credentials = None
+        if options['username'] and options['password']:
+            credentials = (options['username'], options['password'])
+        elif any(name in mix for name in WRITES):
+            self.stderr.write('No --username and --password, leaving out %s.' % ', '.join(WRITES))
+            mix = {name: weight for name, weight in mix.items() if name not in WRITES}
+        if not mix:
+            raise CommandError('Nothing to send.')
+        snippets = list(Snippet.objects.live().order_by('?').values_list('pk', flat=True)[:SAMPLE_SIZE])
+        users = list(User.objects.order_by('?').values_list('pk', flat=True)[:SAMPLE_SIZE])
+        if not snippets or not users:
+            raise CommandError('No snippets or users to request: run generate_data first.')
+        pages = max(1, -(-Snippet.objects.live().count() // 10))
+        sample_code = list(Snippet.objects.filter(language='python').values_list('code', flat=True)
+                           [:50]) or ['print("hello, world")\n']
+        duration = options['duration']
+        if duration is None and options['requests'] is None:
+            duration = 30.0
+        run = Run(options['base_url'], mix, snippets, users, pages, sample_code, credentials, duration,
+                  options['requests'], options['timeout'])
+        workers = [Worker(run, options['seed'] * 1000 + number) for number in range(max(1, options['concurrency']))]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        self.report([result for worker in workers for result in worker.results], elapsed)
+
+    def report(self, results, elapsed):
+        by_operation = defaultdict(list)
+        errors = defaultdict(int)
+        for operation, seconds, ok in results:
+            by_operation[operation].append(seconds)
+            by_operation['total'].append(seconds)
+            if not ok:
+                errors[operation] += 1
+                errors['total'] += 1
+        self.stdout.write('%-12s %9s %7s %9s %9s %9s %9s' % (
+            'operation', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+        for operation in sorted(by_operation, key=lambda name: (name == 'total', name)):
+            ordered = sorted(by_operation[operation])
+            self.stdout.write('%-12s %9d %7d %9.1f %9.1f %9.1f %9.1f' % (
+                (operation, len(ordered), errors[operation]) +
+                tuple(percentile(ordered, percent) * 1000 for percent in PERCENTILES) +
+                (len(ordered) / elapsed,)))
+        self.stdout.write('%d requests in %.1fs.' % (len(results), elapsed))
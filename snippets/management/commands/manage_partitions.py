@@ -0,0 +1,42 @@
+"""
+Keep the monthly partitions of the snippets table in shape. Run it daily, e.g. from cron.
+
+    python manage.py manage_partitions
+    python manage.py manage_partitions --ahead 6 --retain 24
+    python manage.py manage_partitions --dry-run
+
+See snippets/partitions.py.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from snippets.partitions import PARTITIONS_AHEAD, PARTITIONS_RETAIN, is_partitioned, list_partitions, \
+    maintain_partitions
+
+
+class Command(BaseCommand):
+    help = 'Create the monthly snippet partitions ahead of time and detach the ones past retention.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=PARTITIONS_AHEAD,
+                            help='Months after the current one to have partitions for.')
+        parser.add_argument('--retain', type=int, default=PARTITIONS_RETAIN,
+                            help='Detach partitions wholly older than this many months, counting the current one.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be done.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if not is_partitioned(connection):
+            raise CommandError('The snippets table is not partitioned; that needs PostgreSQL and migration 0010.')
+        if options['retain'] is not None and options['retain'] < 1:
+            raise CommandError('--retain must keep at least the current month.')
+        with transaction.atomic(using=options['database']):
+            created, detached = maintain_partitions(connection, ahead=options['ahead'], retain=options['retain'],
+                                                    dry_run=options['dry_run'])
+        prefix = 'Would have ' if options['dry_run'] else ''
+        for name in created:
+            self.stdout.write('%screated %s' % (prefix, name))
+        for name in detached:
+            self.stdout.write('%sdetached %s' % (prefix, name))
+        self.stdout.write('%d partitions attached.' % len(list_partitions(connection)))
@@ -0,0 +1,111 @@
+"""
+Show how much of each worker's memory is shared with the others and how much is its own.
+
+    python manage.py memory_report --parent $(cat /run/gunicorn.pid)   # the workers of a running server
+    python manage.py memory_report 4242 4243
+    python manage.py memory_report --fork 4                             # forks warmed up by snippets/warmup.py
+    python manage.py memory_report --fork 4 --cold                      # and without, to compare
+
+For each process it reports its resident memory, the part of it shared with other processes (in a forked worker,
+the pages nobody has written to since the fork), the private part, and the proportional set size that shares out the
+shared pages between the processes mapping them. The private column is what each extra worker costs.
+
+With `--fork`, this command stands in for a server: it warms up as mainAPI/wsgi.py would (unless `--cold`), forks
+that many children which each go through what a worker does on its first requests (the warm-up steps, which are
+quick when already done, and on-demand renders of the warm lexers in a few styles), and reports them. Linux only.
+"""
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from snippets.highlighting import render_html
+from snippets.warmup import WARM_LEXERS, WARM_SAMPLE, child_pids, process_memory, warm_up
+
+MIB = 1024 * 1024
+WORKLOAD_STYLES = ('friendly', 'monokai', 'default')
+
+
+def first_requests():
+    warm_up(freeze=False)
+    for language in WARM_LEXERS:
+        for style in WORKLOAD_STYLES:
+            render_html(WARM_SAMPLE * 20, language, style, False)
+
+
+class Command(BaseCommand):
+    help = 'Report the shared and private memory of server workers, or of warm or cold forks of this process.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pids', nargs='*', type=int, help='Processes to report.')
+        parser.add_argument('--parent', type=int, help='Report the children of this process, e.g. a server master.')
+        parser.add_argument('--fork', type=int, default=0, help='Fork this many workers and report them.')
+        parser.add_argument('--cold', action='store_true', help='With --fork, fork without warming up first.')
+
+    def handle(self, *args, **options):
+        if not os.path.exists('/proc/self/smaps'):
+            raise CommandError('Memory reports need Linux /proc.')
+        if options['fork']:
+            self.report_forks(options['fork'], options['cold'])
+            return
+        pids = list(options['pids'])
+        if options['parent']:
+            pids = [options['parent']] + child_pids(options['parent']) + pids
+        if not pids:
+            raise CommandError('Give process ids, --parent or --fork.')
+        self.report(pids)
+
+    def report_forks(self, count, cold):
+        if not cold:
+            timings = warm_up()
+            self.stdout.write('Warmed up in %.0fms (%s).\n' % (sum(timings.values()) * 1000, ', '.join(
+                '%s %.0fms' % (name, seconds * 1000) for name, seconds in timings.items())))
+        children = []
+        try:
+            for _ in range(count):
+                ready_read, ready_write = os.pipe()
+                done_read, done_write = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    # the child: do a worker's first requests, then hold still until measured. Only the parent may
+                    # keep write ends of the `done` pipes open, or closing them would not release the children.
+                    status = 1
+                    try:
+                        for _, other_read, other_write in children:
+                            os.close(other_read)
+                            os.close(other_write)
+                        os.close(ready_read)
+                        os.close(done_write)
+                        first_requests()
+                        os.write(ready_write, b'.')
+                        os.read(done_read, 1)
+                        status = 0
+                    finally:
+                        os._exit(status)
+                os.close(ready_write)
+                os.close(done_read)
+                children.append((pid, ready_read, done_write))
+            for pid, ready_read, _ in children:
+                if not os.read(ready_read, 1):
+                    raise CommandError('Worker %d failed.' % pid)
+            self.report([os.getpid()] + [pid for pid, _, _ in children])
+        finally:
+            for pid, ready_read, done_write in children:
+                os.close(done_write)
+                os.close(ready_read)
+                os.waitpid(pid, 0)
+
+    def report(self, pids):
+        self.stdout.write('%8s %10s %10s %10s %10s' % ('pid', 'rss MiB', 'pss MiB', 'shared MiB', 'private MiB'))
+        totals = dict.fromkeys(('rss', 'pss', 'shared', 'private'), 0)
+        for pid in pids:
+            try:
+                memory = process_memory(pid)
+            except OSError as exc:
+                self.stderr.write('%8d %s' % (pid, exc.strerror))
+                continue
+            for name in totals:
+                totals[name] += memory[name]
+            self.stdout.write('%8d %10.1f %10.1f %10.1f %10.1f' % (
+                pid, memory['rss'] / MIB, memory['pss'] / MIB, memory['shared'] / MIB, memory['private'] / MIB))
+        self.stdout.write('%8s %10.1f %10.1f %10.1f %10.1f' % (
+            'total', totals['rss'] / MIB, totals['pss'] / MIB, totals['shared'] / MIB, totals['private'] / MIB))
@@ -0,0 +1,21 @@
+"""
+Print a token that has the next requests carrying it profiled.
+
+    curl -H "X-Snippets-Profile: $(python manage.py profile_token)" https://example.com/snippets/
+    curl "https://example.com/snippets/?profile=$(python manage.py profile_token)"
+
+The token is valid for SNIPPETS_PROFILE_TOKEN_MAX_AGE seconds, and only does anything with SNIPPETS_PROFILE_DIR set.
+The response names the profile files in its X-Snippets-Profile header.
+"""
+from django.core.management.base import BaseCommand
+
+from snippets.profiling import PROFILE_DIR, make_token
+
+
+class Command(BaseCommand):
+    help = 'Print a signed token for profiling requests.'
+
+    def handle(self, *args, **options):
+        if PROFILE_DIR is None:
+            self.stderr.write('SNIPPETS_PROFILE_DIR is not set, so requests will not be profiled.')
+        self.stdout.write(make_token())
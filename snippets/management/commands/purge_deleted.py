@@ -0,0 +1,44 @@
+"""
+Delete soft deleted snippets and users a small batch at a time.
+
+    python manage.py purge_deleted
+    python manage.py purge_deleted --batch-size 200 --pause 1 --loop 60
+    python manage.py purge_deleted --delete-user alice
+
+See snippets/purge.py.
+"""
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from snippets.models import UserDeletion
+from snippets.purge import PURGE_BATCH_SIZE, PURGE_PAUSE_SECONDS, Purger
+
+
+class Command(BaseCommand):
+    help = 'Delete soft deleted snippets, and users marked for deletion, in throttled batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete-user', action='append', default=[], metavar='USERNAME',
+                            help='Mark this user for deletion first, hiding them and their snippets right away.')
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE, help='Rows deleted per transaction.')
+        parser.add_argument('--pause', type=float, default=PURGE_PAUSE_SECONDS, help='Seconds to wait between batches.')
+        parser.add_argument('--max-batches', type=int, default=None, help='Stop after this many batches.')
+        parser.add_argument('--loop', type=float, default=None, metavar='SECONDS',
+                            help='Keep running, looking for more to purge this often.')
+
+    def handle(self, *args, **options):
+        for username in options['delete_user']:
+            try:
+                UserDeletion.schedule(User.objects.get(username=username))
+            except User.DoesNotExist:
+                raise CommandError('No user named %r.' % username)
+        while True:
+            stats = Purger(options['batch_size'], options['pause'], options['max_batches']).run()
+            if stats['batches'] or options['loop'] is None:
+                self.stdout.write('Deleted %d snippets and %d users in %d batches.' % (
+                    stats['snippets'], stats['users'], stats['batches']))
+            if options['loop'] is None:
+                return
+            time.sleep(options['loop'])
@@ -0,0 +1,19 @@
+"""
+Recompute the per-user and per-language snippet stats from the snippets themselves.
+
+    python manage.py refresh_stats
+
+Saves and deletes keep the stats current; this catches up after writes that bypass the model (`bulk_create`,
+`QuerySet.update`, raw SQL) and can run periodically to correct any drift.
+"""
+from django.core.management.base import BaseCommand
+
+from snippets.stats import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the snippet counts and code sizes per user and per language.'
+
+    def handle(self, *args, **options):
+        rows = rebuild_stats()
+        self.stdout.write('Wrote %d stats rows.' % rows)
@@ -0,0 +1,151 @@
+"""
+Re-render the stored highlight of every snippet, e.g. after a pygments upgrade or a formatter change.
+
+    python manage.py rehighlight
+    python manage.py rehighlight --language python --language javascript --workers 8
+    python manage.py rehighlight --restart
+
+Snippets are read in primary-key order, a chunk at a time, rendered in parallel in the highlight sandbox and written
+back touching only the rendered fields. Each row is only written if its version is still the one that was read: a
+snippet saved in the meantime already has a render of its new code, and is left alone. After every chunk the last
+primary key written is saved to a checkpoint file, in `SNIPPETS_REHIGHLIGHT_CHECKPOINT_DIR` (the temporary directory
+by default) unless `--checkpoint` names one; running the command again with the same filters picks up from there.
+Archived snippets are skipped.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from snippets.compression import compress_variants
+from snippets.highlighting import fallback_render, render_with_state
+from snippets.models import Snippet
+from snippets.sandbox import HighlightSandbox, RenderLimitExceeded, record_limit_hit, sandbox as default_sandbox
+
+CHECKPOINT_DIR = getattr(settings, 'SNIPPETS_REHIGHLIGHT_CHECKPOINT_DIR', None) or tempfile.gettempdir()
+
+
+def default_checkpoint():
+    # named after the database, so runs against different databases sharing the directory don't resume each other
+    database = hashlib.sha1(str(connection.settings_dict['NAME']).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(CHECKPOINT_DIR, 'snippets-rehighlight-%s.json' % database)
+
+
+def render_row(sandbox, row):
+    """
+    Render one `(pk, code, language, style, linenos, title, version)` row into the values of its rendered fields,
+    bumping the version, and report whether it fell back to plain text.
+    """
+    pk, code, language, style, linenos, title, version = row
+    # a render that overran its limits takes the whole pool down with it, failing renders running alongside; give
+    # every row a second go before falling back
+    for attempt in range(2):
+        try:
+            render = sandbox.run(render_with_state, code, language, style, linenos, title)
+            fallback = False
+            break
+        except RenderLimitExceeded as exc:
+            error = exc
+    else:
+        record_limit_hit(language, code, error)
+        render, fallback = fallback_render(code), True
+    variants = compress_variants(render.html)
+    fields = {'highlighted': render.html, 'highlighted_gzip': variants.get('gzip', b''),
+              'highlighted_br': variants.get('br', b''), 'highlight_state': render.state, 'tokens': render.tokens,
+              'line_index': render.lines, 'version': version + 1}
+    return fields, fallback
+
+
+class Command(BaseCommand):
+    help = 'Re-render the stored highlighted HTML of all snippets, or of a filtered subset, in parallel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--language', action='append', default=[], help='Only snippets in this language.')
+        parser.add_argument('--style', action='append', default=[], help='Only snippets with this style.')
+        parser.add_argument('--owner', action='append', default=[], help='Only snippets owned by this username.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of render processes.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Snippets read, rendered and written per chunk.')
+        parser.add_argument('--checkpoint', help='File recording progress, to resume an interrupted run '
+                                                 '(default: one per database in SNIPPETS_REHIGHLIGHT_CHECKPOINT_DIR).')
+        parser.add_argument('--restart', action='store_true', help='Ignore any checkpoint and start from the top.')
+
+    def get_queryset(self, filters):
+        # archived snippets have no code in the table; rehydrate them first to re-render them
+        queryset = Snippet.objects.filter(archive_segment__isnull=True)
+        if filters['language']:
+            queryset = queryset.filter(language__in=filters['language'])
+        if filters['style']:
+            queryset = queryset.filter(style__in=filters['style'])
+        if filters['owner']:
+            queryset = queryset.filter(owner__username__in=filters['owner'])
+        return queryset
+
+    def read_checkpoint(self, path, filters):
+        try:
+            with open(path) as checkpoint:
+                data = json.load(checkpoint)
+        except FileNotFoundError:
+            return 0, 0
+        if data['filters'] != filters:
+            raise CommandError('%s was written by a run with different filters; pass --restart to discard it.' % path)
+        return data['last_pk'], data['done']
+
+    def write_checkpoint(self, path, filters, last_pk, done):
+        # write then rename, so an interruption never leaves a half-written checkpoint behind
+        with open(path + '.tmp', 'w') as checkpoint:
+            json.dump({'filters': filters, 'last_pk': last_pk, 'done': done}, checkpoint)
+        os.replace(path + '.tmp', path)
+
+    def handle(self, *args, **options):
+        filters = {name: sorted(options[name]) for name in ('language', 'style', 'owner')}
+        path = options['checkpoint'] or default_checkpoint()
+        last_pk, done = (0, 0) if options['restart'] else self.read_checkpoint(path, filters)
+        if last_pk:
+            self.stdout.write('Resuming after pk %d (%d snippets already done).' % (last_pk, done))
+
+        queryset = self.get_queryset(filters).order_by('pk')
+        remaining = queryset.filter(pk__gt=last_pk).count()
+        sandbox = HighlightSandbox(enabled=default_sandbox.enabled, workers=options['workers'])
+        rendered = fallbacks = skipped = nbytes = 0
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=options['workers']) as threads:
+                while True:
+                    rows = list(queryset.filter(pk__gt=last_pk).values_list(
+                        'pk', 'code', 'language', 'style', 'linenos', 'title', 'version',
+                    )[:options['chunk_size']])
+                    if not rows:
+                        break
+                    results = list(threads.map(lambda row: render_row(sandbox, row), rows))
+                    with transaction.atomic():
+                        for row, (fields, _) in zip(rows, results):
+                            # a snippet saved or archived since it was read keeps what that wrote
+                            skipped += 1 - Snippet.objects.filter(
+                                pk=row[0], version=row[6], archive_segment__isnull=True).update(**fields)
+                    last_pk = rows[-1][0]
+                    rendered += len(rows)
+                    done += len(rows)
+                    fallbacks += sum(fallback for _, fallback in results)
+                    nbytes += sum(len(row[1].encode('utf-8')) for row in rows)
+                    self.write_checkpoint(path, filters, last_pk, done)
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write('%d/%d snippets, %.1f snippets/s, %.2f MiB/s of code' % (
+                        rendered, remaining, rendered / elapsed, nbytes / elapsed / 1024 / 1024))
+        finally:
+            sandbox.shutdown()
+
+        elapsed = time.perf_counter() - start
+        if os.path.exists(path):
+            os.remove(path)
+        self.stdout.write(self.style.SUCCESS(
+            'Re-highlighted %d snippets in %.1fs (%.1f snippets/s); %d fell back to plain text, %d changed meanwhile '
+            'and were left alone.' % (rendered - skipped, elapsed, rendered / elapsed if elapsed else 0.0, fallbacks,
+                                      skipped)))
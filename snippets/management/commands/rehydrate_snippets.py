@@ -0,0 +1,47 @@
+"""
+Bring archived snippet bodies back into the database.
+
+    python manage.py rehydrate_snippets --id 42
+    python manage.py rehydrate_snippets --segment 3
+    python manage.py rehydrate_snippets --all
+
+See snippets/archive.py. The segment files are left as they are.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from snippets.archive import ARCHIVED_FIELDS
+from snippets.models import Snippet
+
+
+class Command(BaseCommand):
+    help = 'Copy archived snippet bodies back into the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--id', type=int, action='append', default=[], help='Rehydrate this snippet.')
+        parser.add_argument('--segment', type=int, action='append', default=[],
+                            help='Rehydrate every snippet archived in this segment.')
+        parser.add_argument('--all', action='store_true', help='Rehydrate every archived snippet.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not (options['id'] or options['segment'] or options['all']):
+            raise CommandError('Pass --id, --segment or --all.')
+        queryset = Snippet.objects.filter(archive_segment__isnull=False)
+        if options['id']:
+            queryset = queryset.filter(pk__in=options['id'])
+        if options['segment']:
+            queryset = queryset.filter(archive_segment__in=options['segment'])
+        # loading the snippets reads their bodies back from the archive
+        queryset = queryset.order_by('pk').only('pk', 'archive_segment', *ARCHIVED_FIELDS)
+        rehydrated, last = 0, 0
+        while True:
+            snippets = list(queryset.filter(pk__gt=last)[:options['batch_size']])
+            if not snippets:
+                break
+            with transaction.atomic():
+                for snippet in snippets:
+                    rehydrated += Snippet.objects.filter(pk=snippet.pk, archive_segment=snippet.archive_segment).update(
+                        archive_segment=None, **{name: getattr(snippet, name) for name in ARCHIVED_FIELDS})
+            last = snippets[-1].pk
+        self.stdout.write(self.style.SUCCESS('Rehydrated %d snippets.' % rehydrated))
@@ -0,0 +1,27 @@
+"""
+OPTIONS responses without rebuilding the serializer description every time.
+
+DRF's SimpleMetadata describes the fields of the POST and PUT serializers afresh for each OPTIONS request, listing
+every choice of every `ChoiceField`, hundreds of entries for a snippet's language and style. That description only
+depends on the serializer class and the active language, so CachedMetadata keeps one per process. Which actions a
+user is allowed is still decided per request.
+"""
+from django.utils.translation import get_language
+from rest_framework.metadata import SimpleMetadata
+
+from .serializers import CachedFieldsMixin
+
+serializer_info_cache = {}
+
+
+class CachedMetadata(SimpleMetadata):
+
+    def get_serializer_info(self, serializer):
+        # the fields of other serializers may depend on the request
+        if not isinstance(serializer, CachedFieldsMixin) or not serializer.cache_fields:
+            return super(CachedMetadata, self).get_serializer_info(serializer)
+        key = (type(serializer), get_language())
+        info = serializer_info_cache.get(key)
+        if info is None:
+            info = serializer_info_cache.setdefault(key, super(CachedMetadata, self).get_serializer_info(serializer))
+        return info
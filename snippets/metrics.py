@@ -0,0 +1,323 @@
+"""
+Per-view request metrics, exported in the Prometheus text format.
+
+MetricsMiddleware measures every request and adds it to in-process histograms labelled by view name:
+
+- `snippets_request_seconds`, the wall time of the whole request;
+- `snippets_db_queries` and `snippets_db_seconds`, the queries made on any database and the time spent in them;
+- `snippets_highlight_seconds`, time spent rendering highlights in `Snippet.save()`;
+- `snippets_serializer_seconds`, time spent in serializers turning snippets into data and validating input;
+- `snippets_response_bytes`, the size of the response body.
+
+Alongside them it exports two counters the rest of the app keeps: `snippets_stored_renders_total`, the
+`Snippet.save()` calls that performed or skipped the stored render (`highlighting.render_counts`), and
+`snippets_highlight_limit_hits_total`, the renders that went over a sandbox limit by language and size
+(`sandbox.limit_hits`).
+
+A histogram is a handful of counters, so recording costs a bisection and an increment under a lock. `/metrics`
+serves them as text for Prometheus to scrape. With several worker processes, each only knows its own requests: set
+`SNIPPETS_METRICS_DIR` and every process also writes its histograms to `<pid>.json` there, at most every
+`SNIPPETS_METRICS_FLUSH_SECONDS`, and `/metrics` adds up all the files, so whichever worker answers the scrape reports
+for all of them. Files stay behind when a worker exits, keeping the counters monotonic; clear the directory when the
+server is restarted.
+
+`/metrics` only answers clients whose address is in `SNIPPETS_METRICS_ALLOWED_IPS` (addresses or networks, by default
+this host) and staff users; set it to None to serve everyone.
+"""
+import bisect
+import ipaddress
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+from .highlighting import render_counts
+from .sandbox import limit_hits
+
+METRICS_DIR = getattr(settings, 'SNIPPETS_METRICS_DIR', None)
+METRICS_FLUSH_SECONDS = getattr(settings, 'SNIPPETS_METRICS_FLUSH_SECONDS', 5.0)
+METRICS_ALLOWED_IPS = getattr(settings, 'SNIPPETS_METRICS_ALLOWED_IPS', ('127.0.0.1', '::1'))
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name: (help, buckets)
+METRICS = {
+    'snippets_request_seconds': ('Wall time of requests.', SECONDS_BUCKETS),
+    'snippets_db_queries': ('Database queries per request.', QUERY_BUCKETS),
+    'snippets_db_seconds': ('Time per request spent in database queries.', SECONDS_BUCKETS),
+    'snippets_highlight_seconds': ('Time per request spent rendering highlights on save.', SECONDS_BUCKETS),
+    'snippets_serializer_seconds': ('Time per request spent in serializers.', SECONDS_BUCKETS),
+    'snippets_response_bytes': ('Size of response bodies.', BYTES_BUCKETS),
+}
+# name: (help, label names, the Counter keeping it, keyed by a label value or a tuple of them)
+COUNTERS = {
+    'snippets_stored_renders_total': (
+        'Snippet saves that performed or skipped the stored render.', ('outcome',), render_counts),
+    'snippets_highlight_limit_hits_total': (
+        'Renders that went over a highlight sandbox limit.', ('language', 'size'), limit_hits),
+}
+# what timed() sections are recorded as
+SECTIONS = {'highlight': 'snippets_highlight_seconds', 'serializer': 'snippets_serializer_seconds'}
+
+_state = threading.local()
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, with their sum. Counts aren't cumulative until exported.
+    """
+
+    def __init__(self, buckets, counts=None, total=0.0):
+        self.buckets = buckets
+        self.counts = counts or [0] * (len(buckets) + 1)
+        self.total = total
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def merge(self, other):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.total += other.total
+
+
+class Registry:
+    """
+    The histograms of one process, by `(metric name, view name)`.
+    """
+
+    def __init__(self, directory=METRICS_DIR, flush_seconds=METRICS_FLUSH_SECONDS):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._flushed = 0.0
+
+    def observe(self, name, view, value):
+        key = (name, view)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(METRICS[name][1])
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: Histogram(histogram.buckets, list(histogram.counts), histogram.total)
+                    for key, histogram in self._histograms.items()}
+
+    def counts(self):
+        """
+        The counters of this process, as `{(counter name, label values): count}`.
+        """
+        return {(name, key if isinstance(key, tuple) else (key,)): count
+                for name, (_, _, counter) in COUNTERS.items() for key, count in list(counter.items())}
+
+    def maybe_flush(self):
+        """
+        Write this process's histograms to the metrics directory if they haven't been for a while.
+        """
+        if self.directory is None or time.monotonic() - self._flushed < self.flush_seconds:
+            return
+        self._flushed = time.monotonic()
+        self.flush()
+
+    def flush(self):
+        os.makedirs(self.directory, exist_ok=True)
+        data = {
+            'histograms': [[name, view, histogram.counts, histogram.total]
+                           for (name, view), histogram in self.snapshot().items()],
+            'counters': [[name, labels, count] for (name, labels), count in self.counts().items()],
+        }
+        descriptor, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as temporary:
+            json.dump(data, temporary)
+        os.replace(path, os.path.join(self.directory, '%d.json' % os.getpid()))
+
+    def collect(self):
+        """
+        Return the histograms and counters of every process writing to the directory, or of this one without a
+        directory, as `{(metric name, view name): Histogram}` and `{(counter name, label values): count}` in one dict.
+        """
+        if self.directory is None:
+            collected = self.snapshot()
+            collected.update(self.counts())
+            return collected
+        self.flush()
+        merged = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as source:
+                    data = json.load(source)
+            except (OSError, ValueError):
+                # removed or being replaced while we listed the directory
+                continue
+            if isinstance(data, list):
+                # written before the file had counters
+                data = {'histograms': data}
+            for name, labels, count in data.get('counters', ()):
+                if name in COUNTERS:
+                    key = (name, tuple(labels))
+                    merged[key] = merged.get(key, 0) + count
+            for name, view, counts, total in data['histograms']:
+                if name not in METRICS:
+                    continue
+                histogram = Histogram(METRICS[name][1], counts, total)
+                if (name, view) in merged:
+                    merged[name, view].merge(histogram)
+                else:
+                    merged[name, view] = histogram
+        return merged
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+registry = Registry()
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_bound(bound):
+    return repr(float(bound))
+
+
+def exposition(collected):
+    """
+    Render what `Registry.collect()` returns in the Prometheus text format.
+    """
+    lines = []
+    for name, (help_text, buckets) in METRICS.items():
+        series = sorted((view, histogram) for (metric, view), histogram in collected.items() if metric == name)
+        if not series:
+            continue
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s histogram' % name)
+        for view, histogram in series:
+            view = escape_label(view)
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else format_bound(bound)
+                lines.append('%s_bucket{view="%s",le="%s"} %d' % (name, view, le, cumulative))
+            lines.append('%s_sum{view="%s"} %r' % (name, view, float(histogram.total)))
+            lines.append('%s_count{view="%s"} %d' % (name, view, cumulative))
+    for name, (help_text, label_names, _) in COUNTERS.items():
+        series = sorted((labels, count) for (metric, labels), count in collected.items() if metric == name)
+        if not series:
+            continue
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % name)
+        for labels, count in series:
+            lines.append('%s{%s} %d' % (name, ','.join(
+                '%s="%s"' % (label, escape_label(str(value))) for label, value in zip(label_names, labels)), count))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_networks(addresses):
+    return None if addresses is None else [ipaddress.ip_network(address, strict=False) for address in addresses]
+
+
+allowed_networks = parse_networks(METRICS_ALLOWED_IPS)
+
+
+def may_scrape(request):
+    """
+    Whether `request` may read the metrics: it comes from an allowed address, or from a staff user.
+    """
+    if allowed_networks is None:
+        return True
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in network for network in allowed_networks)
+
+
+class RequestMetrics:
+    """
+    What one request has spent so far, outside the middleware's own timing.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.sections = dict.fromkeys(SECTIONS, 0.0)
+        self.running = set()
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_seconds += time.perf_counter() - start
+
+
+@contextmanager
+def timed(section):
+    """
+    Add the time spent in the block to the current request's `section`. Nested blocks of the same section count once.
+    """
+    current = getattr(_state, 'request', None)
+    if current is None or section in current.running:
+        yield
+        return
+    current.running.add(section)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.sections[section] += time.perf_counter() - start
+        current.running.discard(section)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+class MetricsMiddleware:
+    """
+    Records each request's timings in `registry`. Goes first in MIDDLEWARE, so the wall time covers the others too.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        current = _state.request = RequestMetrics()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(current.execute_wrapper))
+                response = self.get_response(request)
+        finally:
+            _state.request = None
+        elapsed = time.perf_counter() - start
+        view = view_name(request)
+        registry.observe('snippets_request_seconds', view, elapsed)
+        registry.observe('snippets_db_queries', view, current.queries)
+        registry.observe('snippets_db_seconds', view, current.db_seconds)
+        for section, seconds in current.sections.items():
+            registry.observe(SECTIONS[section], view, seconds)
+        if not response.streaming:
+            registry.observe('snippets_response_bytes', view, len(response.content))
+        registry.maybe_flush()
+        return response
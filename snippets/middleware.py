@@ -0,0 +1,77 @@
+"""
+Middleware that only runs for browsers.
+
+Sessions, CSRF protection, messages and X-Frame-Options are there for people using the browsable API, the admin and
+the `api-auth/` login, not for programs calling the JSON API with a token, basic auth or no credentials at all. Yet a
+request for `/snippets/` carrying a stale session cookie costs a session query, and every request pays for the other
+middleware's hooks. The Api* classes below are drop-in subclasses of those middlewares (so the admin's checks still
+find them) that step aside unless `is_browser_request()`:
+
+- the path is under one of SNIPPETS_BROWSER_PATHS (the admin and `api-auth/` by default),
+- the client sends the session cookie, so it may be logged in and authenticating with its session,
+- or it asks for HTML, which is the browsable API.
+
+Sessions stay lazy for browsers: the session store is only read when something uses `request.session` or
+`request.user`. Set SNIPPETS_API_MIDDLEWARE to False to run everything for every request, as Django does.
+"""
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.middleware.clickjacking import XFrameOptionsMiddleware
+from django.middleware.csrf import CsrfViewMiddleware
+
+API_MIDDLEWARE = getattr(settings, 'SNIPPETS_API_MIDDLEWARE', True)
+BROWSER_PATHS = getattr(settings, 'SNIPPETS_BROWSER_PATHS', ('/admin/', '/api-auth/'))
+
+
+def is_browser_request(request):
+    """
+    Whether the request may come from a browser session rather than an API client, decided once per request.
+    """
+    browser = getattr(request, '_snippets_browser', None)
+    if browser is None:
+        browser = (not API_MIDDLEWARE or
+                   request.path_info.startswith(BROWSER_PATHS) or
+                   settings.SESSION_COOKIE_NAME in request.COOKIES or
+                   'text/html' in request.META.get('HTTP_ACCEPT', '') or
+                   request.GET.get('format') == 'api' or
+                   request.path_info.endswith('.api'))
+        request._snippets_browser = browser
+    return browser
+
+
+class BrowserOnlyMixin:
+    """
+    Runs a middleware for browser requests and passes the others straight through.
+    """
+
+    def __call__(self, request):
+        if not is_browser_request(request):
+            return self.get_response(request)
+        return super(BrowserOnlyMixin, self).__call__(request)
+
+
+class ApiSessionMiddleware(BrowserOnlyMixin, SessionMiddleware):
+    pass
+
+
+class ApiCsrfViewMiddleware(BrowserOnlyMixin, CsrfViewMiddleware):
+
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        # called by the handler directly, not from __call__
+        if not is_browser_request(request):
+            return None
+        return super(ApiCsrfViewMiddleware, self).process_view(request, callback, callback_args, callback_kwargs)
+
+
+class ApiAuthenticationMiddleware(BrowserOnlyMixin, AuthenticationMiddleware):
+    pass
+
+
+class ApiMessageMiddleware(BrowserOnlyMixin, MessageMiddleware):
+    pass
+
+
+class ApiXFrameOptionsMiddleware(BrowserOnlyMixin, XFrameOptionsMiddleware):
+    pass
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='highlighted_br',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.AddField(
+            model_name='snippet',
+            name='highlighted_gzip',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0002_highlighted_compressed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
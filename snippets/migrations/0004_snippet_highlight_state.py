@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 21:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0003_snippet_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='highlight_state',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 21:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0006_snippet_line_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnippetViews',
+            fields=[
+                ('snippet', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='views', serialize=False, to='snippets.Snippet')),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='snippetviews',
+            index=models.Index(fields=['-count'], name='snippets_views_count_idx'),
+        ),
+    ]
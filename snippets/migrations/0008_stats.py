@@ -0,0 +1,74 @@
+# Generated by Django 2.2.28 on 2026-10-18 21:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class OctetLength(models.Func):
+    function = 'OCTET_LENGTH'
+    output_field = models.BigIntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='LENGTH(CAST(%(expressions)s AS BLOB))', **extra_context)
+
+
+def count_existing_snippets(apps, schema_editor):
+    # snippets.stats.rebuild_stats as it was for this schema, before snippets could be deleted softly or archived
+    Snippet = apps.get_model('snippets', 'Snippet')
+    UserLanguageStats = apps.get_model('snippets', 'UserLanguageStats')
+    LanguageStats = apps.get_model('snippets', 'LanguageStats')
+    connection = schema_editor.connection
+    using = connection.alias
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE %s IN SHARE MODE' % connection.ops.quote_name(Snippet._meta.db_table))
+    per_user, per_language = [], {}
+    for owner_id, language, count, code_bytes in (
+            Snippet.objects.using(using).order_by().values_list('owner_id', 'language')
+            .annotate(snippets=models.Count('pk'), code_bytes=models.Sum(OctetLength('code')))):
+        per_user.append(UserLanguageStats(owner_id=owner_id, language=language, snippets=count,
+                                          code_bytes=code_bytes))
+        language_totals = per_language.setdefault(language, LanguageStats(language=language))
+        language_totals.snippets += count
+        language_totals.code_bytes += code_bytes
+    for model, rows in ((UserLanguageStats, per_user), (LanguageStats, list(per_language.values()))):
+        batch_size = min(1000, max(connection.ops.bulk_batch_size(model._meta.concrete_fields, rows), 1))
+        model.objects.using(using).bulk_create(rows, batch_size=batch_size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('snippets', '0007_snippetviews'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LanguageStats',
+            fields=[
+                ('language', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('snippets', models.BigIntegerField(default=0)),
+                ('code_bytes', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-snippets', 'language'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserLanguageStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('language', models.CharField(max_length=100)),
+                ('snippets', models.BigIntegerField(default=0)),
+                ('code_bytes', models.BigIntegerField(default=0)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='language_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-snippets', 'language'],
+                'unique_together': {('owner', 'language')},
+            },
+        ),
+        migrations.RunPython(count_existing_snippets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 21:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('snippets', '0008_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserDeletion',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='pending_deletion', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('requested', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='snippet',
+            name='deleted',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(condition=models.Q(deleted=True), fields=['id'], name='snippets_deleted_idx'),
+        ),
+    ]
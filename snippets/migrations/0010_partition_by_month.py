@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 21:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from snippets.partitions import partition_table
+
+
+def partition_snippets(apps, schema_editor):
+    # PostgreSQL only; other databases keep the plain table
+    if schema_editor.connection.vendor == 'postgresql':
+        partition_table(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0009_soft_delete'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='snippetviews',
+            name='snippet',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='views', serialize=False, to='snippets.Snippet'),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['created'], name='snippets_created_idx'),
+        ),
+        # there's no going back short of copying every row into a new plain table
+        migrations.RunPython(partition_snippets),
+    ]
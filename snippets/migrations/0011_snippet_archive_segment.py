@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 21:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0010_partition_by_month'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='archive_segment',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
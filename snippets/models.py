@@ -1,15 +1,37 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 # We'll be using this (pygments) for the code highlighting
 from pygments.lexers import get_all_lexers
 from pygments.styles import get_all_styles
 # pygments for highlighting code after implementing authentication
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters.html import HtmlFormatter
-from pygments import highlight
+from .highlighting import render_counts, render_stored
+# compressing the highlighted HTML once at save time
+from .compression import compress_variants
+# slicing line ranges out of the stored code and highlighted HTML
+from .lines import LineIndex
+# the optional on-disk copy of snippet bodies served by SnippetRaw
+from .raw import raw_store
+# per-user and per-language totals, kept up to date on save and delete
+from .stats import OctetLength, add_to_row, code_size
+# bodies of old snippets moved out to segment files
+from .archive import ARCHIVED_FIELDS, get_archive_store
+# render time shows up in the request metrics
+from .metrics import timed
 
 LEXERS = [item for item in get_all_lexers() if item[1]]
 LANGUAGE_CHOICES = sorted([(item[1][0], item[0]) for item in LEXERS])
 STYLE_CHOICES = sorted([(item, item) for item in get_all_styles()])
+# the fields the highlighted HTML is rendered from
+HIGHLIGHT_INPUTS = ('code', 'language', 'style', 'linenos', 'title')
+# the fields a render writes
+RENDERED_FIELDS = ('highlighted', 'highlighted_gzip', 'highlighted_br', 'highlight_state', 'tokens', 'line_index',
+                   'version')
+# the fields a version stands for: a save writing any of them bumps it
+BODY_FIELDS = HIGHLIGHT_INPUTS + tuple(name for name in RENDERED_FIELDS if name != 'version')
+# the fields UserLanguageStats and LanguageStats count a snippet under
+STATS_INPUTS = ('owner_id', 'language', 'code')
 
 # Create your models here.
 
@@ -52,6 +74,15 @@ We'll need some extra imports also for pygments to highlight our code snippets
 """
 
 
+class SnippetQuerySet(models.QuerySet):
+
+    def live(self):
+        """
+        The snippets that haven't been deleted, by themselves or along with their owner.
+        """
+        return self.filter(deleted=False, owner__pending_deletion__isnull=True)
+
+
 # simple Snippet model that is used to store code snippets
 class Snippet(models.Model):
     created = models.DateTimeField(auto_now_add=True)
@@ -62,23 +93,317 @@ class Snippet(models.Model):
     language = models.CharField(choices=LANGUAGE_CHOICES, default='python', max_length=100)
     style = models.CharField(choices=STYLE_CHOICES, default='friendly', max_length=100)
     highlighted = models.TextField()
+    # gzip and brotli copies of `highlighted`, served as-is by SnippetHighlight
+    highlighted_gzip = models.BinaryField(blank=True, default=b'', editable=False)
+    highlighted_br = models.BinaryField(blank=True, default=b'', editable=False)
+    # bumped in the database by every save writing BODY_FIELDS, so that `(pk, version)` always names
+    # one body: renders cached, raw files written and ETags sent under an older version are never served
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # lexer checkpoints for `highlighted`, letting a code edit re-highlight only the lines it touched
+    highlight_state = models.BinaryField(blank=True, default=b'', editable=False)
+    # the lexed tokens behind `highlighted`, so other styles and formats only need a formatter pass
+    tokens = models.BinaryField(blank=True, default=b'', editable=False)
+    # where each line starts in `code` and in `highlighted`, for fetching line ranges (see lines.py)
+    line_index = models.BinaryField(blank=True, default=b'', editable=False)
+    # set by soft_delete(): the snippet is hidden at once and removed later by the purger (see purge.py)
+    deleted = models.BooleanField(default=False, editable=False)
+    # the archive segment holding ARCHIVED_FIELDS, which are blank in the table while this is set (see archive.py)
+    archive_segment = models.PositiveIntegerField(null=True, blank=True, editable=False)
+
+    objects = SnippetQuerySet.as_manager()
 
     class Meta:
         ordering = ['created']
+        indexes = [
+            # the purger reads deleted snippets off this index, which holds only them
+            models.Index(fields=['id'], name='snippets_deleted_idx', condition=models.Q(deleted=True)),
+            # lists are ordered by `created`, which is also what the table is partitioned on (see partitions.py)
+            models.Index(fields=['created'], name='snippets_created_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Snippet, cls).from_db(db, field_names, values)
+        if 'archive_segment' in field_names and instance.archive_segment is not None:
+            instance._load_archived(ARCHIVED_FIELDS)
+        instance._remember_render()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        if fields is not None and 'archive_segment' in self.get_deferred_fields() and \
+                any(name in ARCHIVED_FIELDS for name in fields):
+            # whether those are in the row or in the archive depends on it
+            fields = list(fields) + ['archive_segment']
+        super(Snippet, self).refresh_from_db(using, fields)
+        # a full refresh went through from_db, but loading deferred fields one by one doesn't
+        if fields is not None and 'archive_segment' not in self.get_deferred_fields() and \
+                self.archive_segment is not None:
+            self._load_archived([name for name in fields if name in ARCHIVED_FIELDS])
+
+    def _load_archived(self, names):
+        deferred = self.get_deferred_fields()
+        names = [name for name in names if name not in deferred]
+        if names:
+            values = get_archive_store().read(self.archive_segment, self.pk)
+            for name in names:
+                setattr(self, name, values[name])
+
+    def _remember_render(self):
+        # keep what the stored render was made from, and what the stats count, so save() can tell what changed since
+        deferred = self.get_deferred_fields()
+        self._rendered = {name: getattr(self, name) for name in HIGHLIGHT_INPUTS + ('highlighted',)
+                          if name not in deferred}
+        self._counted = {name: getattr(self, name) for name in STATS_INPUTS if name not in deferred}
+
+    def highlight_inputs_changed(self):
+        """
+        True if any field the highlighted HTML is rendered from changed since the snippet was loaded or saved.
+
+        Fields that were deferred and never set can't have changed. A snippet that hasn't been saved yet always
+        needs rendering.
+        """
+        rendered = getattr(self, '_rendered', None)
+        if self._state.adding or rendered is None:
+            return True
+        deferred = self.get_deferred_fields()
+        return any(name not in rendered or rendered[name] != getattr(self, name)
+                   for name in HIGHLIGHT_INPUTS if name not in deferred)
+
+    def _previous_render(self):
+        # the `(code, html, state, tokens)` to re-highlight from, if only the code has changed since the last render
+        rendered = getattr(self, '_rendered', None)
+        if rendered is None or not self.highlight_state or not self.tokens:
+            return None
+        if not rendered.keys() >= set(HIGHLIGHT_INPUTS + ('highlighted',)):
+            return None
+        if any(rendered[name] != getattr(self, name) for name in HIGHLIGHT_INPUTS if name != 'code'):
+            return None
+        return rendered['code'], rendered['highlighted'], bytes(self.highlight_state), bytes(self.tokens)
 
     # And now we can add a .save() method to our model class after adding owner and highlighted fields to our model
     def save(self, *args, **kwargs):
         """
         Use the `pygments` library to create a highlighted HTML
         representation of the code snippet.
+
+        The render only runs when one of HIGHLIGHT_INPUTS changed, and never for an `update_fields` save that leaves
+        them all out.
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not set(update_fields) & set(HIGHLIGHT_INPUTS):
+            rerender = False
+        else:
+            rerender = self.highlight_inputs_changed()
+        if rerender:
+            with timed('highlight'):
+                self.highlighted, self.highlight_state, self.tokens, self.line_index = render_stored(
+                    self.code, self.language, self.style, self.linenos, self.title, self._previous_render())
+                variants = compress_variants(self.highlighted)
+            self.highlighted_gzip = variants.get('gzip', b'')
+            self.highlighted_br = variants.get('br', b'')
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | set(RENDERED_FIELDS)
+        elif update_fields is None and not self._state.adding:
+            # the code, its render and their version are still what this instance loaded: leave them to the row,
+            # which a concurrent save may have changed since
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.attname not in deferred and
+                                       field.name not in BODY_FIELDS + ('version',)]
+        render_counts['performed' if rerender else 'skipped'] += 1
+        if not self._state.adding and 'archive_segment' not in self.get_deferred_fields() and \
+                self.archive_segment is not None:
+            # saving brings the bodies back into the table; load any that were deferred while we still can
+            for name in ARCHIVED_FIELDS:
+                getattr(self, name)
+            self.archive_segment = None
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | set(ARCHIVED_FIELDS) | {'archive_segment'}
+        bump = rerender or bool(set(kwargs.get('update_fields') or ()) & set(BODY_FIELDS))
+        if bump and kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'version'}
+        with transaction.atomic():
+            counted = None if self._state.adding else self._counted_before(update_fields)
+            if bump and not self._state.adding:
+                self._save_bumping_version(*args, **kwargs)
+            else:
+                self.version += 1 if bump else 0
+                super(Snippet, self).save(*args, **kwargs)
+            self._count(counted)
+        if bump and raw_store is not None:
+            raw_store.write(self.pk, self.version, self.code)
+        self._remember_render()
+
+    def _save_bumping_version(self, *args, **kwargs):
+        # Incremented by the UPDATE itself, not from the value this instance loaded: concurrent saves, or one from a
+        # stale instance, then each get a version of their own instead of writing different bodies under the same one.
+        loaded, self.version = self.version, F('version') + 1
+        try:
+            super(Snippet, self).save(*args, **kwargs)
+        except Exception:
+            self.version = loaded
+            raise
+        self.version = Snippet.objects.filter(pk=self.pk).values_list('version', flat=True).get()
+
+    def _counted_before(self, update_fields):
+        """
+        Return the `(owner_id, language, code_bytes)` the stats count this snippet under, or () if the save can't
+        change them.
+        """
+        if update_fields is not None and not set(update_fields) & {'owner', 'owner_id', 'language', 'code'}:
+            return ()
+        counted = getattr(self, '_counted', {})
+        if counted.keys() >= set(STATS_INPUTS):
+            if all(counted[name] == getattr(self, name) for name in STATS_INPUTS):
+                return ()
+            return counted['owner_id'], counted['language'], code_size(counted['code'])
+        # loaded with some of them deferred: read what the row holds
+        owner_id, language, size, segment = Snippet.objects.filter(pk=self.pk).values_list(
+            'owner_id', 'language', OctetLength('code'), 'archive_segment').get()
+        if segment is not None:
+            size = get_archive_store().code_size(segment, self.pk)
+        return owner_id, language, size
+
+    def _count(self, counted):
+        # move this snippet from the stats it was counted under (None if it is new) to the ones it belongs to now
+        if counted == ():
+            return
+        deferred = self.get_deferred_fields()
+        owner_id = counted[0] if 'owner_id' in deferred else self.owner_id
+        language = counted[1] if 'language' in deferred else self.language
+        size = counted[2] if 'code' in deferred else code_size(self.code)
+        if counted == (owner_id, language, size):
+            return
+        if counted is not None:
+            count_snippet(counted[0], counted[1], -1, -counted[2])
+        count_snippet(owner_id, language, 1, size)
+
+    def soft_delete(self):
+        """
+        Hide the snippet and take it out of the stats, leaving the row for the purger to delete.
+        """
+        with transaction.atomic():
+            # a snippet of a user being deleted was uncounted with them
+            if Snippet.objects.live().filter(pk=self.pk).update(deleted=True):
+                count_snippet(self.owner_id, self.language, -1, -code_size(self.code))
+        self.deleted = True
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        result = super(Snippet, self).delete(*args, **kwargs)
+        if raw_store is not None:
+            raw_store.remove(pk)
+        return result
+
+    def get_line_index(self):
+        """
+        Return the LineIndex of the stored render, or None for a snippet rendered before line indexes were stored.
         """
-        lexer = get_lexer_by_name(self.language)
-        linenos = 'table' if self.linenos else False
-        options = {'title': self.title} if self.title else {}
-        formatter = HtmlFormatter(style=self.style, linenos=linenos,
-                                  full=True, **options)
-        self.highlighted = highlight(self.code, lexer, formatter)
-        super(Snippet, self).save(*args, **kwargs)
+        return LineIndex(self.line_index) if self.line_index else None
+
+    @property
+    def highlight_encodings(self):
+        """
+        The content-codings we have a stored copy of `highlighted` for.
+        """
+        return [encoding for encoding in ('br', 'gzip') if self.compressed_highlight(encoding)]
+
+    def compressed_highlight(self, encoding):
+        """
+        Return the stored `highlighted` bytes for `encoding`, or b'' if that variant hasn't been stored.
+        """
+        variant = {'gzip': self.highlighted_gzip, 'br': self.highlighted_br}.get(encoding)
+        return bytes(variant) if variant else b''
+
+
+class SnippetViews(models.Model):
+    """
+    How many times a snippet has been viewed, kept apart from Snippet so counting views never touches snippet rows.
+
+    Written in batches by `counters.ViewCounter`.
+    """
+    # no constraint in the database: a partitioned snippets table can't be referenced by id alone
+    snippet = models.OneToOneField(Snippet, primary_key=True, related_name='views', on_delete=models.CASCADE,
+                                   db_constraint=False)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        # the popular snippets are read off this index rather than by sorting the table
+        indexes = [models.Index(fields=['-count'], name='snippets_views_count_idx')]
+
+
+class UserLanguageStats(models.Model):
+    """
+    How many snippets a user has in a language and their total size, so a user's stats never count their snippets.
+    """
+    owner = models.ForeignKey('auth.user', related_name='language_stats', on_delete=models.CASCADE)
+    language = models.CharField(max_length=100)
+    snippets = models.BigIntegerField(default=0)
+    code_bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('owner', 'language')]
+        ordering = ['-snippets', 'language']
+
+
+class LanguageStats(models.Model):
+    """
+    How many snippets there are in a language and their total size.
+    """
+    language = models.CharField(max_length=100, primary_key=True)
+    snippets = models.BigIntegerField(default=0)
+    code_bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-snippets', 'language']
+
+
+def count_snippet(owner_id, language, snippets, code_bytes):
+    """
+    Add `snippets` snippets of `code_bytes` bytes in total to the stats of `language` and of its user.
+    """
+    add_to_row(UserLanguageStats, {'owner_id': owner_id, 'language': language}, snippets, code_bytes)
+    add_to_row(LanguageStats, {'language': language}, snippets, code_bytes)
+
+
+def uncount_user(owner_id):
+    """
+    Take all of a user's snippets out of the stats at once, from the user's own totals.
+    """
+    for language, snippets, code_bytes in (UserLanguageStats.objects.select_for_update().filter(owner_id=owner_id)
+                                           .values_list('language', 'snippets', 'code_bytes')):
+        add_to_row(LanguageStats, {'language': language}, -snippets, -code_bytes)
+    UserLanguageStats.objects.filter(owner_id=owner_id).delete()
+
+
+class UserDeletion(models.Model):
+    """
+    Marks a user as deleted. The user and their snippets are hidden at once and removed by the purger in batches,
+    rather than in one cascade that could lock thousands of rows.
+    """
+    user = models.OneToOneField('auth.user', primary_key=True, related_name='pending_deletion',
+                                on_delete=models.CASCADE)
+    requested = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def schedule(cls, user):
+        with transaction.atomic():
+            deletion, created = cls.objects.get_or_create(user=user)
+            if created:
+                uncount_user(user.pk)
+            # and no more logging in
+            user.is_active = False
+            user.save(update_fields=['is_active'])
+        return deletion
+
+
+@receiver(pre_delete, sender=Snippet)
+def uncount_deleted_snippet(sender, instance, **kwargs):
+    # a pre_delete handler sees every deletion, queryset and cascade deletes included, while the row is still there;
+    # soft deleted snippets, and those of users scheduled for deletion, were uncounted already
+    if instance.deleted or UserDeletion.objects.filter(user_id=instance.owner_id).exists():
+        return
+    count_snippet(instance.owner_id, instance.language, -1, -code_size(instance.code))
 
 
 """
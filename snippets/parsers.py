@@ -0,0 +1,51 @@
+"""
+Parsing raw snippet uploads.
+
+A JSON upload is read whole, decoded, parsed into a dict and escaped strings un-escaped before validation even
+starts, so a multi-megabyte paste is copied several times over. A `text/plain` upload is the code itself: the parser
+reads it from the request stream in chunks, refusing anything over `SNIPPETS_MAX_UPLOAD_BYTES` as soon as it gets
+there, and decodes the buffer once.
+"""
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError
+from rest_framework.parsers import BaseParser
+
+MAX_UPLOAD_BYTES = getattr(settings, 'SNIPPETS_MAX_UPLOAD_BYTES', 8 * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Snippet is larger than the allowed upload size.'
+    default_code = 'upload_too_large'
+
+
+class PlainTextParser(BaseParser):
+    """
+    Parses a `text/plain` body into a str, holding it to MAX_UPLOAD_BYTES.
+    """
+    media_type = 'text/plain'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        request = parser_context.get('request')
+        try:
+            declared = int(request.META.get('CONTENT_LENGTH') or 0) if request is not None else 0
+        except ValueError:
+            declared = 0
+        if declared > MAX_UPLOAD_BYTES:
+            raise UploadTooLarge()
+        buffer = bytearray()
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if len(buffer) + len(chunk) > MAX_UPLOAD_BYTES:
+                raise UploadTooLarge()
+            buffer += chunk
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            return str(buffer, encoding)
+        except (UnicodeDecodeError, LookupError) as exc:
+            raise ParseError('Plain text body could not be decoded as %s: %s' % (encoding, exc))
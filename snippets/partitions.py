@@ -0,0 +1,154 @@
+"""
+Monthly partitions of snippets_snippet on PostgreSQL.
+
+Migration 0010 turns snippets_snippet into a table partitioned by range of `created`, one partition per month, so
+recent rows sit in small partitions with small indexes and old months can be detached (and archived or dropped)
+without deleting row by row. The existing table becomes the first partition, holding everything before next month:
+it is renamed, given a CHECK constraint on `created` so attaching it needs no second scan, and attached as is.
+Queries through the model don't change; the primary key becomes `(id, created)` in the database, as PostgreSQL
+requires of a partitioned table, while ids still come from the same sequence.
+
+Partitions have to exist before rows arrive for their month: run `manage.py manage_partitions` daily to keep
+`SNIPPETS_PARTITIONS_AHEAD` months created ahead and, with `SNIPPETS_PARTITIONS_RETAIN` set, to detach the months
+older than that. Other databases keep the plain table and the command refuses to run.
+"""
+import re
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+TABLE = 'snippets_snippet'
+LEGACY_TABLE = 'snippets_snippet_legacy'
+
+PARTITIONS_AHEAD = getattr(settings, 'SNIPPETS_PARTITIONS_AHEAD', 3)
+PARTITIONS_RETAIN = getattr(settings, 'SNIPPETS_PARTITIONS_RETAIN', None)
+
+# the upper bound in pg_get_expr(relpartbound): FOR VALUES FROM (...) TO ('2024-02-01 00:00:00+00')
+UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month):
+    return '%s_p%04d_%02d' % (TABLE, month.year, month.month)
+
+
+def is_partitioned(connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [TABLE])
+        return cursor.fetchone() is not None
+
+
+def list_partitions(connection):
+    """
+    Return the `(name, upper bound)` of every partition, oldest first.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = %s::regclass', [TABLE])
+        partitions = []
+        for name, bound in cursor.fetchall():
+            match = UPPER_BOUND.search(bound)
+            partitions.append((name, parse_datetime(match.group(1)) if match else None))
+    return sorted(partitions, key=lambda partition: partition[1] or datetime.max.replace(tzinfo=timezone.utc))
+
+
+def create_partition(connection, month):
+    """
+    Create the partition for the month starting at `month` unless it exists, returning its name.
+    """
+    name = partition_name(month)
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)'.format(
+            name=connection.ops.quote_name(name), table=connection.ops.quote_name(TABLE)),
+            [month.isoformat(), add_months(month, 1).isoformat()])
+    return name
+
+
+def detach_partition(connection, name):
+    """
+    Detach a partition, leaving its rows in a table of their own.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE {table} DETACH PARTITION {name}'.format(
+            table=connection.ops.quote_name(TABLE), name=connection.ops.quote_name(name)))
+
+
+def partition_table(connection, now=None, ahead=PARTITIONS_AHEAD):
+    """
+    Turn the plain snippets table into a partitioned one. Takes an exclusive lock on the table and scans it twice
+    (once for the CHECK constraint, once for the `(id, created)` index), so run it in a quiet period.
+    """
+    quote = connection.ops.quote_name
+    boundary = add_months(month_start(now or timezone.now()), 1)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT indexname, indexdef FROM pg_indexes '
+                       'WHERE schemaname = current_schema() AND tablename = %s AND indexname != %s',
+                       [TABLE, TABLE + '_pkey'])
+        indexes = cursor.fetchall()
+        cursor.execute('ALTER TABLE {table} RENAME TO {legacy}'.format(table=quote(TABLE), legacy=quote(LEGACY_TABLE)))
+        # free the index names for the partitioned table's indexes, which adopt these when the table is attached
+        cursor.execute('ALTER TABLE {legacy} RENAME CONSTRAINT {pkey} TO {legacy_pkey}'.format(
+            legacy=quote(LEGACY_TABLE), pkey=quote(TABLE + '_pkey'), legacy_pkey=quote(LEGACY_TABLE + '_pkey')))
+        for name, _ in indexes:
+            cursor.execute('ALTER INDEX {name} RENAME TO {legacy}'.format(
+                name=quote(name), legacy=quote(name[:56] + '_legacy')))
+        cursor.execute(
+            'CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) '
+            'PARTITION BY RANGE (created)'.format(table=quote(TABLE), legacy=quote(LEGACY_TABLE)))
+        cursor.execute('ALTER TABLE {table} ADD PRIMARY KEY (id, created)'.format(table=quote(TABLE)))
+        cursor.execute('ALTER SEQUENCE {sequence} OWNED BY {table}.id'.format(
+            sequence=quote(TABLE + '_id_seq'), table=quote(TABLE)))
+        cursor.execute('ALTER TABLE {table} ADD FOREIGN KEY (owner_id) REFERENCES auth_user (id) '
+                       'DEFERRABLE INITIALLY DEFERRED'.format(table=quote(TABLE)))
+        for _, definition in indexes:
+            cursor.execute(definition)
+        cursor.execute('CREATE UNIQUE INDEX {name} ON {legacy} (id, created)'.format(
+            name=quote(LEGACY_TABLE + '_id_created'), legacy=quote(LEGACY_TABLE)))
+        cursor.execute('ALTER TABLE {legacy} ADD CONSTRAINT {name} CHECK (created IS NOT NULL AND created < %s)'.format(
+            legacy=quote(LEGACY_TABLE), name=quote(LEGACY_TABLE + '_created_check')), [boundary.isoformat()])
+        cursor.execute('ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO (%s)'.format(
+            table=quote(TABLE), legacy=quote(LEGACY_TABLE)), [boundary.isoformat()])
+    for months in range(ahead + 1):
+        create_partition(connection, add_months(boundary, months))
+
+
+def maintain_partitions(connection, now=None, ahead=PARTITIONS_AHEAD, retain=PARTITIONS_RETAIN, dry_run=False):
+    """
+    Create the partitions for this month and `ahead` more, and detach those wholly older than the last `retain`
+    months. Returns the names created and detached.
+    """
+    current = month_start(now or timezone.now())
+    existing = list_partitions(connection)
+    names = {name for name, _ in existing}
+    # the months before the table was partitioned are all in the legacy partition
+    legacy_upper = dict(existing).get(LEGACY_TABLE)
+    created = []
+    for months in range(ahead + 1):
+        month = add_months(current, months)
+        if partition_name(month) not in names and (legacy_upper is None or month >= legacy_upper):
+            if not dry_run:
+                create_partition(connection, month)
+            created.append(partition_name(month))
+    detached = []
+    if retain is not None:
+        cutoff = add_months(current, 1 - retain)
+        for name, upper in existing:
+            if upper is not None and upper <= cutoff:
+                if not dry_run:
+                    detach_partition(connection, name)
+                detached.append(name)
+    return created, detached
@@ -0,0 +1,170 @@
+"""
+Profiling single requests in production.
+
+With `SNIPPETS_PROFILE_DIR` set, ProfilingMiddleware runs a request for one of the views in snippets/views.py under
+cProfile and tracemalloc when either
+
+- it carries a token from `manage.py profile_token`, in an `X-Snippets-Profile` header or a `profile` query
+  parameter. Tokens are signed with SECRET_KEY and expire after `SNIPPETS_PROFILE_TOKEN_MAX_AGE` seconds, so only
+  people with access to the servers can make them;
+- or it is picked at random, one in `SNIPPETS_PROFILE_SAMPLE_RATE` requests (0 turns sampling off).
+
+Each profile leaves two files in the directory, named after the time, view and process:
+
+- `.prof`, the call graph in pstats format, for `python -m pstats`, snakeviz or gprof2dot;
+- `.txt`, the slowest functions by cumulative time and the lines that allocated the most memory during the request.
+
+The oldest files are removed once the directory holds more than `SNIPPETS_PROFILE_MAX_BYTES`. Only one request per
+process is profiled at a time; others arriving meanwhile run as usual.
+"""
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core import signing
+from django.urls import Resolver404, resolve
+
+PROFILE_DIR = getattr(settings, 'SNIPPETS_PROFILE_DIR', None)
+PROFILE_SAMPLE_RATE = getattr(settings, 'SNIPPETS_PROFILE_SAMPLE_RATE', 0)
+PROFILE_MAX_BYTES = getattr(settings, 'SNIPPETS_PROFILE_MAX_BYTES', 256 * 1024 * 1024)
+PROFILE_TOKEN_MAX_AGE = getattr(settings, 'SNIPPETS_PROFILE_TOKEN_MAX_AGE', 3600)
+
+PROFILE_HEADER = 'HTTP_X_SNIPPETS_PROFILE'
+PROFILE_PARAMETER = 'profile'
+PROFILED_MODULE = 'snippets.views'
+TOKEN_SALT = 'snippets.profiling'
+# frames kept per allocation, and lines listed in the summary
+TRACEMALLOC_FRAMES = 10
+SUMMARY_LINES = 40
+
+
+def make_token():
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign('profile')
+
+
+def valid_token(token, max_age=PROFILE_TOKEN_MAX_AGE):
+    try:
+        return signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=max_age) == 'profile'
+    except signing.BadSignature:
+        return False
+
+
+def profiled_view(request):
+    """
+    The name to file a profile of this request under, or None if its view isn't one of ours.
+    """
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return None
+    if getattr(match.func, '__module__', None) != PROFILED_MODULE:
+        return None
+    return match.url_name or match.func.__name__
+
+
+def prune(directory, max_bytes):
+    """
+    Remove the oldest files in `directory` until the rest fit in `max_bytes`.
+    """
+    files = []
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+class Profiler:
+    """
+    Profiles one call at a time, writing its call graph and allocation summary to `directory`.
+    """
+
+    def __init__(self, directory=PROFILE_DIR, max_bytes=PROFILE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def run(self, name, func, *args):
+        """
+        Return `func(*args)` and the base path of the profile files, or None if another profile was running.
+        """
+        if not self._lock.acquire(blocking=False):
+            return func(*args), None
+        try:
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            before = tracemalloc.take_snapshot()
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                result = profile.runcall(func, *args)
+            finally:
+                elapsed = time.perf_counter() - start
+                after = tracemalloc.take_snapshot()
+                if not tracing:
+                    tracemalloc.stop()
+            path = self.save(name, profile, elapsed, after.compare_to(before, 'lineno'))
+            return result, path
+        finally:
+            self._lock.release()
+
+    def save(self, name, profile, elapsed, allocations):
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        stamp = '%s.%03d' % (time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)), now * 1000 % 1000)
+        path = os.path.join(self.directory, '%s-%s-%d' % (stamp, re.sub(r'[^\w.-]', '_', name), os.getpid()))
+        profile.dump_stats(path + '.prof')
+        summary = io.StringIO()
+        summary.write('%s: %.1fms\n\n' % (name, elapsed * 1000))
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+        summary.write('Allocated during the request, by line:\n')
+        for difference in allocations[:SUMMARY_LINES]:
+            summary.write('%s\n' % difference)
+        with open(path + '.txt', 'w') as output:
+            output.write(summary.getvalue())
+        prune(self.directory, self.max_bytes)
+        return path
+
+
+profiler = Profiler() if PROFILE_DIR else None
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the requests asked for with a signed token, and a random sample of the others.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if profiler is None:
+            return self.get_response(request)
+        token = request.META.get(PROFILE_HEADER) or request.GET.get(PROFILE_PARAMETER)
+        requested = bool(token) and valid_token(token)
+        if not requested and not (PROFILE_SAMPLE_RATE and random.randrange(PROFILE_SAMPLE_RATE) == 0):
+            return self.get_response(request)
+        name = profiled_view(request)
+        if name is None:
+            return self.get_response(request)
+        response, path = profiler.run(name, self.get_response, request)
+        if requested and path is not None:
+            response['X-Snippets-Profile'] = os.path.basename(path)
+        return response
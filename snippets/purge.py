@@ -0,0 +1,86 @@
+"""
+Removing deleted snippets and users in the background.
+
+Deleting a user with `on_delete=CASCADE` deletes all of their snippets in one transaction, holding locks on every
+row for as long as that takes. Deletion through the API is soft instead: `Snippet.soft_delete()` flags the snippet
+and `UserDeletion.schedule()` marks the user, which hides them straight away (see `SnippetQuerySet.live()`). The
+purger then deletes the rows in primary-key order, `SNIPPETS_PURGE_BATCH_SIZE` at a time and each batch in its own
+short transaction, pausing `SNIPPETS_PURGE_PAUSE_SECONDS` between batches so it never hogs the database. A user
+row goes last, once none of their snippets are left. Both were taken out of the stats when they were hidden, so the
+purger only deletes, without loading the snippets' code and renders.
+
+Run it with `manage.py purge_deleted`, from cron or with `--loop`.
+"""
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .models import Snippet, UserDeletion
+from .raw import raw_store
+
+PURGE_BATCH_SIZE = getattr(settings, 'SNIPPETS_PURGE_BATCH_SIZE', 500)
+PURGE_PAUSE_SECONDS = getattr(settings, 'SNIPPETS_PURGE_PAUSE_SECONDS', 0.5)
+
+
+class Purger:
+    """
+    Deletes soft deleted snippets, then the users waiting for deletion, in small batches.
+    """
+
+    def __init__(self, batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE_SECONDS, max_batches=None):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.max_batches = max_batches
+        # 'snippets' and 'users' deleted, in how many 'batches'
+        self.stats = Counter()
+
+    def out_of_batches(self):
+        return self.max_batches is not None and self.stats['batches'] >= self.max_batches
+
+    def purge_snippets(self, queryset):
+        """
+        Delete the snippets in `queryset` a batch at a time, returning whether all of them are gone.
+        """
+        last = 0
+        while not self.out_of_batches():
+            if self.stats['batches']:
+                time.sleep(self.pause)
+            # keyset pagination: each batch starts past the last one, never rescanning what was deleted
+            pks = list(queryset.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+            if not pks:
+                return True
+            with transaction.atomic():
+                batch = Snippet.objects.filter(pk__in=pks)
+                # A user's snippets were uncounted when the user was scheduled for deletion: flagged as deleted, the
+                # pre_delete handler knows that from the one column loaded, and the bodies are never read.
+                batch.filter(deleted=False).update(deleted=True)
+                batch.only('deleted').delete()
+            if raw_store is not None:
+                for pk in pks:
+                    raw_store.remove(pk)
+            self.stats['snippets'] += len(pks)
+            self.stats['batches'] += 1
+            last = pks[-1]
+        return False
+
+    def purge_user(self, user_id):
+        if not self.purge_snippets(Snippet.objects.filter(owner_id=user_id)):
+            return False
+        with transaction.atomic():
+            # anything left to cascade to is small: the user's stats rows and the deletion mark
+            User.objects.filter(pk=user_id).delete()
+        self.stats['users'] += 1
+        return True
+
+    def run(self):
+        """
+        Purge until nothing is left or `max_batches` have been deleted, returning the stats.
+        """
+        if self.purge_snippets(Snippet.objects.filter(deleted=True)):
+            for user_id in UserDeletion.objects.order_by('requested').values_list('user_id', flat=True):
+                if not self.purge_user(user_id):
+                    break
+        return self.stats
@@ -0,0 +1,111 @@
+"""
+Serving snippet code as plain text from `/snippets/<pk>/raw`.
+
+By default the code is sent from the database row. With `SNIPPETS_RAW_STORE_DIR` set every snippet body is also
+written to a file there, named after the snippet's pk and version so a file is never served for the wrong version,
+and full responses are handed to the web server instead of being copied through Python:
+
+- 'sendfile' returns a FileResponse, which WSGI servers with a `wsgi.file_wrapper` (gunicorn, uWSGI) send with
+  `sendfile(2)`.
+- 'x-accel-redirect' returns an empty response with an `X-Accel-Redirect` header; nginx must serve
+  `SNIPPETS_RAW_ACCEL_PREFIX` from the store directory as an `internal` location, and takes care of ranges itself.
+
+Files are written on save and, for snippets saved before the store was turned on, the first time they are requested.
+"""
+import os
+import tempfile
+
+from django.conf import settings
+
+RAW_STORE_DIR = getattr(settings, 'SNIPPETS_RAW_STORE_DIR', None)
+RAW_SERVE_MODE = getattr(settings, 'SNIPPETS_RAW_SERVE_MODE', 'sendfile')
+RAW_ACCEL_PREFIX = getattr(settings, 'SNIPPETS_RAW_ACCEL_PREFIX', '/_raw/')
+
+# spread files over this many subdirectories, so none of them grows huge
+FANOUT = 1000
+
+
+def parse_byte_range(header, size):
+    """
+    Parse a `Range` header against a body of `size` bytes.
+
+    Returns None to send the whole body (no header, one we don't handle or several ranges, which we're allowed to
+    ignore), `(start, end)` with `end` exclusive for a satisfiable single range, or `()` when it can't be satisfied.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, dash, last = spec.strip().partition('-')
+    try:
+        if not dash:
+            return None
+        if not first:
+            # a suffix range: the last `last` bytes
+            length = int(last)
+            if length <= 0:
+                return ()
+            return max(size - length, 0), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        return ()
+    return start, min(end, size)
+
+
+class RawStore:
+    """
+    Snippet bodies on disk, one UTF-8 file per snippet version.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def relative_path(self, pk, version):
+        return os.path.join(str(pk % FANOUT), '%d-%d.txt' % (pk, version))
+
+    def path(self, pk, version):
+        return os.path.join(self.root, self.relative_path(pk, version))
+
+    def write(self, pk, version, code):
+        """
+        Store `code` for this version of the snippet and remove the files of older versions.
+        """
+        path = self.path(pk, version)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # write then rename, so a request never sees a half-written file
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as out:
+            out.write(code.encode('utf-8'))
+        os.replace(tmp, path)
+        self.remove(pk, keep=path)
+        return path
+
+    def remove(self, pk, keep=None):
+        directory = os.path.join(self.root, str(pk % FANOUT))
+        prefix = '%d-' % pk
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            if name.startswith(prefix) and name.endswith('.txt') and path != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def ensure(self, snippet):
+        """
+        Return the path of the file for `snippet`'s current version, writing it if it isn't there yet.
+        """
+        path = self.path(snippet.pk, snippet.version)
+        if not os.path.exists(path):
+            self.write(snippet.pk, snippet.version, snippet.code)
+        return path
+
+
+raw_store = RawStore(RAW_STORE_DIR) if RAW_STORE_DIR else None
@@ -0,0 +1,69 @@
+"""
+A browsable API renderer that doesn't rebuild the same HTML forms on every page view.
+
+DRF's BrowsableAPIRenderer renders the POST and PUT forms from scratch for every page, and for snippets that means
+`<select>` elements with an option per pygments lexer and style, several hundred in all. The form for a given view,
+method and object never changes between requests, so CachedBrowsableAPIRenderer keeps the rendered fragments in a
+per-process LRU keyed by view, method, the user's login state, the active language and, for forms bound to an object,
+its pk and version; a snippet edit bumps the version, so an outdated form is never shown. Whether the user may see a
+form at all is still checked on every request, and forms redisplaying submitted data and errors aren't cached.
+"""
+from django.conf import settings
+from django.core.paginator import Page
+from django.utils.translation import get_language
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.request import override_method
+
+from .highlighting import RenderCache
+
+BROWSABLE_FORM_CACHE_SIZE = getattr(settings, 'SNIPPETS_BROWSABLE_FORM_CACHE_SIZE', 256)
+
+form_cache = RenderCache(BROWSABLE_FORM_CACHE_SIZE, 16 * 1024 * 1024)
+
+
+class CachedBrowsableAPIRenderer(BrowsableAPIRenderer):
+
+    def get_form_instance(self, data):
+        """
+        The object a form would be bound to, as DRF's renderer works it out.
+        """
+        serializer = getattr(data, 'serializer', None)
+        if not serializer or getattr(serializer, 'many', False):
+            return None
+        instance = getattr(serializer, 'instance', None)
+        return None if isinstance(instance, Page) else instance
+
+    def get_form_cache_key(self, data, view, method, request, instance):
+        """
+        Return the key to cache the `method` form under, or None when it mustn't be cached.
+        """
+        if request.method == method and getattr(data, 'serializer', None) is not None:
+            # redisplaying what was submitted, errors and all
+            return None
+        bound = None
+        if instance is not None and method in ('PUT', 'PATCH'):
+            version = getattr(instance, 'version', None)
+            if version is None:
+                return None
+            bound = (type(instance).__name__, instance.pk, version)
+        return (type(view).__module__, type(view).__qualname__, method, request.user.is_authenticated,
+                get_language(), bound)
+
+    def get_rendered_html_form(self, data, view, method, request):
+        instance = self.get_form_instance(data)
+        key = None
+        if BROWSABLE_FORM_CACHE_SIZE and method not in ('DELETE', 'OPTIONS'):
+            key = self.get_form_cache_key(data, view, method, request, instance)
+        if key is None:
+            return super(CachedBrowsableAPIRenderer, self).get_rendered_html_form(data, view, method, request)
+        with override_method(view, request, method) as overridden:
+            # permissions are per request, even when the form isn't
+            if not self.show_form_for_method(view, method, overridden, instance):
+                return None
+        form = form_cache.get(key)
+        if form is None:
+            form = super(CachedBrowsableAPIRenderer, self).get_rendered_html_form(data, view, method, request)
+            if form is None:
+                return None
+            form_cache.set(key, form, len(form))
+        return form
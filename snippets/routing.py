@@ -0,0 +1,99 @@
+"""
+Reading from replicas.
+
+With `SNIPPETS_READ_REPLICAS` set to `{alias: weight}`, each GET, HEAD or OPTIONS request reads from one of those
+`DATABASES` aliases, picked at random in proportion to its weight, while writes and every other request use
+'default'. Replication lags, so a client that has just written would not see its own change on a replica: any
+request that may have written sets a cookie pinning that client to the primary for `SNIPPETS_REPLICA_PIN_SECONDS`.
+
+ReplicaRoutingMiddleware picks the database for a request and ReplicaRouter applies it; code running outside a
+request, such as management commands and the view counter's flush thread, always uses 'default'.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+READ_REPLICAS = getattr(settings, 'SNIPPETS_READ_REPLICAS', {})
+REPLICA_PIN_SECONDS = getattr(settings, 'SNIPPETS_REPLICA_PIN_SECONDS', 5.0)
+PIN_COOKIE = 'snippets_primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = threading.local()
+
+
+def choose_replica(replicas=None, rng=random):
+    """
+    Pick one of `replicas` (`{alias: weight}`, READ_REPLICAS by default) by weight, or None if there are none.
+    """
+    replicas = READ_REPLICAS if replicas is None else replicas
+    if not replicas:
+        return None
+    aliases = sorted(replicas)
+    return rng.choices(aliases, [replicas[alias] for alias in aliases])[0]
+
+
+@contextmanager
+def read_from(alias):
+    """
+    Send the reads made in this thread during the block to `alias`, or to 'default' for None.
+    """
+    previous = getattr(_state, 'alias', None)
+    _state.alias = alias
+    try:
+        yield
+    finally:
+        _state.alias = previous
+
+
+def current_alias():
+    """
+    The database this thread's reads go to, None meaning 'default'.
+    """
+    return getattr(_state, 'alias', None)
+
+
+def pinned_to_primary(request, now=None):
+    try:
+        until = float(request.COOKIES.get(PIN_COOKIE, 0))
+    except ValueError:
+        return False
+    return until > (time.time() if now is None else now)
+
+
+class ReplicaRouter:
+    """
+    Reads go where the current request's `read_from()` says; writes always go to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        return current_alias()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Reads safe requests from a replica unless the client wrote recently, and pins clients that write.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        safe = request.method in SAFE_METHODS
+        alias = choose_replica() if safe and not pinned_to_primary(request) else None
+        with read_from(alias):
+            response = self.get_response(request)
+        if not safe and response.status_code < 400 and READ_REPLICAS:
+            response.set_cookie(PIN_COOKIE, '%.3f' % (time.time() + REPLICA_PIN_SECONDS),
+                                max_age=int(REPLICA_PIN_SECONDS) + 1, httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,145 @@
+"""
+A sandboxed executor for highlight renders.
+
+Some pygments lexers can spend seconds on pathological input, and a render made inside the request would block the
+worker serving it. Renders therefore run in a small pool of worker processes, each one held to a CPU-time budget.
+A render that goes over its budget (or takes the worker down with it) raises RenderLimitExceeded in the caller, and
+the language and size of the offending snippet are recorded so we can see which combinations hit the limits.
+"""
+import logging
+import multiprocessing
+import resource
+import signal
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SANDBOX_ENABLED = getattr(settings, 'SNIPPETS_SANDBOX_ENABLED', True)
+SANDBOX_WORKERS = getattr(settings, 'SNIPPETS_SANDBOX_WORKERS', 2)
+SANDBOX_CPU_SECONDS = getattr(settings, 'SNIPPETS_SANDBOX_CPU_SECONDS', 2.0)
+# wall-clock backstop for renders stuck where the CPU timer can't interrupt them
+SANDBOX_WALL_SECONDS = getattr(settings, 'SNIPPETS_SANDBOX_WALL_SECONDS', 5.0)
+SANDBOX_MAX_OUTPUT = getattr(settings, 'SNIPPETS_SANDBOX_MAX_OUTPUT', 16 * 1024 * 1024)
+SANDBOX_MEMORY_BYTES = getattr(settings, 'SNIPPETS_SANDBOX_MEMORY_BYTES', 1024 * 1024 * 1024)
+
+# (language, size bucket) -> number of renders that went over a limit
+limit_hits = Counter()
+
+
+class RenderLimitExceeded(Exception):
+    """
+    Raised when a render would go over its size or time budget.
+    """
+
+
+def size_bucket(nbytes):
+    """
+    Round a snippet size up to a power-of-two bucket label such as '64KiB', to group limit hits by size.
+    """
+    kib = 1
+    while kib * 1024 < nbytes:
+        kib *= 2
+    return '%dKiB' % kib
+
+
+def record_limit_hit(language, code, reason):
+    nbytes = len(code.encode('utf-8'))
+    limit_hits[(language, size_bucket(nbytes))] += 1
+    logger.warning('Highlight limit hit rendering %d bytes of %s: %s', nbytes, language, reason)
+
+
+def _init_worker(memory_bytes):
+    if memory_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+
+def _cpu_expired(signum, frame):
+    raise RenderLimitExceeded('Rendering used more than the allowed CPU time.')
+
+
+def _run_limited(cpu_seconds, max_output, func, args, kwargs):
+    # Runs in the worker. ITIMER_PROF counts CPU time of this process and interrupts Python code cleanly; the
+    # RLIMIT_CPU set just above it is the hard stop for time spent inside a single C call such as a regex match.
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    resource.setrlimit(resource.RLIMIT_CPU, (int(used + cpu_seconds) + 2, hard))
+    signal.signal(signal.SIGPROF, _cpu_expired)
+    signal.setitimer(signal.ITIMER_PROF, cpu_seconds)
+    try:
+        return func(*args, max_output=max_output, **kwargs)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+class HighlightSandbox:
+    """
+    Runs render functions in worker processes with CPU-time, wall-time, output-size and memory limits.
+
+    The render function must accept a `max_output` keyword argument. When the sandbox is disabled renders run
+    in-process with only the output limit applied.
+    """
+
+    def __init__(self, enabled=SANDBOX_ENABLED, workers=SANDBOX_WORKERS, cpu_seconds=SANDBOX_CPU_SECONDS,
+                 wall_seconds=SANDBOX_WALL_SECONDS, max_output=SANDBOX_MAX_OUTPUT,
+                 memory_bytes=SANDBOX_MEMORY_BYTES):
+        self.enabled = enabled
+        self.workers = workers
+        self.cpu_seconds = cpu_seconds
+        self.wall_seconds = wall_seconds
+        self.max_output = max_output
+        self.memory_bytes = memory_bytes
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # forkserver keeps workers from inheriting the parent's database connections and threads
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('forkserver'),
+                    initializer=_init_worker,
+                    initargs=(self.memory_bytes,),
+                )
+            return self._pool
+
+    def _discard_pool(self, pool):
+        # a worker is stuck or dead; kill the whole pool and let the next render start a fresh one
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        for process in list(getattr(pool, '_processes', {}).values()):
+            process.kill()
+        pool.shutdown(wait=False)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call `func(*args, **kwargs)` within the limits, raising RenderLimitExceeded if any of them is hit.
+        """
+        if not self.enabled:
+            return func(*args, max_output=self.max_output, **kwargs)
+        pool = self._get_pool()
+        future = pool.submit(_run_limited, self.cpu_seconds, self.max_output, func, args, kwargs)
+        try:
+            return future.result(timeout=self.wall_seconds)
+        except TimeoutError:
+            self._discard_pool(pool)
+            raise RenderLimitExceeded('Rendering took longer than the allowed time.')
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            raise RenderLimitExceeded('The render worker was killed, most likely for going over a resource limit.')
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+sandbox = HighlightSandbox()
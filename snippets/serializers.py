@@ -3,8 +3,15 @@ The first thing we need to get started on our Web API is to provide a way of ser
 snippet instances into representations such as 'json'. We can do this by declaring serializers that work very similar
 to Django's forms. Create a file in the snippets directory named serializers.py
 """
+import copy
+from collections import OrderedDict
+
 from rest_framework import serializers
-from .models import Snippet, LANGUAGE_CHOICES, STYLE_CHOICES
+from rest_framework.fields import empty
+from .models import Snippet, LANGUAGE_CHOICES, LanguageStats, STYLE_CHOICES
+from .highlighting import OUTPUT_CHOICES
+from .lines import parse_line_range
+from .metrics import timed
 # importing auth model for user serializer
 from django.contrib.auth.models import User
 
@@ -263,7 +270,46 @@ We can easily re-write our existing serializers to use hyperlinking. In your sni
 """
 
 
-class SnippetSerializer(serializers.HyperlinkedModelSerializer):
+# built fields of the CachedFieldsMixin serializers, by class
+field_templates = {}
+
+
+class CachedFieldsMixin:
+    """
+    Builds a ModelSerializer's fields once per process rather than once per instance.
+
+    ModelSerializer introspects the model and constructs every field again for each serializer, `ChoiceField`s over
+    all of LANGUAGE_CHOICES and STYLE_CHOICES included. With this mixin each instance gets shallow copies of the fields
+    built the first time, which `bind()` then attaches to it as usual. The copies share their arguments, so only use
+    it on serializers whose fields don't wrap other fields (no `many=True` relations or nested serializers) and
+    don't depend on the context.
+    """
+    cache_fields = True
+
+    def get_fields(self):
+        if not self.cache_fields:
+            return super(CachedFieldsMixin, self).get_fields()
+        templates = field_templates.get(type(self))
+        if templates is None:
+            templates = field_templates.setdefault(type(self), super(CachedFieldsMixin, self).get_fields())
+        return OrderedDict((name, copy.copy(field)) for name, field in templates.items())
+
+
+class TimedMixin:
+    """
+    Counts the time spent serializing objects and validating input towards the request's serializer metrics.
+    """
+
+    def to_representation(self, instance):
+        with timed('serializer'):
+            return super(TimedMixin, self).to_representation(instance)
+
+    def run_validation(self, data=empty):
+        with timed('serializer'):
+            return super(TimedMixin, self).run_validation(data)
+
+
+class SnippetSerializer(TimedMixin, CachedFieldsMixin, serializers.HyperlinkedModelSerializer):
     owner = serializers.ReadOnlyField(source='owner.username')
     highlight = serializers.HyperlinkedIdentityField(view_name='snippet-highlight', format='html')
 
@@ -272,7 +318,80 @@ class SnippetSerializer(serializers.HyperlinkedModelSerializer):
         fields = ['url', 'id', 'highlight', 'owner', 'title', 'code', 'linenos', 'language', 'style']
 
 
-class UserSerializer(serializers.HyperlinkedModelSerializer):
+class RawSnippetSerializer(TimedMixin, CachedFieldsMixin, serializers.HyperlinkedModelSerializer):
+    """
+    A snippet without its code, for raw uploads: the metadata comes from the query string or `X-Snippet-*` headers
+    and the code from the request body.
+    """
+    owner = serializers.ReadOnlyField(source='owner.username')
+    highlight = serializers.HyperlinkedIdentityField(view_name='snippet-highlight', format='html')
+    raw = serializers.HyperlinkedIdentityField(view_name='snippet-raw')
+
+    class Meta:
+        model = Snippet
+        fields = ['url', 'id', 'highlight', 'raw', 'owner', 'title', 'linenos', 'language', 'style']
+
+    @classmethod
+    def metadata(cls, request):
+        """
+        Collect the metadata fields sent with a raw upload, query parameters winning over headers.
+        """
+        data = {}
+        for name in ('title', 'linenos', 'language', 'style'):
+            header = 'HTTP_X_SNIPPET_%s' % name.upper()
+            if name in request.query_params:
+                data[name] = request.query_params[name]
+            elif header in request.META:
+                data[name] = request.META[header]
+        return data
+
+
+class PopularSnippetSerializer(TimedMixin, serializers.HyperlinkedModelSerializer):
+    """
+    A snippet in the popular list: no code, but how many times it has been viewed.
+    """
+    owner = serializers.ReadOnlyField(source='owner.username')
+    highlight = serializers.HyperlinkedIdentityField(view_name='snippet-highlight', format='html')
+    views = serializers.IntegerField(source='view_count', read_only=True)
+
+    class Meta:
+        model = Snippet
+        fields = ['url', 'id', 'highlight', 'owner', 'title', 'language', 'views']
+
+
+class LineRangeSerializer(serializers.Serializer):
+    """
+    The `?lines=a-b` query parameter, for fetching part of a snippet. `a-` runs to the end and `a` is a single line.
+    """
+    lines = serializers.CharField(required=False)
+
+    def validate_lines(self, value):
+        try:
+            return parse_line_range(value)
+        except ValueError:
+            raise serializers.ValidationError('Expected a line range such as 10-20, 10- or 10.')
+
+
+class HighlightOptionsSerializer(serializers.Serializer):
+    """
+    Query parameters accepted by the highlight endpoint to render a snippet with another style or format.
+    """
+    style = serializers.ChoiceField(choices=STYLE_CHOICES, required=False)
+    linenos = serializers.BooleanField(required=False)
+    output = serializers.ChoiceField(choices=OUTPUT_CHOICES, required=False)
+
+
+class LanguageStatsSerializer(TimedMixin, serializers.ModelSerializer):
+    """
+    One language's line in a stats response, from either LanguageStats or UserLanguageStats.
+    """
+
+    class Meta:
+        model = LanguageStats
+        fields = ['language', 'snippets', 'code_bytes']
+
+
+class UserSerializer(TimedMixin, serializers.HyperlinkedModelSerializer):
     snippets = serializers.HyperlinkedIdentityField(many=True, view_name='snippet-detail', read_only=True)
 
     class Meta:
@@ -0,0 +1,91 @@
+"""
+Snippet counts and code size per language, overall and per user.
+
+Counting a user's snippets by language means reading every one of them. Instead the totals are kept in
+UserLanguageStats and LanguageStats and adjusted as snippets are created, changed and deleted (see Snippet.save and
+the pre_delete handler in models.py), so `/users/<pk>/stats/` and `/snippets/stats/` read one row per language.
+
+Writes that skip the model, like `bulk_create` and `QuerySet.update`, aren't counted; `manage.py refresh_stats`
+recomputes the tables from the snippets after those.
+"""
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import BigIntegerField, Count, F, Func, Sum
+
+from .archive import get_archive_store
+
+
+class OctetLength(Func):
+    """
+    The size of a text column in bytes, as stored in `code_bytes`.
+    """
+    function = 'OCTET_LENGTH'
+    output_field = BigIntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # SQLite has no OCTET_LENGTH, but the length of a text cast to a blob is its size in bytes
+        return self.as_sql(compiler, connection, template='LENGTH(CAST(%(expressions)s AS BLOB))', **extra_context)
+
+
+def code_size(code):
+    return len(code.encode('utf-8'))
+
+
+def add_to_row(model, lookup, snippets, code_bytes):
+    """
+    Add `snippets` and `code_bytes` to the stats row of `model` matching `lookup`, creating it for positive counts.
+    """
+    changes = {'snippets': F('snippets') + snippets, 'code_bytes': F('code_bytes') + code_bytes}
+    if model.objects.filter(**lookup).update(**changes) or snippets <= 0:
+        # a removal never creates a row: its owner may be being deleted along with it
+        return
+    model.objects.get_or_create(**lookup)
+    model.objects.filter(**lookup).update(**changes)
+
+
+def insert_batch_size(connection, model, rows, limit=1000):
+    # this Django takes an explicit batch size as is, even past what the backend accepts in one statement (SQLite)
+    return min(limit, max(connection.ops.bulk_batch_size(model._meta.concrete_fields, list(rows)), 1))
+
+
+def rebuild_stats(using=DEFAULT_DB_ALIAS):
+    """
+    Recompute UserLanguageStats and LanguageStats from the snippets in database `using`, returning how many rows were
+    written.
+    """
+    Snippet = apps.get_model('snippets', 'Snippet')
+    UserLanguageStats = apps.get_model('snippets', 'UserLanguageStats')
+    LanguageStats = apps.get_model('snippets', 'LanguageStats')
+    connection = connections[using]
+    with transaction.atomic(using=using):
+        if connection.vendor == 'postgresql':
+            # hold off snippet writes until the new totals are in, or their changes would be lost
+            with connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE %s IN SHARE MODE' % connection.ops.quote_name(Snippet._meta.db_table))
+        # deleted snippets, and those of users being deleted, were uncounted when they were hidden
+        snippets = Snippet.objects.using(using).live().order_by()
+        # archived snippets have blank code in the table; their sizes are in the archive index
+        archived = snippets.filter(archive_segment__isnull=False)
+        snippets = snippets.filter(archive_segment__isnull=True)
+        totals = {}
+        for owner_id, language, count, code_bytes in (snippets.values_list('owner_id', 'language').annotate(
+                snippets=Count('pk'), code_bytes=Sum(OctetLength('code')))):
+            totals[owner_id, language] = [count, code_bytes]
+        for owner_id, language, pk, segment in archived.values_list('owner_id', 'language', 'pk', 'archive_segment'):
+            row = totals.setdefault((owner_id, language), [0, 0])
+            row[0] += 1
+            row[1] += get_archive_store().code_size(segment, pk)
+        per_user, per_language = [], {}
+        for (owner_id, language), (count, code_bytes) in totals.items():
+            per_user.append(UserLanguageStats(owner_id=owner_id, language=language, snippets=count,
+                                              code_bytes=code_bytes))
+            language_totals = per_language.setdefault(language, LanguageStats(language=language))
+            language_totals.snippets += count
+            language_totals.code_bytes += code_bytes
+        UserLanguageStats.objects.using(using).all().delete()
+        LanguageStats.objects.using(using).all().delete()
+        UserLanguageStats.objects.using(using).bulk_create(
+            per_user, batch_size=insert_batch_size(connection, UserLanguageStats, per_user))
+        LanguageStats.objects.using(using).bulk_create(
+            per_language.values(), batch_size=insert_batch_size(connection, LanguageStats, per_language))
+    return len(per_user) + len(per_language)
@@ -1,3 +1,1306 @@
-from django.test import TestCase
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.test import Client, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from pygments import highlight
+from pygments.lexers import get_lexer_by_name
+
+from . import counters
+from .archive import ArchiveStore
+from .coalesce import FileLock
+from .compression import preferred_encoding
+from .counters import ViewCounter
+from .highlighting import (
+    get_formatter, get_output_formatter, plain_html, render_cache, render_counts, render_html, render_on_demand,
+    render_stored, render_tokens, render_with_state,
+)
+from .management.commands.loadtest import parse_mix, percentile
+from .management.commands.rehighlight import Command as RehighlightCommand
+from .models import STYLE_CHOICES, LanguageStats, Snippet, SnippetViews, UserDeletion, UserLanguageStats
+from .metadata import serializer_info_cache
+from .metrics import Registry, exposition, parse_networks, registry
+from .partitions import LEGACY_TABLE, add_months, maintain_partitions
+from .profiling import Profiler, make_token, valid_token
+from .purge import Purger
+from .routing import PIN_COOKIE, choose_replica
+from .raw import RawStore
+from .renderers import form_cache
+from .sandbox import HighlightSandbox, RenderLimitExceeded, limit_hits, sandbox, size_bucket
+from .serializers import SnippetSerializer, field_templates
+from .tokens import TokenStream
+from .views import SnippetDetail, object_flight
+from .warmup import child_pids, process_memory, warm_up
 
 # Create your tests here.
+
+
+def setUpModule():
+    # Views viewed during the tests are counted by a counter of their own that never flushes by itself: the global
+    # one would start its flush thread and flush again at exit, against a test database dropped by then.
+    patcher = mock.patch('snippets.views.view_counter', ViewCounter(background=False))
+    patcher.start()
+    unittest.addModuleCleanup(patcher.stop)
+
+
+class InProcessRendersMixin:
+    """
+    Renders run in the test process, without the sandbox's worker pool; SandboxTests cover the sandbox itself.
+    """
+
+    def setUp(self):
+        super(InProcessRendersMixin, self).setUp()
+        self.addCleanup(setattr, sandbox, 'enabled', sandbox.enabled)
+        sandbox.enabled = False
+
+
+class CompressionTests(InProcessRendersMixin, TestCase):
+
+    def test_preferred_encoding(self):
+        both = {'gzip', 'br'}
+        self.assertIsNone(preferred_encoding('', both))
+        self.assertEqual(preferred_encoding('gzip, deflate, br', both), 'br')
+        self.assertEqual(preferred_encoding('br;q=0.5, gzip;q=0.8', both), 'gzip')
+        self.assertEqual(preferred_encoding('br, gzip', {'gzip'}), 'gzip')
+        self.assertIsNone(preferred_encoding('gzip;q=0, br;q=0', both))
+        self.assertIsNone(preferred_encoding('deflate', both))
+        # identity preferred over a variant the client only tolerates, but not over one it rates as highly
+        self.assertIsNone(preferred_encoding('identity;q=1, gzip;q=0.5', both))
+        self.assertEqual(preferred_encoding('identity, gzip', {'gzip'}), 'gzip')
+        self.assertEqual(preferred_encoding('*', both), 'br')
+        self.assertEqual(preferred_encoding('*;q=0.3, br;q=0', both), 'gzip')
+        self.assertEqual(preferred_encoding('GZIP;Q=0.9', both), 'gzip')
+
+    def test_highlight_served_precompressed(self):
+        snippet = Snippet.objects.create(owner=User.objects.create(username='owner'), code='print(1)\n')
+        url = '/snippets/%d/highlight/' % snippet.pk
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response.content, bytes(snippet.highlighted_gzip))
+        self.assertEqual(gzip.decompress(response.content).decode('utf-8'), snippet.highlighted)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        plain = self.client.get(url, HTTP_ACCEPT_ENCODING='identity')
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(plain.content.decode('utf-8'), snippet.highlighted)
+        self.assertIn('Accept-Encoding', plain['Vary'])
+
+
+class OnDemandHighlightTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(OnDemandHighlightTests, self).setUp()
+        render_cache.clear()
+        caches['default'].clear()
+        self.snippet = Snippet.objects.create(owner=User.objects.create(username='owner'), code='print(1)\n')
+        self.url = '/snippets/%d/highlight/' % self.snippet.pk
+
+    def test_style_and_linenos(self):
+        for query, style, linenos in (('?style=monokai', 'monokai', False), ('?linenos=true', 'friendly', True),
+                                      ('?style=monokai&linenos=true', 'monokai', True)):
+            response = self.client.get(self.url + query)
+            self.assertEqual(response.content.decode('utf-8'),
+                             render_html(self.snippet.code, 'python', style, linenos), query)
+        self.assertEqual(self.client.get(self.url + '?style=nonsense').status_code, 400)
+
+    def test_snippet_with_line_numbers(self):
+        snippet = Snippet.objects.create(owner=self.snippet.owner, code='print(1)\n', linenos=True)
+        url = '/snippets/%d/highlight/' % snippet.pk
+        with mock.patch('snippets.views.render_on_demand') as render:
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(response.content).decode('utf-8'), snippet.highlighted)
+            self.assertEqual(self.client.get(url).content.decode('utf-8'), snippet.highlighted)
+        render.assert_not_called()
+        self.assertEqual(self.client.get(url + '?style=monokai').content.decode('utf-8'),
+                         render_html(snippet.code, 'python', 'monokai', True))
+        self.assertEqual(self.client.get(url + '?linenos=false').content.decode('utf-8'),
+                         render_html(snippet.code, 'python', 'friendly', False))
+
+    def test_cached_until_the_snippet_changes(self):
+        with mock.patch('snippets.highlighting.render_tokens', wraps=render_tokens) as render:
+            first = self.client.get(self.url + '?style=monokai').content
+            self.assertEqual(self.client.get(self.url + '?style=monokai').content, first)
+            self.assertEqual(render.call_count, 1)
+            self.snippet.code = 'print(2)\n'
+            self.snippet.save()
+            second = self.client.get(self.url + '?style=monokai').content
+        self.assertEqual(render.call_count, 2)
+        self.assertIn('2', second.decode('utf-8'))
+        self.assertNotEqual(second, first)
+
+    def test_too_large_to_render_on_demand(self):
+        with mock.patch('snippets.highlighting.ON_DEMAND_MAX_CODE_BYTES', 4), \
+                self.assertLogs('snippets.sandbox', 'WARNING'):
+            response = self.client.get(self.url + '?style=monokai')
+        self.assertEqual(response.status_code, 422)
+        # the stored render is still served
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+
+INCREMENTAL_SAMPLES = {
+    'python': 'def f(x):\n    """doc\n    string"""\n    return x + 1  # add\n\ns = \'a\\\nb\'\n' * 8,
+    'javascript': 'var a = `x\n${1}\n`; /* block\n comment */ "s"\n' * 8,
+    'html': '<html><script>\nvar x = 1;\n</script><style>\na {}\n</style>\n<!-- c\n -->\n' * 6,
+}
+INCREMENTAL_FRAGMENTS = ['"""', '"', "'", '/*', '*/', '\n', '#', '<!--', '-->', '`', '{', '}', '(', ')', 'x = 1\n',
+                         '<script>', '</script>', '\\', '\t']
+
+
+class IncrementalHighlightTests(SimpleTestCase):
+    """
+    Re-highlighting an edit incrementally must give exactly the document a full render would.
+    """
+
+    def check_random_edits(self, language, style, linenos, title, edits=60):
+        rng = random.Random('%s-%s-%s' % (language, style, linenos))
+        code = INCREMENTAL_SAMPLES[language]
+        html, state, tokens, _ = render_with_state(code, language, style, linenos, title)
+        for edit in range(edits):
+            start = rng.randrange(len(code) + 1)
+            end = min(len(code), start + rng.choice([0, 0, 1, 5, 40]))
+            inserted = ''.join(rng.choice(INCREMENTAL_FRAGMENTS) for _ in range(rng.choice([0, 1, 2])))
+            new_code = code[:start] + inserted + code[end:]
+            new_html, new_state, new_tokens, lines = render_with_state(new_code, language, style, linenos, title,
+                                                                       previous=(code, html, state, tokens))
+            expected = highlight(new_code, get_lexer_by_name(language), get_formatter(style, linenos, title))
+            self.assertEqual(new_html, expected, 'edit %d of %s differs from a full render' % (edit, language))
+            full = render_with_state(new_code, language, style, linenos, title)
+            self.assertEqual((new_state, new_tokens, lines), full[1:])
+            code, html, state, tokens = new_code, new_html, new_state, new_tokens
+
+    def test_random_edits(self):
+        for language in INCREMENTAL_SAMPLES:
+            with self.subTest(language=language):
+                self.check_random_edits(language, 'friendly', False, '')
+
+    def test_random_edits_with_options(self):
+        self.check_random_edits('python', 'monokai', True, 'A title')
+
+
+class TokenStreamTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        code = 'def f(x):\n\treturn x  # tab\r\n'
+        lexer = get_lexer_by_name('python')
+        stream = TokenStream.from_tokens(list(lexer.get_tokens(code)))
+        self.assertEqual(TokenStream.decode(stream.encode(code), code), stream)
+        self.assertEqual(''.join(value for _, value in stream), stream.text)
+
+    def test_render_tokens_matches_highlight(self):
+        code = INCREMENTAL_SAMPLES['python']
+        lexer = get_lexer_by_name('python')
+        tokens = render_with_state(code, 'python', 'friendly', False).tokens
+        for style, linenos in [('monokai', False), ('emacs', True)]:
+            self.assertEqual(render_tokens(tokens, code, style, linenos),
+                             highlight(code, lexer, get_formatter(style, linenos)))
+        # runs of same-type tokens are merged in storage, so only the escape codes between them can differ
+        ansi = render_tokens(tokens, code, 'monokai', False, output='ansi')
+        self.assertEqual(re.sub('\x1b\\[[0-9;]*m', '', ansi), code)
+        self.assertIn('\x1b[38;5;', ansi)
+
+
+class SandboxTests(SimpleTestCase):
+    """
+    Renders going over the sandbox's limits, with real worker processes.
+    """
+    # enough lexing to take well over the limits below
+    SLOW_CODE = 'value = compute(1, "two", [3.0])  # comment\n' * 20000
+
+    def make_sandbox(self, **limits):
+        limited = HighlightSandbox(enabled=True, workers=1, **limits)
+        self.addCleanup(limited.shutdown)
+        return limited
+
+    def test_cpu_limit_falls_back_to_plain_text(self):
+        limited = self.make_sandbox(cpu_seconds=0.5, wall_seconds=30)
+        self.assertEqual(limited.run(render_with_state, 'x = 1\n', 'python', 'friendly', False).html,
+                         render_with_state('x = 1\n', 'python', 'friendly', False).html)
+        self.addCleanup(limit_hits.clear)
+        limit_hits.clear()
+        with mock.patch('snippets.highlighting.sandbox', limited), self.assertLogs('snippets.sandbox', 'WARNING'):
+            render = render_stored(self.SLOW_CODE, 'python', 'friendly', False)
+        self.assertEqual(render.html, plain_html(self.SLOW_CODE))
+        self.assertEqual((render.state, render.tokens), (b'', b''))
+        self.assertEqual(limit_hits, {('python', size_bucket(len(self.SLOW_CODE))): 1})
+
+    def test_wall_clock_limit(self):
+        limited = self.make_sandbox(cpu_seconds=60, wall_seconds=0.2)
+        with self.assertRaisesRegex(RenderLimitExceeded, 'longer than the allowed time'):
+            limited.run(render_with_state, self.SLOW_CODE, 'python', 'friendly', False)
+        # the stuck pool was replaced; give the new one time to start
+        limited.wall_seconds = 30
+        self.assertIn('<pre', limited.run(render_with_state, 'x = 1\n', 'python', 'friendly', False).html)
+
+    def test_killed_worker(self):
+        limited = self.make_sandbox(cpu_seconds=60, wall_seconds=60)
+        pool = limited._get_pool()
+
+        def kill_workers():
+            while not pool._processes:
+                time.sleep(0.01)
+            for process in list(pool._processes.values()):
+                process.kill()
+
+        killer = threading.Thread(target=kill_workers)
+        killer.start()
+        with self.assertRaisesRegex(RenderLimitExceeded, 'worker was killed'):
+            limited.run(render_with_state, self.SLOW_CODE, 'python', 'friendly', False)
+        killer.join()
+
+
+class SnippetIncrementalSaveTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(SnippetIncrementalSaveTests, self).setUp()
+        self.owner = User.objects.create(username='owner')
+
+    def test_code_edit_matches_full_render(self):
+        snippet = Snippet.objects.create(owner=self.owner, code=INCREMENTAL_SAMPLES['python'])
+        self.assertTrue(snippet.highlight_state)
+        snippet = Snippet.objects.get(pk=snippet.pk)
+        snippet.code = snippet.code.replace('return x + 1', 'return """x', 1)
+        self.assertIsNotNone(snippet._previous_render())
+        snippet.save()
+        expected = highlight(snippet.code, get_lexer_by_name('python'), get_formatter('friendly', False))
+        self.assertEqual(Snippet.objects.get(pk=snippet.pk).highlighted, expected)
+
+
+class SnippetRenderSkipTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(SnippetRenderSkipTests, self).setUp()
+        self.owner = User.objects.create(username='owner')
+        self.snippet = Snippet.objects.create(owner=self.owner, code='print(1)\n')
+        render_counts.clear()
+
+    def test_unchanged_inputs_skip_render(self):
+        snippet = Snippet.objects.get(pk=self.snippet.pk)
+        snippet.owner = User.objects.create(username='other')
+        snippet.save()
+        self.assertEqual(render_counts, {'skipped': 1})
+        self.assertEqual(Snippet.objects.get(pk=snippet.pk).version, self.snippet.version)
+
+    def test_concurrent_edits_get_versions_of_their_own(self):
+        first, second = Snippet.objects.get(pk=self.snippet.pk), Snippet.objects.get(pk=self.snippet.pk)
+        first.code = 'print(2)\n'
+        first.save()
+        second.code = 'print(3)\n'
+        second.save()
+        self.assertEqual((first.version, second.version), (self.snippet.version + 1, self.snippet.version + 2))
+        self.assertEqual(Snippet.objects.values_list('code', 'version').get(pk=self.snippet.pk),
+                         ('print(3)\n', second.version))
+
+    def test_stale_save_leaves_newer_code(self):
+        stale, fresh = Snippet.objects.get(pk=self.snippet.pk), Snippet.objects.get(pk=self.snippet.pk)
+        fresh.code = 'print(2)\n'
+        fresh.save()
+        stale.owner = User.objects.create(username='other')
+        stale.save()
+        row = Snippet.objects.get(pk=self.snippet.pk)
+        self.assertEqual((row.code, row.version, row.owner), ('print(2)\n', fresh.version, stale.owner))
+        self.assertIn('2', row.highlighted)
+
+    def test_changed_input_renders(self):
+        snippet = Snippet.objects.get(pk=self.snippet.pk)
+        snippet.title = 'Hello'
+        snippet.save()
+        self.assertEqual(render_counts, {'performed': 1})
+        self.assertIn('<title>Hello</title>', Snippet.objects.get(pk=snippet.pk).highlighted)
+
+    def test_update_fields_without_inputs_skip_render(self):
+        self.snippet.code = 'print(2)\n'
+        self.snippet.owner = User.objects.create(username='other')
+        self.snippet.save(update_fields=['owner'])
+        self.assertEqual(render_counts, {'skipped': 1})
+        self.assertEqual(Snippet.objects.get(pk=self.snippet.pk).code, 'print(1)\n')
+
+    def test_update_fields_with_inputs_save_render(self):
+        self.snippet.code = 'print(2)\n'
+        self.snippet.save(update_fields=['code'])
+        self.assertEqual(render_counts, {'performed': 1})
+        self.assertIn('2', Snippet.objects.get(pk=self.snippet.pk).highlighted)
+
+    def test_deferred_inputs_are_unchanged(self):
+        snippet = Snippet.objects.only('owner').get(pk=self.snippet.pk)
+        snippet.owner = User.objects.create(username='other')
+        snippet.save()
+        self.assertEqual(render_counts, {'skipped': 1})
+
+
+class RehighlightCommandTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(RehighlightCommandTests, self).setUp()
+        owner = User.objects.create(username='owner')
+        self.snippets = [Snippet.objects.create(owner=owner, code='print(%d)\n' % n, language=language)
+                         for n, language in enumerate(['python', 'python', 'javascript'])]
+        self.expected = {snippet.pk: snippet.highlighted for snippet in self.snippets}
+        Snippet.objects.update(highlighted='stale')
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.checkpoint))
+
+    def highlighted(self):
+        return dict(Snippet.objects.values_list('pk', 'highlighted'))
+
+    def test_rerenders_filtered_snippets(self):
+        call_command('rehighlight', language=['python'], workers=2, chunk_size=1, checkpoint=self.checkpoint,
+                     stdout=StringIO())
+        highlighted = self.highlighted()
+        self.assertEqual(highlighted[self.snippets[0].pk], self.expected[self.snippets[0].pk])
+        self.assertEqual(highlighted[self.snippets[1].pk], self.expected[self.snippets[1].pk])
+        self.assertEqual(highlighted[self.snippets[2].pk], 'stale')
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_default_checkpoint_in_checkpoint_dir(self):
+        directory = os.path.dirname(self.checkpoint)
+        with mock.patch('snippets.management.commands.rehighlight.CHECKPOINT_DIR', directory), \
+                mock.patch.object(RehighlightCommand, 'write_checkpoint', autospec=True,
+                                  side_effect=RehighlightCommand.write_checkpoint) as write:
+            call_command('rehighlight', chunk_size=1, stdout=StringIO())
+        paths = {call[0][1] for call in write.call_args_list}
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(os.path.dirname(paths.pop()), directory)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_resumes_after_checkpoint(self):
+        with open(self.checkpoint, 'w') as checkpoint:
+            json.dump({'filters': {'language': [], 'style': [], 'owner': []},
+                       'last_pk': self.snippets[1].pk, 'done': 2}, checkpoint)
+        call_command('rehighlight', checkpoint=self.checkpoint, stdout=StringIO())
+        highlighted = self.highlighted()
+        self.assertEqual(highlighted[self.snippets[0].pk], 'stale')
+        self.assertEqual(highlighted[self.snippets[2].pk], self.expected[self.snippets[2].pk])
+
+    def test_keeps_snippets_saved_while_rendering(self):
+        edited = self.snippets[0]
+
+        class InlineExecutor:
+            # render in this thread, so the test database sees the save made in the middle
+            def __init__(self, max_workers):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def map(self, func, rows):
+                results = [func(row) for row in rows]
+                edited.code = 'print("edited")\n'
+                edited.save()
+                return results
+
+        with mock.patch('snippets.management.commands.rehighlight.ThreadPoolExecutor', InlineExecutor):
+            call_command('rehighlight', checkpoint=self.checkpoint, stdout=StringIO())
+        snippet = Snippet.objects.get(pk=edited.pk)
+        self.assertEqual(snippet.version, edited.version)
+        self.assertIn('edited', snippet.highlighted)
+        self.assertEqual(self.highlighted()[self.snippets[1].pk], self.expected[self.snippets[1].pk])
+
+
+class LineRangeTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(LineRangeTests, self).setUp()
+        owner = User.objects.create(username='owner')
+        code = ''.join('value_%d = %d\n' % (n, n) for n in range(1, 51))
+        self.snippet = Snippet.objects.create(owner=owner, code=code, linenos=True)
+
+    def test_detail_slices_code(self):
+        response = self.client.get('/snippets/%d/?lines=10-12' % self.snippet.pk)
+        self.assertEqual(response.json()['code'], 'value_10 = 10\nvalue_11 = 11\nvalue_12 = 12\n')
+        self.assertEqual(response.json()['lines'], {'first': 10, 'last': 12, 'total': 50})
+
+    def test_highlight_slices_lines(self):
+        response = self.client.get('/snippets/%d/highlight/?lines=49-' % self.snippet.pk)
+        body = response.content.decode()
+        self.assertEqual(body.count('\n'), 2)
+        self.assertIn('value_49', body)
+        self.assertIn('value_50', body)
+        self.assertEqual((response['X-Line-Range'], response['X-Total-Lines']), ('49-50', '50'))
+
+    def test_stripped_lines_and_crlf_number_alike(self):
+        code = '\n\r\nfirst = 1\r\nsecond = 2\rthird = 3\r\n\n\n'
+        for language in ('python', 'php'):
+            snippet = Snippet.objects.create(owner=self.snippet.owner, code=code, language=language)
+            detail = self.client.get('/snippets/%d/?lines=3-4' % snippet.pk).json()
+            self.assertEqual(detail['code'], 'first = 1\r\nsecond = 2\r')
+            highlight = self.client.get('/snippets/%d/highlight/?lines=3-4' % snippet.pk)
+            body = highlight.content.decode()
+            self.assertEqual((body.count('\n'), 'first' in body, 'second' in body, 'third' in body),
+                             (2, True, True, False))
+            self.assertEqual((highlight['X-Line-Range'], highlight['X-Total-Lines']), ('3-4', '7'))
+            self.assertEqual(detail['lines'], {'first': 3, 'last': 4, 'total': 7})
+            self.assertEqual(self.client.get('/snippets/%d/highlight/?lines=1-2' % snippet.pk).content, b'')
+
+    def test_invalid_range(self):
+        self.assertEqual(self.client.get('/snippets/%d/?lines=3-1' % self.snippet.pk).status_code, 400)
+
+
+class SnippetRawTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(SnippetRawTests, self).setUp()
+        owner = User.objects.create(username='owner')
+        self.snippet = Snippet.objects.create(owner=owner, code='print("héllo")\n')
+        self.url = '/snippets/%d/raw' % self.snippet.pk
+        self.body = self.snippet.code.encode('utf-8')
+
+    def test_full_body(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.content, self.body)
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertEqual(response['Content-Length'], str(len(self.body)))
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-4')
+        self.assertEqual((response.status_code, response.content), (206, b'print'))
+        self.assertEqual(response['Content-Range'], 'bytes 0-4/%d' % len(self.body))
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=-3').content, self.body[-3:])
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=100-').status_code, 416)
+        stale = self.client.get(self.url, HTTP_RANGE='bytes=0-4', HTTP_IF_RANGE='"stale"')
+        self.assertEqual((stale.status_code, stale.content), (200, self.body))
+
+    def test_on_disk_store(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        store = RawStore(root)
+        with mock.patch('snippets.views.raw_store', store), mock.patch('snippets.models.raw_store', store):
+            response = self.client.get(self.url)
+            self.assertEqual(b''.join(response.streaming_content), self.body)
+            self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=6-').content, self.body[6:])
+            self.snippet.code = 'print(2)\n'
+            self.snippet.save()
+            self.assertEqual(os.listdir(os.path.join(root, str(self.snippet.pk))),
+                             ['%d-%d.txt' % (self.snippet.pk, self.snippet.version)])
+            with mock.patch('snippets.views.RAW_SERVE_MODE', 'x-accel-redirect'):
+                response = self.client.get(self.url)
+            self.assertEqual(response['X-Accel-Redirect'],
+                             '/_raw/%d/%d-%d.txt' % (self.snippet.pk, self.snippet.pk, self.snippet.version))
+            pk = self.snippet.pk
+            self.snippet.delete()
+            self.assertEqual(os.listdir(os.path.join(root, str(pk))), [])
+
+
+class RawUploadTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(RawUploadTests, self).setUp()
+        self.owner = User.objects.create(username='owner')
+        self.client.force_login(self.owner)
+
+    def test_plain_text_post(self):
+        response = self.client.post('/snippets/?language=javascript&title=Big', data='var a = "x";\n',
+                                    content_type='text/plain', HTTP_X_SNIPPET_LINENOS='true')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('code', response.json())
+        snippet = Snippet.objects.get(pk=response.json()['id'])
+        self.assertEqual((snippet.code, snippet.language, snippet.title, snippet.linenos),
+                         ('var a = "x";\n', 'javascript', 'Big', True))
+        self.assertEqual(response['Location'], response.json()['url'])
+
+    def test_plain_text_put(self):
+        snippet = Snippet.objects.create(owner=self.owner, code='print(1)\n')
+        response = self.client.put('/snippets/%d/raw' % snippet.pk, data='print(2)\n', content_type='text/plain')
+        self.assertEqual(response.status_code, 200)
+        snippet.refresh_from_db()
+        self.assertEqual(snippet.code, 'print(2)\n')
+        self.assertIn('2', snippet.highlighted)
+
+    def test_put_needs_owner(self):
+        snippet = Snippet.objects.create(owner=User.objects.create(username='other'), code='print(1)\n')
+        response = self.client.put('/snippets/%d/raw' % snippet.pk, data='x', content_type='text/plain')
+        self.assertEqual(response.status_code, 403)
+
+    def test_blank_body_rejected(self):
+        snippet = Snippet.objects.create(owner=self.owner, code='print(1)\n')
+        for body in ('', ' \n'):
+            response = self.client.post('/snippets/', data=body, content_type='text/plain')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('code', response.json())
+            response = self.client.put('/snippets/%d/raw' % snippet.pk, data=body, content_type='text/plain')
+            self.assertEqual(response.status_code, 400)
+        snippet.refresh_from_db()
+        self.assertEqual(snippet.code, 'print(1)\n')
+        self.assertEqual(Snippet.objects.count(), 1)
+
+    def test_size_cap(self):
+        with mock.patch('snippets.parsers.MAX_UPLOAD_BYTES', 10):
+            response = self.client.post('/snippets/', data='x' * 11, content_type='text/plain')
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Snippet.objects.exists())
+
+
+def _render_once_per_process(directory, results):
+    # run in a child process: render the key unless another process already has, holding the cross-process lock
+    lock = FileLock(os.path.join(directory, 'locks'))
+    output = os.path.join(directory, 'render.html')
+    with lock.hold('snippet-1', timeout=10) as acquired:
+        if acquired and not os.path.exists(output):
+            time.sleep(0.2)
+            with open(os.path.join(directory, 'renders.log'), 'a') as log:
+                log.write('render\n')
+            with open(output, 'w') as rendered:
+                rendered.write('<html>')
+    with open(output) as rendered:
+        results.put(rendered.read())
+
+
+class CoalescingTests(InProcessRendersMixin, SimpleTestCase):
+
+    def setUp(self):
+        super(CoalescingTests, self).setUp()
+        render_cache.clear()
+        caches['default'].clear()
+
+    def test_burst_renders_once_per_key(self):
+        renders = []
+
+        def slow_render(*args, **kwargs):
+            renders.append(args)
+            time.sleep(0.2)
+            return '<html>'
+
+        snippets = [Snippet(pk=pk, code='print(1)\n', version=1) for pk in (1, 2)]
+        barrier = threading.Barrier(20)
+        results = []
+
+        def request(snippet):
+            barrier.wait()
+            results.append(render_on_demand(snippet, 'monokai', True))
+
+        with mock.patch('snippets.highlighting.render_html', slow_render):
+            threads = [threading.Thread(target=request, args=(snippets[n % 2],)) for n in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(renders), 2)
+        self.assertEqual(results, ['<html>'] * 20)
+
+    def test_burst_across_processes_renders_once(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        processes = [context.Process(target=_render_once_per_process, args=(directory, results)) for _ in range(6)]
+        for process in processes:
+            process.start()
+        outputs = [results.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join()
+        with open(os.path.join(directory, 'renders.log')) as log:
+            self.assertEqual(log.read(), 'render\n')
+        self.assertEqual(outputs, ['<html>'] * 6)
+
+
+class CoalescedLookupTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(CoalescedLookupTests, self).setUp()
+        self.snippet = Snippet.objects.create(owner=User.objects.create(username='owner'), code='print(1)\n')
+        self.shared = Snippet.objects.select_related('owner').get(pk=self.snippet.pk)
+
+    def test_followers_check_permissions_on_their_own_copy(self):
+        # every request gets what a leader would hand those waiting on it
+        with mock.patch.object(object_flight, 'do', lambda key, func: self.shared), \
+                mock.patch.object(SnippetDetail, 'check_object_permissions', autospec=True) as check:
+            self.assertEqual(self.client.get('/snippets/%d/' % self.snippet.pk).status_code, 200)
+            self.assertEqual(self.client.get('/snippets/%d/' % self.snippet.pk).status_code, 200)
+        self.assertEqual(check.call_count, 2)
+        first, second = (call[0][2] for call in check.call_args_list)
+        self.assertIsNot(first, self.shared)
+        self.assertIsNot(first, second)
+        self.assertEqual(first.pk, self.shared.pk)
+        first.title = 'changed'
+        first._state.fields_cache.clear()
+        self.assertEqual(self.shared.title, '')
+        self.assertIn('owner', self.shared._state.fields_cache)
+
+    def test_only_shared_between_requests_on_the_same_database(self):
+        keys = []
+
+        def shared_result(key, func):
+            keys.append(key)
+            return self.shared
+
+        with mock.patch.object(object_flight, 'do', shared_result):
+            with mock.patch('snippets.routing.choose_replica', return_value='replica'):
+                self.client.get('/snippets/%d/' % self.snippet.pk)
+            self.client.cookies[PIN_COOKIE] = str(time.time() + 60)
+            self.client.get('/snippets/%d/' % self.snippet.pk)
+        self.assertEqual([key[-1] for key in keys], ['replica', None])
+
+
+class ViewCounterTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(ViewCounterTests, self).setUp()
+        owner = User.objects.create(username='owner')
+        self.first, self.second = [Snippet.objects.create(owner=owner, code='print(%d)\n' % n) for n in (1, 2)]
+        self.counter = ViewCounter(background=False)
+        patcher = mock.patch('snippets.views.view_counter', self.counter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_views_are_buffered_then_flushed(self):
+        for _ in range(3):
+            self.client.get('/snippets/%d/' % self.first.pk)
+        self.client.get('/snippets/%d/highlight/' % self.second.pk)
+        self.assertFalse(SnippetViews.objects.exists())
+        self.assertEqual(self.counter.pending(), {self.first.pk: 3, self.second.pk: 1})
+        # the process-wide counter is left alone, so it has nothing to flush at exit
+        self.assertEqual((counters.view_counter.pending(), counters.view_counter._thread), ({}, None))
+        self.counter.flush()
+        self.counter.add(self.second.pk, 5)
+        self.counter.flush()
+        self.assertEqual(dict(SnippetViews.objects.values_list('snippet_id', 'count')),
+                         {self.first.pk: 3, self.second.pk: 6})
+
+    def test_popular_is_served_from_last_flush(self):
+        self.counter.add(self.first.pk, 2)
+        self.counter.add(self.second.pk, 7)
+        self.counter.flush()
+        self.counter.add(self.first.pk, 100)
+        response = self.client.get('/snippets/popular/')
+        self.assertEqual([(item['id'], item['views']) for item in response.json()],
+                         [(self.second.pk, 7), (self.first.pk, 2)])
+
+    def test_popular_goes_stale_without_flushes(self):
+        self.assertEqual(self.counter.get_popular(), [])
+        # counted by another process
+        SnippetViews.objects.create(snippet=self.first, count=4)
+        self.assertEqual(self.counter.get_popular(), [])
+        with mock.patch('snippets.counters.time.monotonic', return_value=time.monotonic() + 60):
+            self.assertEqual(self.counter.get_popular(), [(self.first.pk, 4)])
+
+    def test_long_buffer_is_flushed_in_batches(self):
+        for pk in range(self.second.pk + 1, self.second.pk + 1500):
+            self.counter.add(pk)
+        self.counter.add(self.first.pk, 2)
+        with CaptureQueriesContext(connection) as queries:
+            self.counter.flush()
+        # a query per 500 snippets checking they exist, under SQLite's 999 parameters even where it allows more
+        lookups = [query for query in queries if 'FROM "snippets_snippet"' in query['sql']]
+        self.assertEqual(len(lookups), 3)
+        self.assertEqual(dict(SnippetViews.objects.values_list('snippet_id', 'count')), {self.first.pk: 2})
+
+
+class StatsTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(StatsTests, self).setUp()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+
+    def stats(self):
+        return (sorted(UserLanguageStats.objects.filter(snippets__gt=0)
+                       .values_list('owner__username', 'language', 'snippets', 'code_bytes')),
+                sorted(LanguageStats.objects.filter(snippets__gt=0).values_list('language', 'snippets', 'code_bytes')))
+
+    def test_stats_follow_saves_and_deletes(self):
+        first = Snippet.objects.create(owner=self.alice, code='x = 1\n')
+        second = Snippet.objects.create(owner=self.alice, code='var \u00e9;', language='javascript')
+        Snippet.objects.create(owner=self.bob, code='y = 22\n')
+        first.code = 'x = 100\n'
+        first.save()
+        second = Snippet.objects.defer('code').get(pk=second.pk)
+        second.language = 'python'
+        second.save()
+        self.assertEqual(self.stats(), (
+            [('alice', 'python', 2, 15), ('bob', 'python', 1, 7)],
+            [('python', 3, 22)],
+        ))
+        Snippet.objects.filter(pk=first.pk).delete()
+        self.bob.delete()
+        self.assertEqual(self.stats(), ([('alice', 'python', 1, 7)], [('python', 1, 7)]))
+
+    def test_refresh_matches_incremental_stats(self):
+        for n in range(6):
+            Snippet.objects.create(owner=(self.alice, self.bob)[n % 2], code='x = %d\n' % n * n,
+                                   language=('python', 'ruby', 'c')[n % 3])
+        kept = self.stats()
+        Snippet.objects.bulk_create([Snippet(owner=self.bob, code='int main;', language='c', highlighted='')])
+        call_command('refresh_stats', stdout=StringIO())
+        self.assertEqual(self.stats()[1], [(language, snippets + (language == 'c'), size + 9 * (language == 'c'))
+                                           for language, snippets, size in kept[1]])
+
+    def test_endpoints(self):
+        Snippet.objects.create(owner=self.alice, code='x = 1\n')
+        Snippet.objects.create(owner=self.alice, code='int x;', language='c')
+        Snippet.objects.create(owner=self.bob, code='print()', language='python')
+        with self.assertNumQueries(2):
+            response = self.client.get('/users/%d/stats/' % self.alice.pk)
+        self.assertEqual((response.data['snippets'], response.data['code_bytes']), (2, 12))
+        self.assertEqual([dict(language) for language in response.data['languages']],
+                         [{'language': 'c', 'snippets': 1, 'code_bytes': 6},
+                          {'language': 'python', 'snippets': 1, 'code_bytes': 6}])
+        response = self.client.get('/snippets/stats/')
+        self.assertEqual((response.data['snippets'], response.data['code_bytes']), (3, 19))
+        self.assertEqual(self.client.get('/users/999/stats/').status_code, 404)
+
+
+class SoftDeleteTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(SoftDeleteTests, self).setUp()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.kept = Snippet.objects.create(owner=self.alice, code='x = 1\n')
+        self.heavy = [Snippet.objects.create(owner=self.bob, code='y = %d\n' % n) for n in range(7)]
+
+    def listed(self, url):
+        return sorted(item['id'] for item in self.client.get(url).json()['results'])
+
+    def test_deleted_snippet_is_hidden_then_purged(self):
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.delete('/snippets/%d/' % self.kept.pk).status_code, 204)
+        self.assertTrue(Snippet.objects.filter(pk=self.kept.pk).exists())
+        self.assertEqual(self.client.get('/snippets/%d/' % self.kept.pk).status_code, 404)
+        self.assertNotIn(self.kept.pk, self.listed('/snippets/'))
+        self.assertEqual(self.client.get('/users/%d/stats/' % self.alice.pk).data['snippets'], 0)
+        self.assertEqual(Purger(pause=0).run()['snippets'], 1)
+        self.assertFalse(Snippet.objects.filter(pk=self.kept.pk).exists())
+        self.assertEqual(LanguageStats.objects.get(language='python').snippets, 7)
+
+    def test_user_is_hidden_then_purged_in_batches(self):
+        UserDeletion.schedule(self.bob)
+        self.assertEqual(self.listed('/users/'), [self.alice.pk])
+        self.assertEqual(self.client.get('/users/%d/' % self.bob.pk).status_code, 404)
+        self.assertEqual(self.listed('/snippets/'), [self.kept.pk])
+        with mock.patch('snippets.purge.time.sleep') as sleep:
+            stats = Purger(batch_size=3, pause=0.25, max_batches=2).run()
+            self.assertEqual((stats['snippets'], stats['users']), (6, 0))
+            self.assertTrue(User.objects.filter(pk=self.bob.pk).exists())
+            stats = Purger(batch_size=3, pause=0.25).run()
+        self.assertEqual((stats['snippets'], stats['users'], stats['batches']), (1, 1, 1))
+        sleep.assert_called_with(0.25)
+        self.assertFalse(User.objects.filter(pk=self.bob.pk).exists())
+        self.assertEqual(list(Snippet.objects.values_list('pk', flat=True)), [self.kept.pk])
+        self.assertEqual(LanguageStats.objects.get(language='python').snippets, 1)
+
+    def test_user_is_uncounted_when_scheduled(self):
+        UserDeletion.schedule(self.bob)
+        self.assertEqual((LanguageStats.objects.get(language='python').snippets,
+                          UserLanguageStats.objects.filter(owner=self.bob).exists()), (1, False))
+        self.heavy[0].soft_delete()
+        call_command('refresh_stats', stdout=StringIO())
+        self.assertEqual(LanguageStats.objects.get(language='python').snippets, 1)
+        with CaptureQueriesContext(connection) as queries:
+            Purger(pause=0).run()
+        # the batches load no bodies; the user's own delete only looks for snippets left, and finds none
+        self.assertFalse([query['sql'] for query in queries
+                          if '"code"' in query['sql'] and '"owner_id" IN' not in query['sql']])
+        self.assertEqual(LanguageStats.objects.get(language='python').snippets, 1)
+
+
+class ReplicaRoutingTests(InProcessRendersMixin, TestCase):
+    """
+    Runs against a second SQLite database standing in for a replica that hasn't caught up with anything yet.
+    """
+    databases = {'default', 'replica'}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3',
+                                            'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3')}
+        call_command('migrate', database='replica', verbosity=0)
+        super(ReplicaRoutingTests, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ReplicaRoutingTests, cls).tearDownClass()
+        connections['replica'].close()
+        del connections.databases['replica']
+        delattr(connections._connections, 'replica')
+        shutil.rmtree(cls.replica_dir)
+
+    def setUp(self):
+        super(ReplicaRoutingTests, self).setUp()
+        patcher = mock.patch('snippets.routing.READ_REPLICAS', {'replica': 1})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.owner = User.objects.create(username='owner')
+        Snippet.objects.create(owner=self.owner, code='x = 1\n')
+
+    def count(self):
+        return self.client.get('/snippets/').json()['count']
+
+    def test_reads_go_to_replica_until_client_writes(self):
+        self.assertEqual(self.count(), 0)
+        self.client.force_login(self.owner)
+        response = self.client.post('/snippets/', {'code': 'y = 2\n'})
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        self.assertEqual(self.count(), 2)
+        with mock.patch('snippets.routing.time.time', return_value=time.time() + 60):
+            self.assertEqual(self.count(), 0)
+
+    def test_replicas_are_picked_by_weight(self):
+        rng = random.Random(7)
+        picks = [choose_replica({'a': 3, 'b': 1}, rng) for _ in range(4000)]
+        self.assertAlmostEqual(picks.count('a') / len(picks), 0.75, delta=0.03)
+        self.assertIsNone(choose_replica({}))
+
+
+def month(year, number):
+    return datetime(year, number, 1, tzinfo=timezone.utc)
+
+
+class PartitionTests(SimpleTestCase):
+
+    def test_add_months(self):
+        self.assertEqual(add_months(month(2024, 11), 3), month(2025, 2))
+        self.assertEqual(add_months(month(2024, 1), -1), month(2023, 12))
+
+    def test_maintenance_plan(self):
+        existing = [(LEGACY_TABLE, month(2024, 3)), ('snippets_snippet_p2024_03', month(2024, 4)),
+                    ('snippets_snippet_p2024_04', month(2024, 5)), ('snippets_snippet_p2024_05', month(2024, 6))]
+        with mock.patch('snippets.partitions.list_partitions', return_value=existing):
+            created, detached = maintain_partitions(None, now=datetime(2024, 5, 10, tzinfo=timezone.utc), ahead=2,
+                                                    retain=2, dry_run=True)
+        self.assertEqual(created, ['snippets_snippet_p2024_06', 'snippets_snippet_p2024_07'])
+        self.assertEqual(detached, [LEGACY_TABLE, 'snippets_snippet_p2024_03'])
+
+
+class ArchiveTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(ArchiveTests, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        patcher = mock.patch('snippets.archive.archive_store', ArchiveStore(self.root))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        owner = User.objects.create(username='owner')
+        self.old = [Snippet.objects.create(owner=owner, code='old_%d = "h\u00e9"\n' % n) for n in range(5)]
+        self.new = Snippet.objects.create(owner=owner, code='new = 1\n')
+        Snippet.objects.exclude(pk=self.new.pk).update(created=timezone.now() - timedelta(days=400))
+        SnippetViews.objects.create(snippet=self.old[0], count=50)
+
+    def archive(self, *args):
+        call_command('archive_snippets', '--directory', self.root, *args, stdout=StringIO())
+
+    def test_archived_snippets_load_transparently(self):
+        self.archive('--segment-bytes', '1')
+        archived = Snippet.objects.filter(archive_segment__isnull=False).order_by('pk')
+        self.assertEqual([snippet.pk for snippet in archived], [snippet.pk for snippet in self.old[1:]])
+        self.assertEqual(len(set(archived.values_list('archive_segment', flat=True))), 4)
+        self.assertEqual(set(archived.values_list('code', 'highlighted')), {('', '')})
+        snippet = self.old[2]
+        self.assertEqual(self.client.get('/snippets/%d/' % snippet.pk).json()['code'], snippet.code)
+        response = self.client.get('/snippets/%d/highlight/' % snippet.pk)
+        self.assertEqual(response.content.decode('utf-8'), snippet.highlighted)
+        self.assertEqual(self.client.get('/snippets/%d/raw' % snippet.pk).content, snippet.code.encode('utf-8'))
+        deferred = Snippet.objects.defer('code').get(pk=snippet.pk)
+        self.assertEqual(deferred.code, snippet.code)
+        deferred = Snippet.objects.only('id', 'version').get(pk=snippet.pk)
+        self.assertEqual(deferred.code, snippet.code)
+        stats = self.client.get('/snippets/stats/').data
+        call_command('refresh_stats', stdout=StringIO())
+        self.assertEqual(self.client.get('/snippets/stats/').data, stats)
+
+    def test_raw_store_files_archived_code(self):
+        self.archive()
+        snippet = self.old[1]
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        store = RawStore(root)
+        with mock.patch('snippets.views.raw_store', store), mock.patch('snippets.models.raw_store', store):
+            response = self.client.get('/snippets/%d/raw' % snippet.pk)
+            self.assertEqual(b''.join(response.streaming_content), snippet.code.encode('utf-8'))
+            with open(store.path(snippet.pk, snippet.version), 'rb') as stored:
+                self.assertEqual(stored.read(), snippet.code.encode('utf-8'))
+
+    def test_saving_or_rehydrating_brings_bodies_back(self):
+        self.archive()
+        snippet = Snippet.objects.get(pk=self.old[1].pk)
+        snippet.title = 'renamed'
+        snippet.save()
+        row = Snippet.objects.filter(pk=snippet.pk).values_list('archive_segment', 'code', 'title').get()
+        self.assertEqual(row, (None, self.old[1].code, 'renamed'))
+        call_command('rehydrate_snippets', '--all', stdout=StringIO())
+        self.assertFalse(Snippet.objects.filter(archive_segment__isnull=False).exists())
+        self.assertEqual([Snippet.objects.values_list('code', flat=True).get(pk=old.pk) for old in self.old],
+                         [old.code for old in self.old])
+
+
+class BrowsableFormCacheTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(BrowsableFormCacheTests, self).setUp()
+        form_cache.clear()
+        self.addCleanup(form_cache.clear)
+        self.owner = User.objects.create(username='owner')
+        self.snippet = Snippet.objects.create(owner=self.owner, code='x = 1\n')
+
+    def page(self, path):
+        page = self.client.get(path, HTTP_ACCEPT='text/html').content.decode('utf-8')
+        # the CSRF token is masked afresh for every response
+        return re.sub('[A-Za-z0-9]{64}', 'TOKEN', page)
+
+    def test_forms_are_reused_until_the_snippet_changes(self):
+        path = '/snippets/%d/' % self.snippet.pk
+        self.client.force_login(self.owner)
+        page = self.page(path)
+        self.assertIn('x = 1', page)
+        cached = len(form_cache)
+        self.assertTrue(cached)
+        self.assertEqual(self.page(path), page)
+        self.assertEqual(len(form_cache), cached)
+        self.snippet.code = 'y = 2\n'
+        self.snippet.save()
+        self.assertIn('y = 2', self.page(path))
+
+    def test_forms_follow_permissions(self):
+        other = User.objects.create(username='other')
+        path = '/snippets/%d/' % self.snippet.pk
+        self.client.force_login(self.owner)
+        self.assertIn('name="code"', self.page(path))
+        self.client.force_login(other)
+        self.assertNotIn('name="code"', self.page(path))
+
+
+class SerializerCacheTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(SerializerCacheTests, self).setUp()
+        self.owner = User.objects.create(username='owner')
+
+    def test_cached_fields_are_bound_per_serializer(self):
+        first, second = SnippetSerializer(), SnippetSerializer()
+        self.assertIsNot(first.fields['language'], second.fields['language'])
+        self.assertIs(first.fields['language'].parent, first)
+        self.assertIs(second.fields['language'].parent, second)
+        uncached = type('UncachedSnippetSerializer', (SnippetSerializer,), {'cache_fields': False})
+        snippet = Snippet.objects.create(owner=self.owner, code='x = 1\n')
+        request = self.client.get('/snippets/').wsgi_request
+        self.assertEqual(SnippetSerializer(snippet, context={'request': request}).data,
+                         uncached(snippet, context={'request': request}).data)
+
+    def test_options_metadata_is_reused(self):
+        serializer_info_cache.clear()
+        self.addCleanup(serializer_info_cache.clear)
+        self.assertNotIn('actions', self.client.options('/snippets/').json())
+        self.client.force_login(self.owner)
+        first = self.client.options('/snippets/').json()
+        self.assertIn('python', [choice['value'] for choice in first['actions']['POST']['language']['choices']])
+        self.assertEqual(len(serializer_info_cache), 1)
+        self.assertEqual(self.client.options('/snippets/').json(), first)
+
+
+class ApiMiddlewareTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(ApiMiddlewareTests, self).setUp()
+        self.owner = User.objects.create_user('owner', password='secret')
+
+    def test_api_clients_skip_browser_middleware(self):
+        response = self.client.get('/snippets/')
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+        self.assertNotIn('X-Frame-Options', response)
+        response = self.client.get('/snippets/', HTTP_ACCEPT='text/html')
+        self.assertTrue(hasattr(response.wsgi_request, 'session'))
+        self.assertIn('X-Frame-Options', response)
+
+    def test_browsers_keep_csrf_protection(self):
+        browser = Client(enforce_csrf_checks=True)
+        response = browser.post('/api-auth/login/', {'username': 'owner', 'password': 'secret'})
+        self.assertEqual(response.status_code, 403)
+        browser.force_login(self.owner)
+        self.assertEqual(browser.post('/snippets/', {'code': 'x = 1'}).status_code, 403)
+        api = Client(enforce_csrf_checks=True)
+        response = api.post('/snippets/', {'code': 'x = 1'}, HTTP_AUTHORIZATION='Basic b3duZXI6c2VjcmV0')
+        self.assertEqual(response.status_code, 201)
+
+
+class MetricsTests(InProcessRendersMixin, TestCase):
+
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        registry.clear()
+        self.addCleanup(registry.clear)
+        self.owner = User.objects.create_user('owner', password='secret')
+
+    def test_requests_are_recorded_per_view(self):
+        self.client.force_login(self.owner)
+        self.client.post('/snippets/', {'code': 'x = 1\n'})
+        self.client.get('/snippets/')
+        histograms = registry.snapshot()
+        self.assertEqual(sum(histograms['snippets_request_seconds', 'snippet-list'].counts), 2)
+        self.assertGreater(histograms['snippets_db_queries', 'snippet-list'].total, 2)
+        self.assertGreater(histograms['snippets_highlight_seconds', 'snippet-list'].total, 0)
+        self.assertGreater(histograms['snippets_serializer_seconds', 'snippet-list'].total, 0)
+        self.assertGreater(histograms['snippets_response_bytes', 'snippet-list'].total, 0)
+        text = self.client.get('/metrics').content.decode('utf-8')
+        self.assertIn('# TYPE snippets_request_seconds histogram', text)
+        self.assertIn('snippets_request_seconds_bucket{view="snippet-list",le="+Inf"} 2', text)
+        self.assertIn('snippets_request_seconds_count{view="snippet-list"} 2', text)
+
+    def test_workers_are_added_up(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        other = Registry(root)
+        other.observe('snippets_db_queries', 'snippet-list', 3)
+        other.flush()
+        os.rename(os.path.join(root, '%d.json' % os.getpid()), os.path.join(root, '1.json'))
+        mine = Registry(root)
+        mine.observe('snippets_db_queries', 'snippet-list', 30)
+        text = exposition(mine.collect())
+        self.assertIn('snippets_db_queries_bucket{view="snippet-list",le="5.0"} 1', text)
+        self.assertIn('snippets_db_queries_bucket{view="snippet-list",le="50.0"} 2', text)
+        self.assertIn('snippets_db_queries_sum{view="snippet-list"} 33.0', text)
+
+    def test_counters_are_exported(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for counter in (render_counts, limit_hits):
+            self.addCleanup(counter.clear)
+            counter.clear()
+        render_counts.update(performed=2, skipped=1)
+        limit_hits['python', '64KiB'] += 1
+        Registry(root).flush()
+        os.rename(os.path.join(root, '%d.json' % os.getpid()), os.path.join(root, '1.json'))
+        text = exposition(Registry(root).collect())
+        self.assertIn('# TYPE snippets_stored_renders_total counter', text)
+        self.assertIn('snippets_stored_renders_total{outcome="performed"} 4', text)
+        self.assertIn('snippets_stored_renders_total{outcome="skipped"} 2', text)
+        self.assertIn('# TYPE snippets_highlight_limit_hits_total counter', text)
+        self.assertIn('snippets_highlight_limit_hits_total{language="python",size="64KiB"} 2', text)
+
+    def test_scrapers_are_restricted(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.7').status_code, 403)
+        with mock.patch('snippets.metrics.allowed_networks', parse_networks(['203.0.113.0/24'])):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.7').status_code, 200)
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.owner.is_staff = True
+        self.owner.save()
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.7').status_code, 200)
+
+
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        patcher = mock.patch('snippets.profiling.profiler', Profiler(self.root, max_bytes=10 ** 9))
+        self.profiler = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_signed_requests_are_profiled(self):
+        self.assertFalse(valid_token('profile:forged'))
+        response = self.client.get('/snippets/', HTTP_X_SNIPPETS_PROFILE=make_token())
+        name = response['X-Snippets-Profile']
+        self.assertEqual(sorted(os.listdir(self.root)), [name + '.prof', name + '.txt'])
+        with open(os.path.join(self.root, name + '.txt')) as summary:
+            text = summary.read()
+        self.assertIn('snippet-list', text)
+        self.assertIn('Allocated during the request', text)
+        self.assertNotIn('X-Snippets-Profile', self.client.get('/snippets/', {'profile': 'nope'}))
+        # only views in snippets/views.py
+        self.assertNotIn('X-Snippets-Profile', self.client.get('/api-auth/login/', HTTP_X_SNIPPETS_PROFILE=make_token()))
+        self.assertEqual(len(os.listdir(self.root)), 2)
+
+    def test_sampled_profiles_stay_within_their_budget(self):
+        self.profiler.max_bytes = 1
+        with mock.patch('snippets.profiling.PROFILE_SAMPLE_RATE', 1):
+            for _ in range(3):
+                response = self.client.get('/snippets/')
+                self.assertNotIn('X-Snippets-Profile', response)
+        self.assertLessEqual(len(os.listdir(self.root)), 1)
+
+
+class LoadToolsTests(InProcessRendersMixin, TestCase):
+
+    def test_generate_data(self):
+        call_command('generate_data', users=3, snippets=7, workers=1, batch_size=3, seed='test', stdout=StringIO())
+        self.assertEqual(User.objects.filter(username__startswith='synthetic-').count(), 3)
+        snippets = list(Snippet.objects.all())
+        self.assertEqual(len(snippets), 7)
+        for snippet in snippets:
+            render = render_with_state(snippet.code, snippet.language, snippet.style, snippet.linenos, snippet.title)
+            self.assertEqual(snippet.highlighted, render.html)
+            self.assertTrue(snippet.highlighted_gzip)
+        self.assertEqual(sum(LanguageStats.objects.values_list('snippets', flat=True)), 7)
+
+    def test_percentiles_and_mix(self):
+        ordered = list(range(1, 101))
+        self.assertEqual([percentile(ordered, percent) for percent in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertEqual(parse_mix('detail=3,raw,create=0'), {'detail': 3.0, 'raw': 1.0})
+        with self.assertRaises(CommandError):
+            parse_mix('detail=3,everything=1')
+
+
+class WarmUpTests(SimpleTestCase):
+    """
+    Warming up happens before the fork, so it must not touch the database, which SimpleTestCase enforces.
+    """
+
+    def test_warm_up_fills_caches(self):
+        self.addCleanup(field_templates.clear)
+        self.addCleanup(serializer_info_cache.clear)
+        field_templates.clear()
+        serializer_info_cache.clear()
+        timings = warm_up(freeze=False)
+        self.assertEqual(set(timings), {'lexers', 'formatters', 'urls', 'serializers', 'templates'})
+        self.assertIn(SnippetSerializer, field_templates)
+        self.assertIn((SnippetSerializer, settings.LANGUAGE_CODE), serializer_info_cache)
+        hits = get_output_formatter.cache_info().hits
+        for style, _ in STYLE_CHOICES:
+            get_output_formatter('html', style, True)
+        self.assertEqual(get_output_formatter.cache_info().hits, hits + len(STYLE_CHOICES))
+
+    @unittest.skipUnless(os.path.exists('/proc/self/smaps'), 'needs Linux /proc')
+    def test_process_memory(self):
+        memory = process_memory(os.getpid())
+        self.assertGreater(memory['rss'], 0)
+        self.assertEqual(memory['shared'] + memory['private'], memory['rss'])
+        self.assertIn(os.getpid(), child_pids(os.getppid()))
+
+
+PERF_BASELINE = os.path.join(os.path.dirname(__file__), 'perf_baseline.json')
+# a measurement regresses when it exceeds baseline * factor + slack
+PERF_TIME_TOLERANCE = (3.0, 0.002)
+PERF_ALLOCATION_TOLERANCE = (1.5, 64 * 1024)
+PERF_RUNS = 5
+# wall time and allocations depend on the machine and its load, so only query budgets gate an ordinary run
+PERF_UPDATE_BASELINE = bool(os.environ.get('SNIPPETS_PERF_UPDATE_BASELINE'))
+PERF_TIMINGS = bool(os.environ.get('SNIPPETS_PERF_TIMINGS')) or PERF_UPDATE_BASELINE
+
+
+class PerformanceTests(InProcessRendersMixin, TestCase):
+    """
+    Every endpoint against a table of thousands of snippets: hard query budgets and, with SNIPPETS_PERF_TIMINGS=1,
+    wall time and peak allocations compared with perf_baseline.json on a quiet machine. After a deliberate change,
+    rewrite the baseline by running the tests with SNIPPETS_PERF_UPDATE_BASELINE=1 and commit it.
+    """
+    users = 2000
+    snippets = 10000
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(48)
+        User.objects.bulk_create([User(username='perf-%d' % n) for n in range(cls.users)])
+        owners = list(User.objects.filter(username__startswith='perf-').values_list('pk', flat=True))
+        languages = ['python', 'javascript', 'html', 'c', 'rust', 'sql']
+        Snippet.objects.bulk_create(
+            [Snippet(owner_id=rng.choice(owners), language=rng.choice(languages), title='snippet %d' % n,
+                     code='def f%d(x):\n    return x * %d\n' % (n, n), highlighted='<pre>f</pre>')
+             for n in range(cls.snippets)])
+        call_command('refresh_stats', stdout=StringIO())
+        cls.owner = User.objects.get(pk=owners[0])
+        cls.snippet = Snippet.objects.filter(owner=cls.owner).first()
+        cls.snippet.save(update_fields=['code'])
+
+    def setUp(self):
+        super(PerformanceTests, self).setUp()
+        counter = ViewCounter(background=False)
+        for pk in Snippet.objects.values_list('pk', flat=True)[:100]:
+            counter.add(pk, pk)
+        counter.flush()
+        patcher = mock.patch('snippets.views.view_counter', counter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.owner)
+
+    def endpoints(self):
+        """
+        Yield `(name, query budget, request)` for each endpoint in snippets/urls.py. The budgets include the two
+        queries that load the logged in user's session.
+        """
+        snippet, owner = self.snippet.pk, self.owner.pk
+        last_page = self.snippets // 10
+        yield 'api-root', 2, lambda: self.client.get('/')
+        yield 'snippet-list', 4, lambda: self.client.get('/snippets/')
+        yield 'snippet-list, last page', 4, lambda: self.client.get('/snippets/', {'page': last_page})
+        yield 'snippet-list, create', 7, lambda: self.client.post('/snippets/', {'code': 'print(1)\n'})
+        yield 'snippet-list, options', 2, lambda: self.client.options('/snippets/')
+        yield 'snippet-popular', 3, lambda: self.client.get('/snippets/popular/')
+        yield 'snippet-stats', 3, lambda: self.client.get('/snippets/stats/')
+        yield 'snippet-detail', 3, lambda: self.client.get('/snippets/%d/' % snippet)
+        yield 'snippet-detail, lines', 3, lambda: self.client.get('/snippets/%d/' % snippet, {'lines': '2'})
+        yield 'snippet-highlight', 3, lambda: self.client.get('/snippets/%d/highlight/' % snippet)
+        yield 'snippet-raw', 3, lambda: self.client.get('/snippets/%d/raw' % snippet)
+        yield 'user-list', 5, lambda: self.client.get('/users/')
+        yield 'user-detail', 4, lambda: self.client.get('/users/%d/' % owner)
+        yield 'user-stats', 4, lambda: self.client.get('/users/%d/stats/' % owner)
+
+    def measure(self, request):
+        """
+        Return the queries, median wall time and peak allocated bytes of `request`, the last two only when timing.
+        """
+        request()
+        with CaptureQueriesContext(connection) as queries:
+            response = request()
+        self.assertLess(response.status_code, 300, response.content[:200])
+        count = len(queries)
+        if not PERF_TIMINGS:
+            return count, None, None
+        times = []
+        for _ in range(PERF_RUNS):
+            start = time.perf_counter()
+            request()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            request()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return count, sorted(times)[PERF_RUNS // 2], peak
+
+    def test_endpoints_within_budgets(self):
+        try:
+            with open(PERF_BASELINE) as baseline_file:
+                baseline = json.load(baseline_file)
+        except FileNotFoundError:
+            baseline = {}
+        measured, regressions = {}, []
+        for name, budget, request in self.endpoints():
+            count, seconds, peak = self.measure(request)
+            if count > budget:
+                regressions.append('%s: %d queries, over its budget of %d' % (name, count, budget))
+            if not PERF_TIMINGS:
+                continue
+            measured[name] = {'seconds': round(seconds, 6), 'allocated_bytes': peak}
+            expected = baseline.get(name)
+            if expected is None:
+                continue
+            for key, (factor, slack), unit, scale in (('seconds', PERF_TIME_TOLERANCE, 'ms', 1000),
+                                                      ('allocated_bytes', PERF_ALLOCATION_TOLERANCE, 'KiB', 1 / 1024)):
+                value, limit = measured[name][key], expected[key] * factor + slack
+                if value > limit:
+                    regressions.append('%s: %.1f%s against a baseline of %.1f%s (%+.0f%%, limit %.1f%s)' % (
+                        name, value * scale, unit, expected[key] * scale, unit,
+                        (value / expected[key] - 1) * 100 if expected[key] else float('inf'), limit * scale, unit))
+        if PERF_UPDATE_BASELINE:
+            with open(PERF_BASELINE, 'w') as baseline_file:
+                json.dump(measured, baseline_file, indent=2, sort_keys=True)
+                baseline_file.write('\n')
+        if regressions:
+            self.fail('Performance regressions:\n' + '\n'.join(regressions))
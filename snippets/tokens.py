@@ -0,0 +1,137 @@
+"""
+Compact storage for a lexed token stream.
+
+Lexing is most of the cost of highlighting, so every stored render also keeps the tokens it was formatted from.
+Any other output (another style, line numbers, ANSI for terminal clients) is then only a formatter pass away.
+
+Adjacent tokens of the same type are merged (formatters merge them anyway), and the stream is stored as an interned
+table of token types, one type index and one length per run, and the text itself only when it isn't the snippet's
+code verbatim. The whole thing is zlib-compressed.
+"""
+import struct
+import zlib
+from array import array
+
+from pygments.token import string_to_tokentype
+
+MAGIC = b'TKS1'
+_HEADER = struct.Struct('<4sBII')
+# header flags
+_HAS_TEXT = 1
+
+
+class TokenStream:
+    """
+    A run-length token stream over `text`: run `i` has type `types[i]` and covers `text[ends[i - 1]:ends[i]]`.
+    """
+
+    def __init__(self, text, types, ends):
+        self.text = text
+        self.types = types
+        self.ends = ends
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        """
+        Build a stream from `(tokentype, value)` pairs.
+        """
+        stream = cls('', [], [])
+        stream._extend(tokens)
+        stream.text = ''.join(value for _, value in tokens)
+        return stream
+
+    def _extend(self, tokens, offset=0):
+        # append runs, `offset` being the length of text they start after
+        types, ends = self.types, self.ends
+        pos = offset
+        for ttype, value in tokens:
+            if not value:
+                continue
+            pos += len(value)
+            if types and types[-1] is ttype:
+                ends[-1] = pos
+            else:
+                types.append(ttype)
+                ends.append(pos)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __iter__(self):
+        text, start = self.text, 0
+        for ttype, end in zip(self.types, self.ends):
+            yield ttype, text[start:end]
+            start = end
+
+    def __eq__(self, other):
+        return (isinstance(other, TokenStream)
+                and (self.text, self.types, self.ends) == (other.text, other.types, other.ends))
+
+    def _runs_between(self, start, end):
+        # the runs covering text[start:end], cut at both ends
+        text, run_start = self.text, 0
+        for ttype, run_end in zip(self.types, self.ends):
+            if run_end > start and run_start < end:
+                yield ttype, text[max(run_start, start):min(run_end, end)]
+            if run_end >= end:
+                break
+            run_start = run_end
+
+    def splice(self, start, end, tokens, text):
+        """
+        Return the stream for `text`, made of this stream with `text[start:end]` replaced by `tokens`.
+
+        Everything after `end` in the old text must be unchanged at the end of `text`.
+        """
+        stream = TokenStream(text, [], [])
+        stream._extend(self._runs_between(0, start))
+        stream._extend(tokens, start)
+        stream._extend(self._runs_between(end, len(self.text)), len(text) - (len(self.text) - end))
+        return stream
+
+    def encode(self, code):
+        """
+        Serialise the stream; the text is left out when it is `code` verbatim.
+        """
+        names, ids = [], {}
+        for ttype in self.types:
+            if ttype not in ids:
+                ids[ttype] = len(names)
+                names.append(ttype)
+        type_ids = array('B' if len(names) < 256 else 'H', [ids[ttype] for ttype in self.types])
+        lengths = array('I', (end - start for start, end in zip([0] + self.ends, self.ends)))
+        flags = 0 if self.text == code else _HAS_TEXT
+        table = '\n'.join(str(ttype) for ttype in names).encode('utf-8')
+        parts = [_HEADER.pack(MAGIC, flags, len(names), len(self.types)), struct.pack('<I', len(table)), table,
+                 type_ids.tobytes(), lengths.tobytes()]
+        if flags & _HAS_TEXT:
+            parts.append(self.text.encode('utf-8'))
+        return zlib.compress(b''.join(parts))
+
+    @classmethod
+    def decode(cls, blob, code):
+        """
+        Load a stream stored with `encode(code)`.
+        """
+        data = zlib.decompress(bytes(blob))
+        magic, flags, ntypes, nruns = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('Not a stored token stream.')
+        pos = _HEADER.size
+        table_size, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        names = data[pos:pos + table_size].decode('utf-8').split('\n') if ntypes else []
+        pos += table_size
+        type_ids = array('B' if ntypes < 256 else 'H')
+        type_ids.frombytes(data[pos:pos + nruns * type_ids.itemsize])
+        pos += nruns * type_ids.itemsize
+        lengths = array('I')
+        lengths.frombytes(data[pos:pos + nruns * lengths.itemsize])
+        pos += nruns * lengths.itemsize
+        text = data[pos:].decode('utf-8') if flags & _HAS_TEXT else code
+        table = [string_to_tokentype(name) for name in names]
+        ends, end = [], 0
+        for length in lengths:
+            end += length
+            ends.append(end)
+        return cls(text, [table[index] for index in type_ids], ends)
@@ -128,10 +128,14 @@ dramatically lowers the barrier-to-entry for other developers wanting to inspect
 urlpatterns = format_suffix_patterns([
     path('', views.api_root),
     path('snippets/', views.SnippetList.as_view(), name='snippet-list'),
+    path('snippets/popular/', views.SnippetPopular.as_view(), name='snippet-popular'),
+    path('snippets/stats/', views.SnippetStats.as_view(), name='snippet-stats'),
     path('snippets/<int:pk>/', views.SnippetDetail.as_view(), name='snippet-detail'),
     path('snippets/<int:pk>/highlight/', views.SnippetHighlight.as_view(), name='snippet-highlight'),
+    path('snippets/<int:pk>/raw', views.SnippetRaw.as_view(), name='snippet-raw'),
     path('users/', views.UserList.as_view(), name='user-list'),
     path('users/<int:pk>/', views.UserDetail.as_view(), name='user-detail'),
+    path('users/<int:pk>/stats/', views.UserStats.as_view(), name='user-stats'),
 ])
 
 # we are all set, now we need to add some pagination because we are going to get alot of instances from our API
@@ -3,7 +3,8 @@ from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.parsers import JSONParser
 from .models import Snippet
-from .serializers import SnippetSerializer, UserSerializer
+from .serializers import (SnippetSerializer, UserSerializer, HighlightOptionsSerializer, LineRangeSerializer,
+                          RawSnippetSerializer, PopularSnippetSerializer, LanguageStatsSerializer)
 # working with requests and responses
 from rest_framework import status
 from rest_framework.decorators import api_view
@@ -19,6 +20,35 @@ from django.contrib.auth.models import User
 from .permissions import IsOwnerOrReadOnly
 # importing reverse for the root of our API
 from rest_framework.reverse import reverse
+# serving the pre-compressed highlight variants
+from django.utils.cache import patch_vary_headers
+from .compression import preferred_encoding
+from .highlighting import RenderLimitExceeded, render_on_demand
+# fetching line ranges of large snippets
+from .lines import LineIndex, build_index
+# serving raw code, optionally straight from files
+import os
+from django.http import FileResponse
+from django.utils.cache import get_conditional_response
+from .raw import RAW_ACCEL_PREFIX, RAW_SERVE_MODE, parse_byte_range, raw_store
+# streaming raw uploads
+from rest_framework.settings import api_settings
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import CharField
+from .parsers import PlainTextParser
+# sharing one lookup between concurrent requests for the same snippet
+import copy
+from .coalesce import SingleFlight
+from .routing import current_alias
+# buffered view counts and the popular snippets
+from .counters import view_counter
+from .models import RENDERED_FIELDS
+# precomputed snippet stats
+from .models import LanguageStats
+# hiding soft deleted users' snippets
+from django.db.models import Prefetch
+# request metrics for Prometheus
+from .metrics import exposition, may_scrape, registry
 
 """
 Writing regular Django views using our Serializer
@@ -430,10 +460,45 @@ module even more.
 """
 
 
-class SnippetList(generics.ListCreateAPIView):
-    queryset = Snippet.objects.all()
+class RawUploadMixin:
+    """
+    Accepts `text/plain` uploads, the body being the code and the other fields coming from the query string or
+    `X-Snippet-*` headers, so large pastes skip JSON parsing.
+    """
+    parser_classes = list(api_settings.DEFAULT_PARSER_CLASSES) + [PlainTextParser]
+
+    def is_raw_upload(self):
+        return self.request.content_type.split(';')[0].strip() == PlainTextParser.media_type
+
+    def raw_code(self):
+        # an empty body never reaches the parser. The body is stored as sent, untrimmed, but blank code is refused
+        # as the JSON path's serializer would
+        code = self.request.data if isinstance(self.request.data, str) else ''
+        if not code or code.isspace():
+            raise ValidationError({'code': [CharField.default_error_messages['blank']]}, code='blank')
+        return code
+
+    def save_raw_upload(self, instance=None, **kwargs):
+        code = self.raw_code()
+        serializer = RawSnippetSerializer(instance, data=RawSnippetSerializer.metadata(self.request),
+                                          partial=instance is not None, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        serializer.save(code=code, **kwargs)
+        return serializer
+
+
+class SnippetList(RawUploadMixin, generics.ListCreateAPIView):
+    # the owner's name is in every item; the renders aren't in any
+    queryset = Snippet.objects.live().select_related('owner').defer(*RENDERED_FIELDS)
     serializer_class = SnippetSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+
+    def create(self, request, *args, **kwargs):
+        if not self.is_raw_upload():
+            return super(SnippetList, self).create(request, *args, **kwargs)
+        serializer = self.save_raw_upload(owner=request.user)
+        headers = {'Location': serializer.data['url']}
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
     """
     
     Associating Snippets with Users
@@ -462,13 +527,105 @@ class SnippetList(generics.ListCreateAPIView):
         # snippets are associated to the user that created them
 
 
-class SnippetDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Snippet.objects.all()
+object_flight = SingleFlight()
+
+
+def copy_instance(instance):
+    """
+    A copy of a model instance that can be changed without affecting the original.
+    """
+    clone = copy.copy(instance)
+    # copy.copy shares `_state`, and the related objects cached on it, between the two
+    clone._state = copy.copy(instance._state)
+    clone._state.fields_cache = dict(instance._state.fields_cache)
+    return clone
+
+
+class CoalescedLookupMixin:
+    """
+    Lets concurrent read requests for the same snippet share one database query instead of each making their own.
+
+    Each request still checks its own object permissions, and gets its own copy of the snippet. Only requests reading
+    from the same database share a lookup, so a client pinned to the primary never gets a replica's stale row.
+    """
+
+    def get_object(self):
+        if self.request.method not in permissions.SAFE_METHODS:
+            return super(CoalescedLookupMixin, self).get_object()
+        key = (type(self), self.kwargs[self.lookup_url_kwarg or self.lookup_field], current_alias())
+        obj = copy_instance(object_flight.do(key, self.lookup_object))
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def lookup_object(self):
+        """
+        `get_object()` without the permission checks, which are up to each request sharing the result.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        return generics.get_object_or_404(queryset, **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+
+
+class LineRangeMixin:
+    """
+    Lets a snippet view answer `?lines=a-b` with just those lines, sliced using the snippet's stored line index.
+    """
+
+    def get_line_range(self):
+        """
+        Return the `(first, last)` lines asked for, `last` being None for an open range, or None for all of them.
+        """
+        options = LineRangeSerializer(data=self.request.query_params)
+        options.is_valid(raise_exception=True)
+        return options.validated_data.get('lines')
+
+
+class SnippetDetail(CoalescedLookupMixin, LineRangeMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = Snippet.objects.live().select_related('owner')
     serializer_class = SnippetSerializer
     # permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     permission_classes = [permissions.IsAuthenticatedOrReadOnly,
                           IsOwnerOrReadOnly]
 
+    def retrieve(self, request, *args, **kwargs):
+        line_range = self.get_line_range()
+        snippet = self.get_object()
+        view_counter.add(snippet.pk)
+        data = self.get_serializer(snippet).data
+        if line_range is not None:
+            index = snippet.get_line_index()
+            if index is None:
+                # rendered before line indexes were stored; build one for the code on the fly
+                index = LineIndex(build_index(snippet.code, '', 0, 0))
+            start, end, first, last = index.code_span(*line_range)
+            data['code'] = snippet.code[start:end]
+            data['lines'] = {'first': first, 'last': last, 'total': index.code_lines}
+        return Response(data)
+
+    def perform_destroy(self, instance):
+        # hidden now, deleted by the purger
+        instance.soft_delete()
+
+
+class SnippetPopular(generics.ListAPIView):
+    """
+    The most viewed snippets, most viewed first, as of the view counter's last flush.
+    """
+    serializer_class = PopularSnippetSerializer
+    pagination_class = None
+
+    def get_queryset(self):
+        popular = view_counter.get_popular()
+        # only the listed rows, and none of their big columns
+        snippets = Snippet.objects.live().select_related('owner').defer('code', *RENDERED_FIELDS).in_bulk(
+            [pk for pk, _ in popular])
+        listed = []
+        for pk, views in popular:
+            if pk in snippets:
+                snippets[pk].view_count = views
+                listed.append(snippets[pk])
+        return listed
+
 
 # Wow, that's pretty concise. We've gotten a huge amount for free, and our code looks like good, clean,
 # idiomatic Django.
@@ -487,16 +644,56 @@ Make sure to also import the UserSerializer class
 """
 
 
+# users marked for deletion are hidden, and so are deleted snippets in the users' snippet lists
+LIVE_USERS = User.objects.filter(pending_deletion__isnull=True).order_by('pk').prefetch_related(
+    Prefetch('snippets', queryset=Snippet.objects.filter(deleted=False).only('id', 'owner_id')))
+
+
 class UserList(generics.ListAPIView):
-    queryset = User.objects.all()
+    queryset = LIVE_USERS
     serializer_class = UserSerializer
 
 
 class UserDetail(generics.RetrieveAPIView):
-    queryset = User.objects.all()
+    queryset = LIVE_USERS
     serializer_class = UserSerializer
 
 
+def stats_data(rows):
+    """
+    Sum up a queryset of per-language stats rows into the body of a stats response.
+    """
+    languages = LanguageStatsSerializer(rows.filter(snippets__gt=0), many=True).data
+    return {
+        'snippets': sum(language['snippets'] for language in languages),
+        'code_bytes': sum(language['code_bytes'] for language in languages),
+        'languages': languages,
+    }
+
+
+class SnippetStats(generics.GenericAPIView):
+    """
+    How many snippets there are and their total size, overall and per language.
+    """
+    queryset = LanguageStats.objects.all()
+
+    def get(self, request, *args, **kwargs):
+        return Response(stats_data(self.get_queryset()))
+
+
+class UserStats(generics.GenericAPIView):
+    """
+    How many snippets a user has and their total size, overall and per language.
+    """
+    queryset = User.objects.filter(pending_deletion__isnull=True)
+
+    def get(self, request, *args, **kwargs):
+        user = self.get_object()
+        data = stats_data(user.language_stats.all())
+        data['user'] = reverse('user-detail', args=[user.pk], request=request)
+        return Response(data)
+
+
 """
 
 Finally we need to add those views into the API, by referencing them from the URL conf. Add the following to the patterns in snippets/urls.py.
@@ -583,6 +780,16 @@ def api_root(request, format=None):
     })
 
 
+def metrics(request):
+    """
+    Request metrics in the Prometheus text format, for every worker when SNIPPETS_METRICS_DIR is set. Only for the
+    addresses in SNIPPETS_METRICS_ALLOWED_IPS and staff users.
+    """
+    if not may_scrape(request):
+        return HttpResponse('Forbidden.\n', status=403, content_type='text/plain; charset=utf-8')
+    return HttpResponse(exposition(registry.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # Two things should be noticed here. First, we're using REST framework's reverse function in order to return
 # fully-qualified URLs; second, URL patterns are identified by convenience names that we will declare later on in our
 # snippets/urls.py.
@@ -606,13 +813,157 @@ Instead of using a concrete generic view, we'll use the base class for represent
 """
 
 
-class SnippetHighlight(generics.GenericAPIView):
-    queryset = Snippet.objects.all()
+class SnippetHighlight(CoalescedLookupMixin, LineRangeMixin, generics.GenericAPIView):
+    queryset = Snippet.objects.live()
     renderer_classes = [renderers.StaticHTMLRenderer]
 
+    def get_render_options(self, snippet):
+        """
+        Return the `(style, linenos, output)` asked for with `?style=`, `?linenos=` and `?output=`, or None when the
+        stored render fits.
+        """
+        options = HighlightOptionsSerializer(data=self.request.query_params)
+        options.is_valid(raise_exception=True)
+        style = options.validated_data.get('style', snippet.style)
+        # a BooleanField reads a parameter missing from a QueryDict as False, like an unticked checkbox
+        linenos = options.validated_data['linenos'] if 'linenos' in self.request.query_params else snippet.linenos
+        output = options.validated_data.get('output', 'html')
+        if (style, linenos, output) == (snippet.style, snippet.linenos, 'html'):
+            return None
+        return style, linenos, output
+
+    def get_lines(self, snippet, line_range):
+        """
+        Answer `?lines=a-b` with those lines of the stored render, as an HTML fragment.
+        """
+        index = snippet.get_line_index()
+        if index is None:
+            return Response('This snippet has no line index yet; it is added when the snippet is next rendered.',
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        start, end, first, last = index.html_span(*line_range)
+        response = Response(snippet.highlighted[start:end])
+        response['X-Line-Range'] = '%d-%d' % (first, last)
+        response['X-Total-Lines'] = str(index.html_lines)
+        return response
+
+    def get(self, request, *args, **kwargs):
+        snippet = self.get_object()
+        view_counter.add(snippet.pk)
+        line_range = self.get_line_range()
+        if line_range is not None:
+            return self.get_lines(snippet, line_range)
+        render_options = self.get_render_options(snippet)
+        if render_options is not None:
+            try:
+                rendered = render_on_demand(snippet, *render_options)
+            except RenderLimitExceeded as exc:
+                return Response(str(exc), status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            if render_options[2] == 'ansi':
+                return HttpResponse(rendered, content_type='text/plain; charset=utf-8')
+            return Response(rendered)
+        encoding = preferred_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), snippet.highlight_encodings)
+        if encoding:
+            # send the bytes compressed at save time rather than compressing the document again
+            response = HttpResponse(snippet.compressed_highlight(encoding), content_type='text/html; charset=utf-8')
+            response['Content-Encoding'] = encoding
+        else:
+            response = Response(snippet.highlighted)
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+
+RAW_CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+
+class SnippetRaw(CoalescedLookupMixin, RawUploadMixin, generics.GenericAPIView):
+    """
+    The snippet's code as plain text, with an ETag and single byte-range support. The owner can replace it with a
+    `text/plain` PUT.
+    """
+    queryset = Snippet.objects.live()
+    permission_classes = [permissions.IsAuthenticatedOrReadOnly,
+                          IsOwnerOrReadOnly]
+    parser_classes = [PlainTextParser]
+
+    def get_queryset(self):
+        queryset = super(SnippetRaw, self).get_queryset()
+        if self.request.method not in permissions.SAFE_METHODS:
+            return queryset
+        # the code is all we send, and with a raw store we only read it to write a missing file, from the archive if
+        # the snippet is archived
+        fields = ('id', 'version', 'archive_segment') if raw_store is not None else (
+            'id', 'version', 'code', 'archive_segment')
+        return queryset.only(*fields)
+
+    def get_byte_range(self, etag, size):
+        header = self.request.META.get('HTTP_RANGE')
+        if not header:
+            return None
+        # If-Range: only send part of the body if the client's copy is still the current one
+        if_range = self.request.META.get('HTTP_IF_RANGE')
+        if if_range and if_range != etag:
+            return None
+        return parse_byte_range(header, size)
+
+    def ranged_response(self, read, size, byte_range):
+        """
+        Build the 200, 206 or 416 response, `read(start, end)` returning those bytes of the body.
+        """
+        if byte_range == ():
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        start, end = byte_range or (0, size)
+        response = HttpResponse(read(start, end), content_type=RAW_CONTENT_TYPE)
+        if byte_range:
+            response.status_code = status.HTTP_206_PARTIAL_CONTENT
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+        response['Content-Length'] = str(end - start)
+        return response
+
+    def stored_response(self, snippet, etag):
+        path = raw_store.ensure(snippet)
+        if RAW_SERVE_MODE == 'x-accel-redirect':
+            # nginx sends the file, ranges included
+            response = HttpResponse(content_type=RAW_CONTENT_TYPE)
+            relative = raw_store.relative_path(snippet.pk, snippet.version).replace(os.sep, '/')
+            response['X-Accel-Redirect'] = RAW_ACCEL_PREFIX + relative
+            return response
+        size = os.path.getsize(path)
+        byte_range = self.get_byte_range(etag, size)
+        if byte_range is None:
+            # the WSGI server's file wrapper sends the whole file with sendfile(2)
+            response = FileResponse(open(path, 'rb'), content_type=RAW_CONTENT_TYPE)
+            response['Content-Length'] = str(size)
+            return response
+
+        def read(start, end):
+            with open(path, 'rb') as stored:
+                return os.pread(stored.fileno(), end - start, start)
+        return self.ranged_response(read, size, byte_range)
+
     def get(self, request, *args, **kwargs):
         snippet = self.get_object()
-        return Response(snippet.highlighted)
+        # a code change always bumps the version, so pk and version identify the body
+        etag = '"%d-%d"' % (snippet.pk, snippet.version)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            if raw_store is not None:
+                response = self.stored_response(snippet, etag)
+            else:
+                body = snippet.code.encode('utf-8')
+                response = self.ranged_response(lambda start, end: body[start:end], len(body),
+                                                self.get_byte_range(etag, len(body)))
+        response['ETag'] = etag
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    def put(self, request, *args, **kwargs):
+        snippet = self.get_object()
+        serializer = self.save_raw_upload(snippet)
+        response = Response(serializer.data)
+        response['ETag'] = '"%d-%d"' % (snippet.pk, snippet.version)
+        return response
 
 
 """
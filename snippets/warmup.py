@@ -0,0 +1,149 @@
+"""
+Warming a server process up before it forks its workers.
+
+Left alone, each WSGI worker imports the pygments lexers it is asked for, builds the formatters and style tables of
+the styles viewers pick, populates Django's URL resolver and builds the serializer fields on its first requests: the
+first requests are slow, and every worker ends up with a private copy of all of it. `warm_up()` does that work once,
+in the process that is about to fork, so the workers start with it done and share those pages with the master
+copy-on-write for as long as nothing writes to them. It also moves everything allocated so far out of the garbage
+collector's reach with `gc.freeze()`, as a collection in a worker touching every object would otherwise copy the
+pages anyway.
+
+mainAPI/wsgi.py calls it when SNIPPETS_WARM_UP is set. To run it before the fork, have the server load the
+application in its master process: `gunicorn --preload mainAPI.wsgi`, or uWSGI without `lazy-apps`. It queries no
+database and starts no thread or process pool, which would not survive the fork.
+
+`process_memory()` reads how much of a process's memory is shared and how much private from /proc, for
+`manage.py memory_report` to compare the workers of a running server, or warm and cold forks.
+"""
+import gc
+import os
+import time
+
+from django.conf import settings
+from django.template.loader import get_template
+from django.urls import get_resolver, resolve
+from django.utils import translation
+from pygments.styles import get_style_by_name
+
+from .highlighting import get_output_formatter, render_with_state
+from .metadata import CachedMetadata
+from .models import STYLE_CHOICES
+from .serializers import CachedFieldsMixin, RawSnippetSerializer, SnippetSerializer
+
+WARM_UP = getattr(settings, 'SNIPPETS_WARM_UP', True)
+WARM_LEXERS = getattr(settings, 'SNIPPETS_WARM_LEXERS', (
+    'python', 'javascript', 'bash', 'java', 'html', 'sql', 'c', 'cpp', 'json', 'go', 'rust', 'ruby', 'php', 'css',
+    'yaml', 'text',
+))
+
+# rendered with every warm lexer, so the lexer's rules are compiled and the stored-render path has run once
+WARM_SAMPLE = 'x = f("a", 1)  # b\n'
+WARM_TEMPLATES = ('rest_framework/api.html', 'rest_framework/login.html')
+WARM_SERIALIZERS = (SnippetSerializer, RawSnippetSerializer)
+
+
+def warm_up(freeze=True):
+    """
+    Load and build what the workers would otherwise each build on first use, returning how long each part took.
+    """
+    timings = {}
+
+    def step(name, func):
+        start = time.perf_counter()
+        func()
+        timings[name] = time.perf_counter() - start
+
+    with translation.override(settings.LANGUAGE_CODE):
+        step('lexers', warm_lexers)
+        step('formatters', warm_formatters)
+        step('urls', warm_urls)
+        step('serializers', warm_serializers)
+        step('templates', warm_templates)
+    if freeze:
+        start = time.perf_counter()
+        gc.collect()
+        gc.freeze()
+        timings['gc'] = time.perf_counter() - start
+    return timings
+
+
+def warm_lexers():
+    for language in WARM_LEXERS:
+        render_with_state(WARM_SAMPLE, language, 'friendly', False)
+
+
+def warm_formatters():
+    # the on-demand formatters are cached per process; stored renders build theirs from the same style classes
+    for style, _ in STYLE_CHOICES:
+        get_style_by_name(style)
+        for linenos in (False, True):
+            get_output_formatter('html', style, linenos)
+
+
+def warm_urls():
+    resolver = get_resolver()
+    # both directions, for the active language
+    resolver.reverse_dict
+    resolve('/snippets/')
+
+
+def warm_serializers():
+    metadata = CachedMetadata()
+    for serializer_class in WARM_SERIALIZERS:
+        serializer = serializer_class()
+        serializer.fields
+        if isinstance(serializer, CachedFieldsMixin):
+            metadata.get_serializer_info(serializer)
+
+
+def warm_templates():
+    for name in WARM_TEMPLATES:
+        get_template(name)
+
+
+# what /proc/<pid>/smaps_rollup calls the fields process_memory() reports, all in kB
+SMAPS_FIELDS = {
+    'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared_clean', 'Shared_Dirty': 'shared_dirty',
+    'Private_Clean': 'private_clean', 'Private_Dirty': 'private_dirty',
+}
+
+
+def process_memory(pid):
+    """
+    Return the resident memory of process `pid` in bytes: `rss`, `pss`, and the `shared` and `private` parts of it.
+
+    Pages are shared while another process maps them too, which for a forked worker means not yet written to since
+    the fork. Linux only; older kernels without smaps_rollup have their smaps summed instead.
+    """
+    totals = dict.fromkeys(SMAPS_FIELDS.values(), 0)
+    path = '/proc/%d/smaps_rollup' % pid
+    if not os.path.exists(path):
+        path = '/proc/%d/smaps' % pid
+    with open(path) as smaps:
+        for line in smaps:
+            name, _, value = line.partition(':')
+            if name in SMAPS_FIELDS:
+                totals[SMAPS_FIELDS[name]] += int(value.split()[0]) * 1024
+    totals['shared'] = totals.pop('shared_clean') + totals.pop('shared_dirty')
+    totals['private'] = totals.pop('private_clean') + totals.pop('private_dirty')
+    return totals
+
+
+def child_pids(parent):
+    """
+    The ids of the processes whose parent is `parent`, such as the workers of a server's master process.
+    """
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as stat:
+                # the command name in parentheses may contain spaces
+                fields = stat.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            children.append(int(entry))
+    return sorted(children)